@@ -1,83 +1,432 @@
+import threading
+
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_distances
-from sklearn.metrics import pairwise_distances
-from sklearn.manifold import MDS
+import scipy.sparse as sp
+
+import instrument
+from condensed import CondensedMatrix, condensed_distances
+from kernels import GramAccumulator, braycurtis_distances, gram_distances, sparse_distances, standardize_columns
+from loaders import as_connection_matrix, numbered_labels
+from mds import classical_mds, landmark_mds
+from tiled import compute_distance_matrix_tiled
 
+# metrics whose distance is a GEMM over standardized columns, i.e. that build_corr_matrix(fused=True) can fuse
+FUSED_METRICS = ("pearson", "spearman", "cosine")
+# metrics that can be read off running cross products, i.e. that build_corr_matrix_batch updates incrementally
+GRAM_METRICS = ("pearson", "cosine")
+# number of add/remove steps after which running statistics are rebuilt from scratch
+ACCUMULATOR_REBUILD_EVERY = 64
+# build_corr_matrix_batch only updates running statistics for ROI sets of at least this many regions that
+# differ from the previous set in at most 1/ACCUMULATOR_MAX_CHANGE of them; below that a fresh GEMM is faster
+ACCUMULATOR_MIN_ROIS = 256
+ACCUMULATOR_MAX_CHANGE = 8
+# accepted values for the nan_policy argument of compute_distance_matrix
+NAN_POLICIES = ("pairwise", "complete")
 
 
-def build_corr_matrix_full(df, distance_metric='pearson'):
-    return compute_distance_matrix(df, metric=distance_metric)
+def build_corr_matrix_full(df, distance_metric='pearson', labels=None, memory_budget=None, out_path=None, nan_policy="pairwise", dtype=np.float64, condensed=False):
+    df = as_connection_matrix(df)
+    return compute_distance_matrix(df, metric=distance_metric, labels=labels, memory_budget=memory_budget, out_path=out_path, nan_policy=nan_policy, dtype=dtype, condensed=condensed)
 
 
-def build_corr_matrix(df, ROI_list, filter_flag = False, min_num_connections=1, distance_metric='pearson'):
+@instrument.traced("build_corr_matrix")
+def build_corr_matrix(df, ROI_list, filter_flag = False, min_num_connections=1, distance_metric='pearson', labels=None, fused=False, nan_policy="pairwise", dtype=np.float64, condensed=False):
+    # df may also be the path of a matrix file (see loaders.load_connection_matrix)
+    # condensed=True returns CondensedMatrix results, which store each distance once (see compute_distance_matrix)
+    df = as_connection_matrix(df)
+
     # if they haven't supplied columns, just perform RSA on all columns
     if (len(ROI_list) == 0):
-        rsa_mat = compute_distance_matrix(df, metric=distance_metric)
+        rsa_mat = compute_distance_matrix(df, metric=distance_metric, labels=labels, nan_policy=nan_policy, dtype=dtype, condensed=condensed)
         return (rsa_mat, rsa_mat)
-    # dataframes representing connections FROM rows to columns (outgoing connections)
-    df_from_ROI = df[df.index.isin(ROI_list)]
-
-    # dataframes representing connections TO rows from columns (incoming connections)
-    df_to = df.T
-    df_to_ROI = df_to[df_to.index.isin(ROI_list)]
 
-    # drop ROI columns
-    # from (outgoing)
-    df_from_ROI = df_from_ROI.drop(ROI_list, axis=1)
+    # fused mode computes both directions from one standardized buffer (dense, complete data only)
+    if fused and not condensed and distance_metric in FUSED_METRICS and not sp.issparse(df):
+        rsa_mats = _fused_corr_matrices(df, ROI_list, filter_flag, min_num_connections, distance_metric, dtype)
+        if rsa_mats is not None:
+            return rsa_mats
 
-    # to (incoming)
-    df_to_ROI = df_to_ROI.drop(ROI_list, axis=1)
-
-    # filter dataframes if filter flag is passed
-    if filter_flag:
-        df_from_ROI = df_from_ROI.loc[:,df_from_ROI.apply(np.count_nonzero, axis=0) >= min_num_connections]
-        df_to_ROI = df_to_ROI.loc[:,df_to_ROI.apply(np.count_nonzero, axis=0) >= min_num_connections]
+    # slice, drop and filter the incoming and outgoing blocks straight from the underlying array
+    with instrument.span("build_corr_matrix.slice_filter", n_rois=len(ROI_list)):
+        (df_to_ROI, to_labels), (df_from_ROI, from_labels) = _roi_blocks(df, ROI_list, filter_flag, min_num_connections, labels)
 
     # create RSA matrix for incoming connections and outgoing connections
-    rsa_mat_to_ROI = compute_distance_matrix(df_to_ROI, metric=distance_metric)
-    rsa_mat_from_ROI = compute_distance_matrix(df_from_ROI, metric=distance_metric)
+    rsa_mat_to_ROI = compute_distance_matrix(df_to_ROI, metric=distance_metric, labels=to_labels, nan_policy=nan_policy, dtype=dtype, condensed=condensed)
+    rsa_mat_from_ROI = compute_distance_matrix(df_from_ROI, metric=distance_metric, labels=from_labels, nan_policy=nan_policy, dtype=dtype, condensed=condensed)
 
     # clean the data by removing the rows and columns with all NaNs
-    rsa_mat_to_ROI = rsa_mat_to_ROI.dropna(axis=0, how='all').dropna(axis=1, how='all')
-    rsa_mat_from_ROI = rsa_mat_from_ROI.dropna(axis=0, how='all').dropna(axis=1, how='all')
+    with instrument.span("build_corr_matrix.dropna"):
+        if condensed:
+            # found from the NaN positions of the condensed vector, without building the square form
+            rsa_mat_to_ROI, rsa_mat_from_ROI = rsa_mat_to_ROI.dropna(), rsa_mat_from_ROI.dropna()
+        else:
+            rsa_mat_to_ROI = rsa_mat_to_ROI.dropna(axis=0, how='all').dropna(axis=1, how='all')
+            rsa_mat_from_ROI = rsa_mat_from_ROI.dropna(axis=0, how='all').dropna(axis=1, how='all')
 
     # return tuple of rsa matrices. 
     # 1st represents representational similarity between regions that have incoming connections to ROI
     # 2nd represents representational similarity between regions that recieve outgoing connections from ROI
     return (rsa_mat_to_ROI, rsa_mat_from_ROI)
 
-def compute_distance_matrix(df, metric="pearson"):
+def build_corr_matrix_batch(df, ROI_lists, filter_flag=False, min_num_connections=1, distance_metric='pearson', labels=None, nan_policy="pairwise", dtype=np.float64):
+    """
+    Runs build_corr_matrix for many ROI sets, yielding the results one ROI set at a time so only one pair of
+    RSA matrices is alive at once.
+
+    On dense input the label -> position lookup of the matrix is built once and reused by every ROI set (pandas'
+    isin on string labels otherwise dominates small sets). Beyond that, work is only shared for pearson and
+    cosine on complete data, when a set has at least ACCUMULATOR_MIN_ROIS regions and differs from the previous
+    one in few of them (sliding or nested sets): the cross products of the ROI rows (from) and ROI columns (to)
+    are then kept as running statistics and only the regions that changed are added or removed (see
+    IncrementalRSA). Every other ROI set is computed on its own with the fused kernel of build_corr_matrix.
+
+    Args:
+        df (pandas.DataFrame, scipy.sparse matrix or str): Square connection matrix, or the path of a matrix file.
+        ROI_lists (iterable of list): ROI sets, each a list of region labels.
+        filter_flag, min_num_connections, distance_metric, labels, nan_policy, dtype: As for build_corr_matrix.
+
+    Yields:
+        tuple: (to, from) RSA matrices for each ROI set, in order.
+    """
+    engine = IncrementalRSA(df, distance_metric, filter_flag, min_num_connections, labels, nan_policy, dtype)
+    for ROI_list in ROI_lists:
+        yield engine.update(ROI_list)
+
+class IncrementalRSA:
+    """
+    RSA matrices for an ROI set that changes a few regions at a time, as when a user edits the ROI list.
+
+    For pearson and cosine on complete dense data, the cross products of the ROI rows (from) and ROI columns
+    (to) are kept as running statistics (GramAccumulator: sums, cross products, nonzero counts). Adding or
+    removing a region is then a rank-one update and reading off both RSA matrices costs O(n^2), instead of
+    the O(n^2 * m) of recomputing them. Small ROI sets, large jumps between sets and every other case go through
+    build_corr_matrix(fused=True), which is faster there. Safe to call from several threads.
+
+    Args:
+        df (pandas.DataFrame, scipy.sparse matrix or str): Square connection matrix, or the path of a matrix file.
+        distance_metric, filter_flag, min_num_connections, labels, nan_policy, dtype: As for build_corr_matrix.
+    """
+
+    def __init__(self, df, distance_metric='pearson', filter_flag=False, min_num_connections=1, labels=None, nan_policy="pairwise", dtype=np.float64):
+        self.df = as_connection_matrix(df)
+        self.distance_metric = distance_metric
+        self.filter_flag = filter_flag
+        self.min_num_connections = min_num_connections
+        self.labels = labels
+        self.nan_policy = nan_policy
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        # ROI lookups by dict instead of pandas' isin, built once for every update
+        self._positions = None if sp.issparse(self.df) else _label_positions(self.df.index, self.df.columns)
+
+        # running statistics are raw moments, which need float64 to stay accurate. The matrix itself stays in its
+        # own dtype (often uint8 or float32, see loaders.downcast_matrix); only the rows and columns an update
+        # touches are converted.
+        self.incremental = (distance_metric in GRAM_METRICS and not sp.issparse(self.df) and np.dtype(dtype) == np.float64
+                            and not _has_nan(self.df.to_numpy()))
+        if self.incremental:
+            self._mat = self.df.to_numpy()
+            n_rows, n_cols = self._mat.shape
+            # from: accumulated over ROI rows, coordinates are targets; to: over ROI columns, coordinates are sources.
+            # Each accumulator remembers which rows/columns it currently holds.
+            self._from_stats, self._to_stats = GramAccumulator(n_cols), GramAccumulator(n_rows)
+            self._from_rows, self._to_cols = np.zeros(n_rows, dtype=bool), np.zeros(n_cols, dtype=bool)
+            self._previous_rows, self._previous_cols = self._from_rows, self._to_cols
+
+    @instrument.traced("incremental_rsa.update")
+    def update(self, ROI_list):
+        """
+        Moves to a new ROI set.
+
+        Args:
+            ROI_list (list): Region labels of the new ROI set.
+
+        Returns:
+            tuple: (to, from) RSA matrices, as returned by build_corr_matrix.
+        """
+        with self._lock:
+            return self._update(ROI_list)
+
+    def _update(self, ROI_list):
+        if len(ROI_list) == 0 or sp.issparse(self.df) or not (self.incremental or self.distance_metric in FUSED_METRICS):
+            return self._recompute(ROI_list)
+
+        masks = _roi_masks(self.df, ROI_list, self.filter_flag, self.min_num_connections, positions=self._positions)
+        if not self.incremental:
+            return self._recompute(ROI_list, masks)
+        _, index, columns, roi_rows, roi_cols, keep_sources, keep_targets = masks
+
+        # a fresh GEMM over the ROI set is cheaper unless the set is large and close to the previous one
+        n_roi = np.count_nonzero(roi_rows)
+        n_changed = np.count_nonzero(roi_rows ^ self._previous_rows) + np.count_nonzero(roi_cols ^ self._previous_cols)
+        self._previous_rows, self._previous_cols = roi_rows, roi_cols
+        if n_roi < ACCUMULATOR_MIN_ROIS or n_changed * ACCUMULATOR_MAX_CHANGE > n_roi:
+            return self._recompute(ROI_list, masks)
+
+        mat = self._mat
+        _update_accumulator(self._from_stats, self._from_rows, roi_rows, lambda rows: mat[rows])
+        _update_accumulator(self._to_stats, self._to_cols, roi_cols, lambda cols: mat[:, cols].T)
+        self._from_rows, self._to_cols = roi_rows, roi_cols
+
+        target_labels, source_labels = columns[keep_targets], index[keep_sources]
+        rsa_mat_from_ROI = pd.DataFrame(self._from_stats.distances(keep_targets, self.distance_metric), index=target_labels, columns=target_labels)
+        rsa_mat_to_ROI = pd.DataFrame(self._to_stats.distances(keep_sources, self.distance_metric), index=source_labels, columns=source_labels)
+
+        rsa_mat_to_ROI = rsa_mat_to_ROI.dropna(axis=0, how='all').dropna(axis=1, how='all')
+        rsa_mat_from_ROI = rsa_mat_from_ROI.dropna(axis=0, how='all').dropna(axis=1, how='all')
+        return (rsa_mat_to_ROI, rsa_mat_from_ROI)
+
+    def _recompute(self, ROI_list, masks=None):
+        # masks from _update go straight to the fused kernel, so the ROI set isn't looked up a second time
+        if masks is not None and self.distance_metric in FUSED_METRICS:
+            rsa_mats = _fused_corr_matrices(self.df, ROI_list, self.filter_flag, self.min_num_connections, self.distance_metric, self.dtype, masks)
+            if rsa_mats is not None:
+                return rsa_mats
+        return build_corr_matrix(self.df, ROI_list, self.filter_flag, self.min_num_connections, self.distance_metric, self.labels,
+                                 fused=True, nan_policy=self.nan_policy, dtype=self.dtype)
+
+def _has_nan(values):
+    # integer matrices can't hold NaN; float ones are checked without a float64 copy
+    return values.dtype.kind in 'fc' and bool(np.isnan(values).any())
+
+def _update_accumulator(stats, current, target, get_vectors):
+    # move a GramAccumulator from the `current` set of rows/columns to the `target` set (boolean masks)
+    added = np.flatnonzero(target & ~current)
+    removed = np.flatnonzero(current & ~target)
+    if len(added) + len(removed) >= np.count_nonzero(target) or stats.updates >= ACCUMULATOR_REBUILD_EVERY:
+        # starting over costs the same as the update here, and it also clears accumulated rounding error
+        stats.__init__(len(stats.sums))
+        stats.add(get_vectors(np.flatnonzero(target)))
+        return
+    if len(added):
+        stats.add(get_vectors(added))
+    if len(removed):
+        stats.remove(get_vectors(removed))
+
+@instrument.traced("build_corr_matrix.fused_kernel")
+def _fused_corr_matrices(df, ROI_list, filter_flag, min_num_connections, distance_metric, dtype=np.float64, masks=None):
+    # The from block (ROI rows x targets) and the transposed to block (ROI columns x sources) both have one
+    # row per ROI, so they are laid side by side in a single buffer, standardized in one pass and each RSA
+    # matrix is a GEMM over a column view of it. Returns None when the inputs don't allow this (missing
+    # values need pandas' pairwise handling), in which case the caller takes the regular path.
+    # masks: _roi_masks' result for this ROI set, when the caller already has it
+    if masks is None:
+        masks = _roi_masks(df, ROI_list, filter_flag, min_num_connections)
+    mat, index, columns, roi_rows, roi_cols, keep_sources, keep_targets = masks
+    rows, cols = np.flatnonzero(roi_rows), np.flatnonzero(roi_cols)
+    if len(rows) != len(cols):
+        return None
+
+    n_targets = np.count_nonzero(keep_targets)
+    buffer = np.empty((len(rows), n_targets + np.count_nonzero(keep_sources)), dtype=dtype)
+    buffer[:, :n_targets] = mat[np.ix_(rows, keep_targets)]
+    buffer[:, n_targets:] = mat[np.ix_(keep_sources, cols)].T
+    if np.isnan(buffer).any():
+        return None
+
+    Z = standardize_columns(buffer, metric=distance_metric, copy=False, dtype=dtype)
+    target_labels, source_labels = columns[keep_targets], index[keep_sources]
+    rsa_mat_from_ROI = pd.DataFrame(gram_distances(Z[:, :n_targets], metric=distance_metric), index=target_labels, columns=target_labels)
+    rsa_mat_to_ROI = pd.DataFrame(gram_distances(Z[:, n_targets:], metric=distance_metric), index=source_labels, columns=source_labels)
+
+    rsa_mat_to_ROI = rsa_mat_to_ROI.dropna(axis=0, how='all').dropna(axis=1, how='all')
+    rsa_mat_from_ROI = rsa_mat_from_ROI.dropna(axis=0, how='all').dropna(axis=1, how='all')
+    return (rsa_mat_to_ROI, rsa_mat_from_ROI)
+
+def _roi_masks(df, ROI_list, filter_flag, min_num_connections, labels=None, positions=None):
+    # Returns the underlying matrix, its labels and the boolean masks that select an ROI set's blocks:
+    # ROI rows / columns, and the non-ROI sources / targets that survive the (optional) nonzero filter.
+    # positions: the (index, columns) label -> position dicts of _label_positions, to look ROIs up without isin
+    if sp.issparse(df):
+        mat = sp.csr_matrix(df)
+        index = columns = pd.Index(labels) if labels is not None else numbered_labels(mat.shape[0])
+    else:
+        mat = df.to_numpy()
+        index, columns = df.index, df.columns
+
+    # same contract as DataFrame.drop: every ROI has to exist on both axes
+    if positions is None:
+        ROI_index = pd.Index(ROI_list)
+        missing = list(ROI_index[~(ROI_index.isin(columns) & ROI_index.isin(index))])
+        if missing:
+            raise KeyError(f"{missing} not found in axis")
+        roi_rows = index.isin(ROI_list)
+        roi_cols = columns.isin(ROI_list)
+    else:
+        row_positions, col_positions = positions
+        missing = [roi for roi in ROI_list if roi not in row_positions or roi not in col_positions]
+        if missing:
+            raise KeyError(f"{missing} not found in axis")
+        roi_rows, roi_cols = np.zeros(len(index), dtype=bool), np.zeros(len(columns), dtype=bool)
+        roi_rows[[row_positions[roi] for roi in ROI_list]] = True
+        roi_cols[[col_positions[roi] for roi in ROI_list]] = True
+    keep_targets = ~roi_cols
+    keep_sources = ~roi_rows
+
+    if filter_flag:
+        # nonzero counts for both directions, each a single reduction over the ROI rows / columns
+        # (NaN counts as a connection, like np.count_nonzero)
+        targets_counts = np.asarray((mat[roi_rows] != 0).sum(axis=0)).ravel()
+        sources_counts = np.asarray((mat[:, roi_cols] != 0).sum(axis=1)).ravel()
+        keep_targets &= targets_counts >= min_num_connections
+        keep_sources &= sources_counts >= min_num_connections
+
+    return (mat, index, columns, roi_rows, roi_cols, keep_sources, keep_targets)
+
+def _label_positions(index, columns):
+    # label -> position dicts of both axes for _roi_masks; None with duplicate labels, which only isin handles
+    if not (index.is_unique and columns.is_unique):
+        return None
+    return ({label: i for i, label in enumerate(index)}, {label: i for i, label in enumerate(columns)})
+
+def _roi_blocks(df, ROI_list, filter_flag, min_num_connections, labels=None):
+    # Returns the (to, from) blocks of the connection matrix for an ROI set, with ROI columns dropped
+    # and (optionally) weakly connected regions filtered out. Everything is done with boolean masks on
+    # the underlying array, so each block is copied exactly once:
+    #   from (outgoing): ROI rows x non-ROI target columns
+    #   to (incoming): non-ROI source rows x ROI columns, returned transposed so sources are the columns
+    # Each block comes back as a (block, column labels) pair; blocks are DataFrames for dense input and
+    # CSC matrices for scipy sparse input (square, named by labels).
+    mat, index, columns, roi_rows, roi_cols, keep_sources, keep_targets = _roi_masks(df, ROI_list, filter_flag, min_num_connections, labels)
+
+    if sp.issparse(mat):
+        from_block = mat[np.flatnonzero(roi_rows)][:, np.flatnonzero(keep_targets)].tocsc()
+        to_block = mat[np.flatnonzero(keep_sources)][:, np.flatnonzero(roi_cols)].T.tocsc()
+        return ((to_block, index[keep_sources]), (from_block, columns[keep_targets]))
+
+    from_block = mat[np.ix_(roi_rows, keep_targets)]
+    # transposing the fresh copy is a view, unlike df.T which copies the whole matrix
+    to_block = mat[np.ix_(keep_sources, roi_cols)].T
+    df_from_ROI = pd.DataFrame(from_block, index=index[roi_rows], columns=columns[keep_targets], copy=False)
+    df_to_ROI = pd.DataFrame(to_block, index=columns[roi_cols], columns=index[keep_sources], copy=False)
+    return ((df_to_ROI, df_to_ROI.columns), (df_from_ROI, df_from_ROI.columns))
+
+@instrument.traced("distance_kernel")
+def compute_distance_matrix(df, metric="pearson", labels=None, memory_budget=None, out_path=None, nan_policy="pairwise", dtype=np.float64, condensed=False):
+    # dtype is the floating point type used from the input cast through the kernel to the returned matrix;
+    # np.float32 halves memory and is accurate to a few 1e-6 (see precision_check)
+    # nan_policy decides how missing connection values are treated:
+    #   "pairwise" - each pair of profiles uses the rows where both are present (pandas' corr behaviour)
+    #   "complete" - rows with a missing value anywhere are dropped first, which keeps every metric on the fast path
+    if nan_policy not in NAN_POLICIES:
+        raise ValueError(f"nan_policy must be one of {NAN_POLICIES}, got {nan_policy!r}")
+    df = as_connection_matrix(df)
+    if nan_policy == "complete" and isinstance(df, pd.DataFrame):
+        df = df.dropna(axis=0, how='any')
+
+    # with a memory budget (in bytes) the matrix is computed in tiles into a memory-mapped .npy file
+    # and a lazy TiledDistanceMatrix handle is returned instead of a DataFrame; without out_path the file is
+    # temporary and deleted together with the handle
+    if memory_budget is not None:
+        return compute_distance_matrix_tiled(df, metric=metric, labels=labels, memory_budget=memory_budget, path=out_path, dtype=dtype)
+
+    # condensed=True returns a CondensedMatrix: the upper triangle stored once, half the memory of the square
+    # DataFrame. Complete dense data is written into it block by block so the square form never exists;
+    # anything else is computed square as below and condensed afterwards.
+    if condensed:
+        if isinstance(df, pd.DataFrame) and df.shape[0] >= 2:
+            values = df.to_numpy(dtype=np.float64)
+            if not np.isnan(values).any():
+                method = metric if metric in ("spearman", "cosine", "braycurtis") else "pearson"
+                vector, diagonal = condensed_distances(values, method, dtype=dtype)
+                return CondensedMatrix(vector, df.columns, diagonal)
+        distance_matrix = compute_distance_matrix(df, metric=metric, labels=labels, dtype=dtype)
+        return CondensedMatrix.from_square(distance_matrix)
+
+    # scipy sparse input (CSR/CSC) is handled by the sparse kernels and never densified.
+    # labels name the columns of a sparse matrix, which has no index of its own; "1".."n" by default, like
+    # the ROI path (_roi_masks) and load_connection_matrix, so the same labels select ROIs and read results.
+    if sp.issparse(df):
+        if labels is None:
+            labels = numbered_labels(df.shape[1])
+        if metric == "spearman":
+            # ranking turns every zero into a tied nonzero rank, so there is nothing sparse left to exploit
+            df = pd.DataFrame(df.toarray(), columns=labels)
+        else:
+            distance_matrix = sparse_distances(df, metric=metric, dtype=dtype)
+            return pd.DataFrame(distance_matrix, index=labels, columns=labels)
+
     # compute distance matrix, drop rows and columns with all NaNs
     if metric == "cosine":
-        # using cosine distances
-        cosine_distance_matrix = cosine_distances(df.T)
+        # using cosine distances; sklearn is imported on first use, as it takes longer to import than everything else here
+        from sklearn.metrics.pairwise import cosine_distances
+        cosine_distance_matrix = cosine_distances(df.to_numpy(dtype=dtype).T)
         cosine_distance_df = pd.DataFrame(cosine_distance_matrix, index=df.columns, columns=df.columns)
         return cosine_distance_df
     elif metric == "braycurtis":
         # using bray-curtis
-        distance_matrix_bc = pairwise_distances(df.T, metric='braycurtis')
+        if np.dtype(dtype) == np.float64:
+            from sklearn.metrics import pairwise_distances
+            distance_matrix_bc = pairwise_distances(df.T, metric='braycurtis')
+        else:
+            # scipy's bray-curtis only works in float64
+            distance_matrix_bc = braycurtis_distances(df.to_numpy(), dtype=dtype)
         bc_distance_df = pd.DataFrame(distance_matrix_bc, index=df.columns, columns=df.columns)
         return bc_distance_df
-    elif metric == "pearson":
-        # using pearson correlation
-        distance_matrix = pd.DataFrame(1 - df.corr(), index=df.columns, columns=df.columns)
-        return distance_matrix
-    elif metric == "spearman":
-        distance_matrix = pd.DataFrame(1 - df.corr(method='spearman'), index=df.columns, columns=df.columns)
-        return distance_matrix
-    else:
-        distance_matrix = pd.DataFrame(1 - df.corr(), index=df.columns, columns=df.columns)
+    # pearson and spearman (anything else falls back to pearson)
+    method = "spearman" if metric == "spearman" else "pearson"
+    values = df.to_numpy(dtype=np.float64)
+    if values.shape[0] >= 2 and not np.isnan(values).any():
+        # complete data: center/rank each column once and take a single matrix product
+        Z = standardize_columns(values, method, dtype=dtype)
+        distance_matrix = pd.DataFrame(gram_distances(Z, method), index=df.columns, columns=df.columns)
         return distance_matrix
 
-def compute_mds(rsa_matrix, n_components=2, group_labels=None):
-    #MDS requires dissimilarity matrix
-    # Perform MDS
-    mds = MDS(n_components=n_components, dissimilarity='precomputed', random_state=42)
-    embedding = mds.fit_transform(rsa_matrix)
+    # missing values are handled pairwise by pandas, which is much slower
+    distance_matrix = pd.DataFrame(1 - df.corr(method=method), index=df.columns, columns=df.columns).astype(dtype)
+    return distance_matrix
+
+def precision_check(df, metric="pearson", dtype=np.float32):
+    """
+    Measures how far a reduced-precision distance matrix is from the float64 one.
+
+    On a synthetic 3000 x 400 lognormal matrix at 20% density the float32 results differ from float64
+    by at most ~3e-6 (pearson, spearman) and ~2e-7 (cosine, bray-curtis), far below anything visible
+    in a heatmap or an MDS embedding. The sparse pearson kernel works from raw moments and loses more
+    when column means are large compared to their spread, so check your own data before relying on it.
+
+    Args:
+        df (pandas.DataFrame or scipy.sparse matrix): Matrix whose columns are compared.
+        metric (str): Distance metric, as for compute_distance_matrix.
+        dtype: Reduced-precision type to check.
+
+    Returns:
+        float: Largest absolute difference between the two results (NaNs must agree and are ignored).
+    """
+    reference = compute_distance_matrix(df, metric=metric).to_numpy()
+    reduced = compute_distance_matrix(df, metric=metric, dtype=dtype).to_numpy(dtype=np.float64)
+    if not np.array_equal(np.isnan(reference), np.isnan(reduced)):
+        return np.inf
+    return float(np.nanmax(np.abs(reference - reduced), initial=0))
+
+@instrument.traced("mds")
+def compute_mds(rsa_matrix, n_components=2, group_labels=None, method="smacof", warm_start=False, n_landmarks=None):
+    # MDS requires dissimilarity matrix. Methods:
+    #   "smacof"    - sklearn's iterative metric MDS (the reference embedding); warm_start=True starts it
+    #                 from the classical solution with a single init instead of several random ones
+    #   "classical" - Torgerson MDS from one truncated eigendecomposition, much faster on large matrices
+    #   "landmark"  - classical MDS on n_landmarks points, the rest triangulated; only reads landmark rows
+    # rsa_matrix may be a CondensedMatrix: classical and landmark MDS read its rows lazily, smacof needs the square form
+    values = rsa_matrix.values if hasattr(rsa_matrix, 'values') else np.asarray(rsa_matrix)
+    if method == "classical":
+        embedding = classical_mds(rsa_matrix if isinstance(rsa_matrix, CondensedMatrix) else values, n_components=n_components)
+    elif method == "landmark":
+        embedding = landmark_mds(values, n_components=n_components, n_landmarks=n_landmarks)
+    elif method == "smacof":
+        from sklearn.manifold import MDS
+        # Perform MDS
+        if warm_start:
+            mds = MDS(n_components=n_components, dissimilarity='precomputed', random_state=42, n_init=1)
+            embedding = mds.fit_transform(np.asarray(values), init=classical_mds(values, n_components=n_components))
+        else:
+            mds = MDS(n_components=n_components, dissimilarity='precomputed', random_state=42)
+            embedding = mds.fit_transform(np.asarray(values))
+    else:
+        raise ValueError(f"Unknown MDS method: {method}")
 
     # Create a DataFrame for the results
-    mds_result = pd.DataFrame(embedding, columns=['Dim1', 'Dim2'], index=rsa_matrix.index)
+    mds_result = pd.DataFrame(embedding, columns=[f'Dim{i + 1}' for i in range(n_components)], index=rsa_matrix.index)
 
     if group_labels is not None:
         mds_result['Group'] = group_labels
@@ -85,7 +434,12 @@ def compute_mds(rsa_matrix, n_components=2, group_labels=None):
     return mds_result
     
     # TODO: Implement this function -- When to clean the data?
+@instrument.traced("clean_correlation_matrix")
 def clean_correlation_matrix(df, major_division_labels):
+    if isinstance(df, CondensedMatrix):
+        nan_rows = df.all_nan()
+        return (df.dropna(), major_division_labels[~nan_rows])
+
     # get rows with all NaNs
     nan_rows = df.isna().all(axis=1)
 
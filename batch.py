@@ -0,0 +1,248 @@
+# Headless batch pipeline for cluster runs: RSA (and optionally MDS) for every dataset x ROI set x metric of a manifest.
+# Only the analysis modules are imported, never Qt or matplotlib, so worker processes start quickly on nodes
+# without a display. Every result is written to disk as soon as it is computed, into a directory that is renamed
+# into place once complete; rerunning the same manifest skips every result that already exists, so an
+# interrupted run resumes where it stopped.
+#
+#   python batch.py manifest.json [--jobs 4] [--force] [--trace trace.json]
+#
+# A manifest is a JSON file:
+#   {
+#     "output_dir": "results",                        (relative paths are relative to the manifest)
+#     "datasets": {"mouse1": "mouse1.npy", "mouse2": "mouse2.csv"},
+#     "roi_sets": {"full": [], "thalamus": ["12", "13", "40"]},
+#     "metrics": ["pearson", "spearman"],
+#     "filter_flag": true, "min_num_connections": 1,   (optional, as for build_corr_matrix)
+#     "nan_policy": "pairwise",                         (optional, as for build_corr_matrix)
+#     "mds": {"n_components": 2, "method": "classical"} (optional; omit to skip MDS)
+#   }
+# An empty ROI set is the full matrix (build_corr_matrix_full). Results land in
+# output_dir/<dataset>/<roi set>/<metric>/: rsa.npz for the full matrix, to.npz and from.npz for ROI sets,
+# plus mds_rsa.csv / mds_to.csv / mds_from.csv. RSA matrices are stored condensed (see condensed.py);
+# read them back with load_result.
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from analysis import build_corr_matrix, build_corr_matrix_full, compute_mds
+from condensed import CondensedMatrix
+from loaders import load_connection_matrix
+
+
+logger = logging.getLogger(__name__)
+
+# prefix of result directories still being written; left-overs of an interrupted run are removed
+PARTIAL_PREFIX = ".partial-"
+# manifest keys passed through to build_corr_matrix
+RSA_OPTIONS = ("filter_flag", "min_num_connections", "nan_policy")
+
+
+def load_manifest(path):
+    """
+    Reads and checks a batch manifest, resolving relative paths against the manifest's folder.
+
+    Args:
+        path (str): JSON manifest file.
+
+    Returns:
+        dict: The manifest, with absolute "output_dir" and dataset paths.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    missing = [key for key in ("output_dir", "datasets", "roi_sets", "metrics") if key not in manifest]
+    if missing:
+        raise ValueError(f"Manifest {path} is missing {missing}")
+    for kind in ("datasets", "roi_sets"):
+        bad = [name for name in manifest[kind] if not name or os.sep in name or name.startswith('.')]
+        if bad:
+            raise ValueError(f"Invalid {kind} names in {path}: {bad}")
+
+    base = os.path.dirname(os.path.abspath(path))
+    manifest['output_dir'] = os.path.join(base, manifest['output_dir'])
+    manifest['datasets'] = {name: os.path.join(base, file) for name, file in manifest['datasets'].items()}
+    return manifest
+
+
+def result_dir(manifest, dataset, roi_set, metric):
+    return os.path.join(manifest['output_dir'], dataset, roi_set, metric)
+
+
+def pending_tasks(manifest, force=False):
+    """
+    The (dataset, ROI set, metric) combinations whose results don't exist yet (all of them with force=True).
+    """
+    tasks = []
+    for dataset in manifest['datasets']:
+        for roi_set in manifest['roi_sets']:
+            for metric in manifest['metrics']:
+                if force or not os.path.isdir(result_dir(manifest, dataset, roi_set, metric)):
+                    tasks.append((dataset, roi_set, metric))
+    return tasks
+
+
+def run_batch(manifest, jobs=1, force=False):
+    """
+    Computes and writes every pending result of a manifest, one dataset at a time.
+
+    Args:
+        manifest (dict): As returned by load_manifest.
+        jobs (int): Worker processes for the RSA step (parallel.run_rsa_sweep); 1 runs in this process.
+        force (bool): Recompute results that already exist.
+
+    Returns:
+        tuple: (number of results written, list of (dataset, ROI set, metric, error) for failed ones).
+    """
+    tasks = pending_tasks(manifest, force)
+    skipped = len(manifest['datasets']) * len(manifest['roi_sets']) * len(manifest['metrics']) - len(tasks)
+    if skipped:
+        logger.info("Skipping %d finished results", skipped)
+
+    written, failed = 0, []
+    for dataset, path in manifest['datasets'].items():
+        dataset_tasks = [(roi_set, metric) for name, roi_set, metric in tasks if name == dataset]
+        if not dataset_tasks:
+            continue
+        logger.info("Loading %s (%s)", dataset, path)
+        try:
+            df = load_connection_matrix(path)
+        except Exception as e:
+            logger.error("Could not load %s: %s", path, e)
+            failed.extend((dataset, roi_set, metric, e) for roi_set, metric in dataset_tasks)
+            continue
+
+        results = _parallel_results(df, manifest, dataset_tasks, jobs) if jobs > 1 else _serial_results(df, manifest, dataset_tasks)
+        for roi_set, metric, matrices in results:
+            if isinstance(matrices, Exception):
+                logger.error("%s / %s / %s failed: %s", dataset, roi_set, metric, matrices)
+                failed.append((dataset, roi_set, metric, matrices))
+                continue
+            try:
+                with instrument.span("batch.write", dataset=dataset, roi_set=roi_set, metric=metric):
+                    _write_result(result_dir(manifest, dataset, roi_set, metric), matrices, manifest.get('mds'))
+            except Exception as e:
+                logger.error("%s / %s / %s failed: %s", dataset, roi_set, metric, e)
+                failed.append((dataset, roi_set, metric, e))
+                continue
+            written += 1
+            logger.info("Wrote %s / %s / %s", dataset, roi_set, metric)
+    return written, failed
+
+
+def load_result(directory):
+    """
+    Reads back one result directory written by run_batch.
+
+    Returns:
+        dict: "rsa" or "to"/"from" CondensedMatrix results, and "mds_*" DataFrames when MDS was run.
+    """
+    result = {}
+    for file in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(file)
+        path = os.path.join(directory, file)
+        if extension == '.npz':
+            with np.load(path, allow_pickle=False) as data:
+                result[name] = CondensedMatrix(data['condensed'], pd.Index(data['labels']), data['diagonal'])
+        elif extension == '.csv':
+            result[name] = pd.read_csv(path, index_col=0)
+    return result
+
+
+def _serial_results(df, manifest, dataset_tasks):
+    # yields (ROI set, metric, {name: matrix} or the exception) one task at a time, so one result is alive at once
+    options = {key: manifest[key] for key in RSA_OPTIONS if key in manifest}
+    for roi_set, metric in dataset_tasks:
+        ROI_list = manifest['roi_sets'][roi_set]
+        try:
+            if len(ROI_list) == 0:
+                matrices = {'rsa': build_corr_matrix_full(df, distance_metric=metric, condensed=True,
+                                                          nan_policy=options.get('nan_policy', "pairwise"))}
+            else:
+                to_matrix, from_matrix = build_corr_matrix(df, ROI_list, distance_metric=metric, condensed=True, **options)
+                matrices = {'to': to_matrix, 'from': from_matrix}
+        except Exception as e:
+            matrices = e
+        yield (roi_set, metric, matrices)
+
+
+def _parallel_results(df, manifest, dataset_tasks, jobs):
+    # one process pool per metric, fed the ROI sets still missing for it; results arrive in completion order
+    from parallel import run_rsa_sweep
+
+    options = {key: manifest[key] for key in RSA_OPTIONS if key in manifest}
+    for metric in dict.fromkeys(metric for _, metric in dataset_tasks):
+        roi_sets = [roi_set for roi_set, task_metric in dataset_tasks if task_metric == metric]
+        ROI_lists = [list(manifest['roi_sets'][roi_set]) for roi_set in roi_sets]
+        # run_rsa_sweep hands back the list objects it was given, which identifies the ROI set
+        names = {id(ROI_list): roi_set for ROI_list, roi_set in zip(ROI_lists, roi_sets)}
+        try:
+            for ROI_list, _, result in run_rsa_sweep(df, ROI_lists, metrics=(metric,), max_workers=jobs,
+                                                     return_exceptions=True, **options):
+                if isinstance(result, Exception):
+                    # only this ROI set failed (e.g. an unknown label); the pool carries on with the others
+                    matrices = result
+                elif len(ROI_list) == 0:
+                    matrices = {'rsa': CondensedMatrix.from_square(result[0])}
+                else:
+                    matrices = {'to': CondensedMatrix.from_square(result[0]), 'from': CondensedMatrix.from_square(result[1])}
+                yield (names[id(ROI_list)], metric, matrices)
+                names.pop(id(ROI_list))
+        except Exception as e:
+            # the pool itself broke (a worker died); everything it had not finished fails with the same error
+            for roi_set in names.values():
+                yield (roi_set, metric, e)
+
+
+def _write_result(directory, matrices, mds_options=None):
+    # everything goes into a scratch directory next to the final one, which is renamed into place at the end,
+    # so a result directory either is complete or does not exist
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    for entry in os.listdir(parent):
+        if entry.startswith(PARTIAL_PREFIX + os.path.basename(directory) + "-"):
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+    scratch = tempfile.mkdtemp(prefix=PARTIAL_PREFIX + os.path.basename(directory) + "-", dir=parent)
+    try:
+        for name, matrix in matrices.items():
+            np.savez(os.path.join(scratch, f"{name}.npz"), condensed=matrix.condensed, diagonal=matrix.diagonal,
+                     labels=np.asarray(matrix.index).astype(str))
+            if mds_options is not None and len(matrix) > mds_options.get('n_components', 2):
+                mds_result = compute_mds(matrix, **mds_options)
+                mds_result.to_csv(os.path.join(scratch, f"mds_{name}.csv"))
+        if os.path.isdir(directory):
+            # only with --force
+            shutil.rmtree(directory)
+        os.replace(scratch, directory)
+    except BaseException:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch RSA / MDS over a manifest of datasets, ROI sets and metrics.")
+    parser.add_argument("manifest", help="JSON manifest file")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes for the RSA step (default 1)")
+    parser.add_argument("--force", action="store_true", help="recompute results that already exist")
+    parser.add_argument("--trace", metavar="PATH", help="record per-stage timings (of this process) to a Chrome trace, "
+                                                        "or JSON lines if PATH ends in .jsonl")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.trace:
+        instrument.enable()
+    written, failed = run_batch(load_manifest(args.manifest), jobs=args.jobs, force=args.force)
+    logger.info("%d results written, %d failed", written, len(failed))
+    if args.trace:
+        instrument.export(args.trace)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# Benchmark suite for the analysis hot paths, on synthetic connectomes (see synthetic.py).
+# Every case is timed over a few repeats (wall time) and run once more under tracemalloc for its peak memory.
+# Results are appended to a JSON lines history, one record per case, keyed by the git commit they were measured
+# on, so that runs before and after a change or an upgrade can be compared:
+#
+#   python benchmarks/run.py                            # all cases at the default sizes
+#   python benchmarks/run.py --sizes 500 4000 --density 0.05 --weights counts
+#   python benchmarks/run.py --cases distance --repeat 5
+#   python benchmarks/run.py --startup                  # also record benchmarks/startup.py
+#   python benchmarks/run.py --compare HEAD~3           # compare with the last run recorded at another commit
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+
+from analysis import build_corr_matrix, clean_correlation_matrix, compute_distance_matrix, compute_mds
+from synthetic import WEIGHT_DISTRIBUTIONS, division_labels, synthetic_connectome
+
+
+DEFAULT_HISTORY = os.path.join(BENCHMARK_DIR, "history.jsonl")
+DEFAULT_SIZES = (500, 2000)
+METRICS = ("pearson", "spearman", "cosine", "braycurtis")
+# SMACOF is quadratic per iteration with many iterations; above this size only the fast methods are timed
+SMACOF_MAX_REGIONS = 1000
+# fraction of the regions used as the ROI set of build_corr_matrix
+ROI_FRACTION = 0.05
+
+
+def benchmark_cases(df, labels):
+    """
+    The benchmark cases for one synthetic matrix, as (group, name, function) triples. Inputs that are not
+    part of what is measured (the RSA matrix MDS starts from, the ROI list) are prepared here.
+    """
+    n = len(df)
+    ROI_list = list(df.columns[:max(1, int(n * ROI_FRACTION))])
+    rsa_matrix = compute_distance_matrix(df)
+    # MDS needs a complete matrix: regions without any connection have undefined correlations
+    clean_matrix, _ = clean_correlation_matrix(rsa_matrix, labels)
+
+    cases = []
+    for metric in METRICS:
+        cases.append(("distance", f"compute_distance_matrix[{metric}]", lambda metric=metric: compute_distance_matrix(df, metric=metric)))
+        cases.append(("distance", f"compute_distance_matrix[{metric}, condensed]",
+                      lambda metric=metric: compute_distance_matrix(df, metric=metric, condensed=True)))
+    cases.append(("roi", "build_corr_matrix[no filter]", lambda: build_corr_matrix(df, ROI_list, distance_metric="pearson")))
+    cases.append(("roi", "build_corr_matrix[filter]",
+                  lambda: build_corr_matrix(df, ROI_list, filter_flag=True, min_num_connections=1, distance_metric="pearson")))
+    cases.append(("roi", "build_corr_matrix[filter, fused]",
+                  lambda: build_corr_matrix(df, ROI_list, filter_flag=True, min_num_connections=1, distance_metric="pearson", fused=True)))
+    cases.append(("mds", "compute_mds[classical]", lambda: compute_mds(clean_matrix, method="classical")))
+    cases.append(("mds", "compute_mds[landmark]", lambda: compute_mds(clean_matrix, method="landmark")))
+    if n <= SMACOF_MAX_REGIONS:
+        cases.append(("mds", "compute_mds[smacof]", lambda: compute_mds(clean_matrix, method="smacof")))
+    cases.append(("clean", "clean_correlation_matrix", lambda: clean_correlation_matrix(rsa_matrix, labels)))
+    return cases
+
+
+def time_case(function, repeat=3):
+    """
+    Wall times of `repeat` calls after an untimed warm-up call (which also pays for lazy imports), then the
+    peak memory of one more call traced by tracemalloc (numpy reports its buffers to tracemalloc, so large
+    arrays are included).
+
+    Returns:
+        dict: median_s, min_s, runs_s and peak_mb.
+    """
+    function()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"median_s": statistics.median(times), "min_s": min(times), "runs_s": times, "peak_mb": peak / 1024 ** 2}
+
+
+def git_commit():
+    # (commit hash, whether the working tree has uncommitted changes); (None, None) outside a git checkout
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+            "processor": platform.processor(), "cpus": os.cpu_count(), "host": platform.node()}
+
+
+def run_suite(sizes=DEFAULT_SIZES, density=0.1, weights="lognormal", repeat=3, groups=None, seed=0, report=print):
+    """
+    Runs every case on a synthetic matrix of each size.
+
+    Args:
+        sizes (iterable of int): Numbers of regions.
+        density (float), weights (str), seed (int): Passed to synthetic_connectome.
+        repeat (int): Timed calls per case.
+        groups (iterable of str): Only run these case groups ("distance", "roi", "mds", "clean").
+        report (callable): Called with a one-line summary after each case.
+
+    Returns:
+        list of dict: One record per case and size.
+    """
+    records = []
+    for n_regions in sizes:
+        df = synthetic_connectome(n_regions, density=density, weights=weights, seed=seed)
+        labels = division_labels(n_regions, seed=seed)
+        for group, name, function in benchmark_cases(df, labels):
+            if groups and group not in groups:
+                continue
+            result = time_case(function, repeat)
+            records.append({"case": name, "group": group, "n_regions": n_regions, "density": density,
+                            "weights": weights, "seed": seed, **result})
+            report(f"{name:<50} n={n_regions:<6} median {result['median_s'] * 1000:10.1f} ms   "
+                   f"peak {result['peak_mb']:9.1f} MB")
+    return records
+
+
+def startup_records(repeat=3, report=print):
+    # benchmarks/startup.py results in the same record format (peak memory is not measured there)
+    from startup import measure_startup
+
+    records = []
+    for name, result in measure_startup(repeat).items():
+        records.append({"case": f"startup[{name}]", "group": "startup", "median_s": result["median"],
+                        "min_s": result["min"], "runs_s": result["runs"], "peak_mb": None})
+        report(f"{'startup[' + name + ']':<50} {'':<8} median {result['median'] * 1000:10.1f} ms")
+    return records
+
+
+def append_history(records, path=DEFAULT_HISTORY):
+    # one JSON object per line; every record carries the commit and environment it was measured in
+    commit, dirty = git_commit()
+    stamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    env = environment()
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps({"commit": commit, "dirty": dirty, "timestamp": stamp, **env, **record}) + "\n")
+
+
+def read_history(path=DEFAULT_HISTORY):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(records, history, revision):
+    """
+    Prints the ratio of each case's median time to the latest one recorded at another commit.
+
+    Args:
+        records (list of dict): The current results.
+        history (list of dict): Records from read_history.
+        revision (str): A git revision (hash, tag, HEAD~1, ...).
+    """
+    commit = subprocess.run(["git", "rev-parse", revision], cwd=REPO_DIR, capture_output=True, text=True,
+                            check=True).stdout.strip()
+    baseline = {}
+    for record in history:
+        if record.get("commit") == commit:
+            # later lines win: the most recent run at that commit
+            baseline[_case_key(record)] = record
+    if not baseline:
+        print(f"No benchmark history for {revision} ({commit[:10]}).")
+        return
+    print(f"\nCompared with {revision} ({commit[:10]}):")
+    for record in records:
+        old = baseline.get(_case_key(record))
+        if old is None:
+            continue
+        ratio = record["median_s"] / old["median_s"] if old["median_s"] else float("nan")
+        memory = ""
+        if record.get("peak_mb") and old.get("peak_mb"):
+            memory = f"   peak {record['peak_mb'] / old['peak_mb']:6.2f}x"
+        print(f"{record['case']:<50} n={str(record.get('n_regions', '')):<6} time {ratio:6.2f}x{memory}")
+
+
+def _case_key(record):
+    return (record["case"], record.get("n_regions"), record.get("density"), record.get("weights"), record.get("seed"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the analysis hot paths on synthetic connectomes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="numbers of regions")
+    parser.add_argument("--density", type=float, default=0.1, help="fraction of nonzero connections")
+    parser.add_argument("--weights", choices=WEIGHT_DISTRIBUTIONS, default="lognormal", help="weight distribution")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="timed calls per case")
+    parser.add_argument("--cases", nargs="+", choices=("distance", "roi", "mds", "clean"), help="only these case groups")
+    parser.add_argument("--startup", action="store_true", help="also measure start-up times (benchmarks/startup.py)")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON lines file results are appended to")
+    parser.add_argument("--no-save", action="store_true", help="don't append the results to the history")
+    parser.add_argument("--compare", metavar="REVISION", help="compare with the last run recorded at this git revision")
+    args = parser.parse_args(argv)
+
+    records = run_suite(args.sizes, args.density, args.weights, args.repeat, args.cases, args.seed)
+    if args.startup:
+        records += startup_records(args.repeat)
+    history = read_history(args.history)
+    if not args.no_save:
+        append_history(records, args.history)
+    if args.compare:
+        compare(records, history, args.compare)
+
+
+if __name__ == "__main__":
+    main()
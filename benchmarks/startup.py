@@ -0,0 +1,84 @@
+# Startup benchmark: how long a fresh process takes to import the analysis modules, and how long until the
+# GUI's main window is on screen. Every measurement runs in a new interpreter, so nothing is cached in
+# sys.modules (the OS file cache is warm after the first repeat, as it is on a workstation or a cluster node).
+#
+#   python benchmarks/startup.py [--repeat 5] [--json]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# each snippet prints the seconds it took, measured inside the new process
+SNIPPETS = {
+    "import analysis": "import time; t = time.perf_counter(); import analysis; print(time.perf_counter() - t)",
+    "import batch": "import time; t = time.perf_counter(); import batch; print(time.perf_counter() - t)",
+    "import gui": "import time; t = time.perf_counter(); import gui; print(time.perf_counter() - t)",
+    # from the first line of the process until DataAnalysisApp has been shown and painted once
+    "gui shown": (
+        "import time; t = time.perf_counter()\n"
+        "import sys\n"
+        "from qtpy.QtWidgets import QApplication\n"
+        "app = QApplication(sys.argv)\n"
+        "from gui import DataAnalysisApp\n"
+        "window = DataAnalysisApp()\n"
+        "window.show()\n"
+        "app.processEvents()\n"
+        "print(time.perf_counter() - t)\n"
+    ),
+}
+
+
+def measure(snippet, repeat=5):
+    """
+    Runs a snippet in `repeat` fresh interpreters from the repository folder.
+
+    Returns:
+        list of float: The seconds each run reported.
+    """
+    env = dict(os.environ)
+    # the GUI measurements also work on machines without a display
+    if not env.get("DISPLAY") and not env.get("WAYLAND_DISPLAY"):
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", snippet], cwd=REPO_DIR, env=env, check=True,
+                                capture_output=True, text=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return times
+
+
+def measure_startup(repeat=5, names=None):
+    """
+    Startup times of every snippet in SNIPPETS (or only those in names).
+
+    Returns:
+        dict: name -> {"median": seconds, "min": seconds, "runs": [seconds, ...]}.
+    """
+    results = {}
+    for name in names or SNIPPETS:
+        times = measure(SNIPPETS[name], repeat)
+        results[name] = {"median": statistics.median(times), "min": min(times), "runs": times}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start import and GUI start-up times.")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = measure_startup(args.repeat)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for name, result in results.items():
+            print(f"{name:<20} median {result['median'] * 1000:8.1f} ms   min {result['min'] * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Synthetic connection matrices for benchmarks.
+# Connectomes are sparse, with heavy-tailed weights and some modular structure: regions belong to a handful of
+# modules and connect more densely within their module than between modules. Size, overall density and the
+# weight distribution are controllable, and the same seed always gives the same matrix.
+import numpy as np
+import pandas as pd
+
+from loaders import numbered_labels
+
+
+WEIGHT_DISTRIBUTIONS = ("lognormal", "uniform", "counts")
+
+
+def synthetic_connectome(n_regions, density=0.1, weights="lognormal", n_modules=8, within_module_ratio=4.0,
+                         self_connections=False, seed=0):
+    """
+    A random square connection matrix labelled "1".."n" like the ones load_connection_matrix returns.
+
+    Args:
+        n_regions (int): Number of regions.
+        density (float): Expected fraction of nonzero connections.
+        weights (str): Distribution of the nonzero weights: "lognormal" (projection strengths), "uniform"
+            or "counts" (whole numbers, e.g. synapse counts; geometric distribution).
+        n_modules (int): Number of modules regions are assigned to.
+        within_module_ratio (float): How much more likely a connection is within a module than between modules.
+        self_connections (bool): Allow nonzero diagonal entries.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        pandas.DataFrame: n_regions x n_regions float64 matrix.
+    """
+    if weights not in WEIGHT_DISTRIBUTIONS:
+        raise ValueError(f"weights must be one of {WEIGHT_DISTRIBUTIONS}, got {weights!r}")
+    rng = np.random.default_rng(seed)
+    modules = rng.integers(n_modules, size=n_regions)
+
+    # connection probabilities scaled so that the expected density comes out as requested
+    same_module = modules[:, None] == modules[None, :]
+    within_fraction = same_module.mean()
+    base = density / (within_fraction * within_module_ratio + (1 - within_fraction))
+    probability = np.where(same_module, min(base * within_module_ratio, 1.0), min(base, 1.0))
+    connected = rng.random((n_regions, n_regions)) < probability
+    if not self_connections:
+        np.fill_diagonal(connected, False)
+
+    n_connections = np.count_nonzero(connected)
+    if weights == "lognormal":
+        values = rng.lognormal(mean=0.0, sigma=1.5, size=n_connections)
+    elif weights == "uniform":
+        values = rng.uniform(0.0, 1.0, size=n_connections)
+    else:
+        values = rng.geometric(0.2, size=n_connections).astype(np.float64)
+
+    matrix = np.zeros((n_regions, n_regions))
+    matrix[connected] = values
+    labels = numbered_labels(n_regions)
+    return pd.DataFrame(matrix, index=labels, columns=labels, copy=False)
+
+
+def division_labels(n_regions, n_divisions=8, seed=0):
+    """
+    Random major-division labels for clean_correlation_matrix and grouped MDS, as a pandas Series over "1".."n".
+    """
+    rng = np.random.default_rng(seed)
+    return pd.Series(rng.integers(n_divisions, size=n_regions).astype(str), index=numbered_labels(n_regions))
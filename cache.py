@@ -0,0 +1,311 @@
+# Content-addressed cache for RSA and MDS results.
+# Results are keyed on a hash of the input matrix (values and labels) plus every parameter of the call,
+# and kept in two tiers: an in-memory LRU for the current session and a directory of .npz files that
+# survives sessions and can be shared by several people (point CONNECTOME_CACHE_DIR at a shared folder).
+# Both tiers evict least recently used entries once they grow past their size limit.
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import instrument
+from analysis import build_corr_matrix, build_corr_matrix_full, compute_mds
+from condensed import CondensedMatrix
+from loaders import DEFAULT_CACHE_DIR, as_connection_matrix
+
+
+# hashed into every key; bump it whenever a kernel change alters results, so older cache entries are never served
+CACHE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    Two-tier (memory + disk) cache of tuples of DataFrames (or CondensedMatrix results), addressed by content hash.
+
+    Args:
+        directory (str): Folder for the on-disk tier; defaults to $CONNECTOME_CACHE_DIR or
+            ~/.cache/connectome-toolbox. Pass False to keep the cache in memory only.
+        memory_bytes (int): Size limit of the in-memory tier.
+        disk_bytes (int): Size limit of the on-disk tier.
+    """
+
+    def __init__(self, directory=None, memory_bytes=512 * 1024 ** 2, disk_bytes=4 * 1024 ** 3):
+        if directory is None:
+            directory = os.environ.get("CONNECTOME_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.directory = directory or None
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # the GUI computes on several worker threads at once
+        self._lock = threading.RLock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key):
+        # returns the cached tuple of DataFrames, or None on a miss
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                instrument.count("cache.memory_hits")
+                return self._memory[key]
+
+        path = self._path(key)
+        if path is None or not os.path.exists(path):
+            instrument.count("cache.misses")
+            return None
+        try:
+            with instrument.span("cache.read"):
+                frames = _read_frames(path)
+            os.utime(path)  # mark as recently used for the disk eviction
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # a partially written, evicted or foreign file is treated as a miss, and removed so the next put
+            # replaces it
+            instrument.count("cache.misses")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        instrument.count("cache.disk_hits")
+        self._remember(key, frames)
+        return frames
+
+    def put(self, key, frames):
+        self._remember(key, frames)
+        path = self._path(key)
+        if path is None:
+            return
+        # write to a temporary file first so readers never see a half-written entry
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                _write_frames(f, frames)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except OSError as e:
+            # a full disk or an unwritable shared folder only costs the disk tier; the result is still returned
+            logger.warning("Could not write cache entry %s: %s", path, e)
+            instrument.count("cache.write_errors")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        for path in self._disk_entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz') if self.directory else None
+
+    def _remember(self, key, frames):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = frames
+            self._memory_size += _nbytes(frames)
+            while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= _nbytes(evicted)
+
+    def _disk_entries(self):
+        if not self.directory:
+            return []
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npz')]
+
+    def _evict_disk(self):
+        entries = []
+        for path in self._disk_entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # removed by another process sharing the directory
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_default_cache = None
+
+
+_default_cache_lock = threading.Lock()
+
+
+def default_cache():
+    # process-wide cache shared by the cached_* functions when no cache is passed
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache()
+    return _default_cache
+
+
+def cache_key(name, data, **params):
+    """
+    Content hash of an analysis call: CACHE_VERSION, the function name, the input matrix and its labels, and all
+    parameters.
+
+    Args:
+        name (str): Name of the cached function.
+        data (pandas.DataFrame, numpy.ndarray, scipy.sparse matrix or TiledDistanceMatrix): Input matrix.
+        **params: Every other argument that affects the result.
+
+    Returns:
+        str: Hex digest usable as a file name.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{CACHE_VERSION}:{name}".encode())
+    if sp.issparse(data):
+        data = sp.csr_matrix(data)
+        for array in (data.data, data.indices, data.indptr):
+            _hash_array(h, array)
+        h.update(repr(data.shape).encode())
+    elif isinstance(data, CondensedMatrix):
+        # hashed in its stored form; data.values would build the square matrix
+        for array in (data.condensed, data.diagonal, np.asarray(data.index).astype(str)):
+            _hash_array(h, array)
+    else:
+        _hash_array(h, np.asarray(data.values if hasattr(data, 'values') else data))
+        for labels in (getattr(data, 'index', None), getattr(data, 'columns', None)):
+            if labels is not None:
+                _hash_array(h, np.asarray(labels).astype(str))
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+def cached_build_corr_matrix(df, ROI_list, filter_flag=False, min_num_connections=1, distance_metric='pearson', cache=None, **kwargs):
+    """
+    build_corr_matrix with results served from the cache when the same matrix, ROI set and options were seen before.
+
+    Args:
+        cache (ResultCache): Cache to use; defaults to default_cache().
+        Other arguments are passed through to build_corr_matrix.
+    """
+    cache = cache or default_cache()
+    df = as_connection_matrix(df)  # a file is keyed on its contents, not its path
+    key = cache_key('build_corr_matrix', df, ROI_list=sorted(map(str, ROI_list)), filter_flag=filter_flag,
+                    min_num_connections=min_num_connections, distance_metric=distance_metric, **_normalize(kwargs))
+    result = cache.get(key)
+    if result is None:
+        result = build_corr_matrix(df, ROI_list, filter_flag=filter_flag, min_num_connections=min_num_connections,
+                                   distance_metric=distance_metric, **kwargs)
+        cache.put(key, result)
+    return result
+
+
+def cached_build_corr_matrix_full(df, distance_metric='pearson', cache=None, **kwargs):
+    """
+    build_corr_matrix_full with results served from the cache. Out-of-core (memory_budget) results are
+    already on disk and are not cached again.
+    """
+    if kwargs.get('memory_budget') is not None:
+        return build_corr_matrix_full(df, distance_metric=distance_metric, **kwargs)
+    cache = cache or default_cache()
+    df = as_connection_matrix(df)
+    key = cache_key('build_corr_matrix_full', df, distance_metric=distance_metric, **_normalize(kwargs))
+    result = cache.get(key)
+    if result is None:
+        result = (build_corr_matrix_full(df, distance_metric=distance_metric, **kwargs),)
+        cache.put(key, result)
+    return result[0]
+
+
+def cached_compute_mds(rsa_matrix, n_components=2, group_labels=None, cache=None, **kwargs):
+    """
+    compute_mds with the embedding served from the cache. Group labels only decorate the result,
+    so they are not part of the key.
+    """
+    cache = cache or default_cache()
+    key = cache_key('compute_mds', rsa_matrix, n_components=n_components, **_normalize(kwargs))
+    result = cache.get(key)
+    if result is None:
+        result = (compute_mds(rsa_matrix, n_components=n_components, **kwargs),)
+        cache.put(key, result)
+    mds_result = result[0]
+    if group_labels is not None:
+        mds_result = mds_result.copy()
+        mds_result['Group'] = group_labels
+    return mds_result
+
+
+def _normalize(params):
+    # dtypes and label arrays get stable, comparable representations for the key
+    normalized = {}
+    for name, value in params.items():
+        if name == 'dtype':
+            value = np.dtype(value).str
+        elif name == 'labels' and value is not None:
+            value = list(map(str, value))
+        normalized[name] = value
+    return normalized
+
+
+def _hash_array(h, array):
+    array = np.asarray(array)
+    h.update(array.dtype.str.encode())
+    h.update(repr(array.shape).encode())
+    if not array.flags.c_contiguous and array.flags.f_contiguous:
+        # DataFrame.values is usually Fortran-ordered: hash the bytes of its (C-ordered) transpose instead of
+        # copying the whole matrix; the marker keeps it apart from a C-ordered array with those same bytes
+        h.update(b'F')
+        array = array.T
+    array = np.ascontiguousarray(array)
+    if array.dtype == object:
+        array = array.astype(str)
+    h.update(memoryview(array).cast('B'))
+
+
+def _nbytes(frames):
+    return sum(frame.nbytes if isinstance(frame, CondensedMatrix) else frame.memory_usage(index=True, deep=False).sum()
+               for frame in frames)
+
+
+def _labels_to_array(labels):
+    array = np.asarray(labels)
+    return array.astype(str) if array.dtype == object else array
+
+
+def _write_frames(f, frames):
+    arrays = {}
+    for i, frame in enumerate(frames):
+        arrays[f'index_{i}'] = _labels_to_array(frame.index)
+        if isinstance(frame, CondensedMatrix):
+            # stored condensed, like in memory
+            arrays[f'condensed_{i}'] = frame.condensed
+            arrays[f'diagonal_{i}'] = frame.diagonal
+            continue
+        arrays[f'values_{i}'] = frame.to_numpy()
+        arrays[f'columns_{i}'] = _labels_to_array(frame.columns)
+    np.savez(f, **arrays)
+
+
+def _read_frames(path):
+    with np.load(path, allow_pickle=False) as data:
+        count = sum(1 for name in data.files if name.startswith('index_'))
+        return tuple(CondensedMatrix(data[f'condensed_{i}'], pd.Index(data[f'index_{i}']), data[f'diagonal_{i}'])
+                     if f'condensed_{i}' in data.files else
+                     pd.DataFrame(data[f'values_{i}'], index=pd.Index(data[f'index_{i}']), columns=pd.Index(data[f'columns_{i}']))
+                     for i in range(count))
@@ -0,0 +1,225 @@
+# Compact storage for symmetric distance matrices.
+# A CondensedMatrix keeps the upper triangle once, as a condensed vector (scipy's squareform order), plus the
+# diagonal and the region labels: half the memory of a square DataFrame. Square views are computed lazily,
+# block by block, so plotting, MDS and the table view can read it without ever building the n x n form.
+import numpy as np
+import pandas as pd
+
+from kernels import similarity_to_distance, standardize_columns
+
+
+# bytes of square similarity block computed at a time by condensed_distances
+CONDENSED_BLOCK_BYTES = 16 * 1024 ** 2
+
+
+class CondensedMatrix:
+    """
+    Symmetric matrix stored as its condensed upper triangle, diagonal and labels.
+
+    Quacks enough like the DataFrames returned by compute_distance_matrix (index, columns, shape, values,
+    numpy conversion) for compute_mds, clean_correlation_matrix and the plotting code to use it directly.
+
+    Args:
+        condensed (numpy.ndarray): The n * (n - 1) / 2 values above the diagonal, row by row.
+        labels (list-like): The n region labels.
+        diagonal (numpy.ndarray): The n diagonal values; zeros when omitted.
+    """
+
+    def __init__(self, condensed, labels, diagonal=None):
+        self.condensed = np.asarray(condensed)
+        self.index = pd.Index(labels)
+        self.columns = self.index
+        n = len(self.index)
+        if len(self.condensed) != n * (n - 1) // 2:
+            raise ValueError(f"A condensed vector of length {len(self.condensed)} does not match {n} labels.")
+        self.diagonal = np.zeros(n, dtype=self.condensed.dtype) if diagonal is None else np.asarray(diagonal, dtype=self.condensed.dtype)
+
+    @classmethod
+    def from_square(cls, matrix, labels=None):
+        """
+        Condenses a square symmetric matrix (DataFrame or array); labels default to the DataFrame's index.
+        """
+        from scipy.spatial.distance import squareform
+        values = matrix.to_numpy() if isinstance(matrix, pd.DataFrame) else np.asarray(matrix)
+        if labels is None:
+            labels = matrix.index if isinstance(matrix, pd.DataFrame) else pd.RangeIndex(values.shape[0])
+        return cls(squareform(values, force='tovector', checks=False), labels, np.diag(values).copy())
+
+    @property
+    def values(self):
+        # lazy square view; index it like an array, or np.asarray() it to materialize
+        return SquareView(self)
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.index))
+
+    @property
+    def dtype(self):
+        return self.condensed.dtype
+
+    @property
+    def nbytes(self):
+        return self.condensed.nbytes + self.diagonal.nbytes
+
+    def __len__(self):
+        return len(self.index)
+
+    def __array__(self, dtype=None, copy=None):
+        from scipy.spatial.distance import squareform
+        square = squareform(self.condensed, force='tomatrix', checks=False)
+        np.fill_diagonal(square, self.diagonal)
+        return square if dtype is None else square.astype(dtype, copy=False)
+
+    def to_frame(self):
+        # materializes the whole square matrix
+        return pd.DataFrame(np.asarray(self), index=self.index, columns=self.columns)
+
+    def all_nan(self):
+        """
+        Boolean mask of the regions whose row is entirely NaN (diagonal included), i.e. what dropna(how='all')
+        would remove from the square form.
+        """
+        n = len(self)
+        nan_positions = np.flatnonzero(np.isnan(self.condensed))
+        rows, cols = _pair_of(nan_positions, n)
+        nan_counts = np.bincount(rows, minlength=n) + np.bincount(cols, minlength=n)
+        return (nan_counts == n - 1) & np.isnan(self.diagonal)
+
+    def dropna(self):
+        # counterpart of df.dropna(axis=0, how='all').dropna(axis=1, how='all') on the square form
+        keep = ~self.all_nan()
+        return self if keep.all() else self.subset(keep)
+
+    def subset(self, keep):
+        """
+        The matrix restricted to some regions, gathered row by row straight from the condensed vector.
+
+        Args:
+            keep (array-like): Boolean mask, integer positions or labels of the regions to keep, in order.
+
+        Returns:
+            CondensedMatrix: The smaller matrix.
+        """
+        keep = np.asarray(keep)
+        if keep.dtype == bool:
+            positions = np.flatnonzero(keep)
+        elif keep.dtype.kind in 'iu':
+            positions = keep
+        else:
+            positions = self.index.get_indexer(keep)
+            if (positions < 0).any():
+                raise KeyError(f"{list(keep[positions < 0])} not found in axis")
+        n, n_kept = len(self), len(positions)
+        out = np.empty(n_kept * (n_kept - 1) // 2, dtype=self.dtype)
+        start = 0
+        for a in range(n_kept - 1):
+            others = positions[a + 1:]
+            low, high = np.minimum(positions[a], others), np.maximum(positions[a], others)
+            out[start:start + len(others)] = self.condensed[_condensed_position(low, high, n)]
+            start += len(others)
+        return CondensedMatrix(out, self.index[positions], self.diagonal[positions])
+
+    def block(self, rows, cols):
+        """
+        Dense block of the square form.
+
+        Args:
+            rows, cols (array-like): Integer positions.
+
+        Returns:
+            numpy.ndarray: len(rows) x len(cols) block.
+        """
+        rows = np.asarray(rows)[:, None]
+        cols = np.asarray(cols)[None, :]
+        low, high = np.minimum(rows, cols), np.maximum(rows, cols)
+        on_diagonal = low == high
+        positions = _condensed_position(low, np.where(on_diagonal, low + 1, high), len(self))
+        # diagonal cells point at a valid dummy position and are overwritten below
+        block = self.condensed[np.minimum(positions, max(len(self.condensed) - 1, 0))] if len(self.condensed) else np.zeros(positions.shape, dtype=self.dtype)
+        return np.where(on_diagonal, self.diagonal[np.broadcast_to(rows, block.shape)], block)
+
+
+class SquareView:
+    """
+    Lazy square view of a CondensedMatrix. Supports integer, slice and array indexing of rows, and of rows and
+    columns together, computing only the requested cells.
+    """
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.shape = matrix.shape
+        self.dtype = matrix.dtype
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.matrix.__array__(dtype)
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        n = self.shape[0]
+        row_positions = np.arange(n)[rows]
+        col_positions = np.arange(n)[cols]
+        block = self.matrix.block(np.atleast_1d(row_positions), np.atleast_1d(col_positions))
+        if np.ndim(row_positions) == 0:
+            block = block[0]
+            return block[0] if np.ndim(col_positions) == 0 else block
+        return block[:, 0] if np.ndim(col_positions) == 0 else block
+
+
+def condensed_distances(X, metric="pearson", dtype=np.float64, block_bytes=CONDENSED_BLOCK_BYTES):
+    """
+    Column-by-column distances of a complete dense matrix, written block by block straight into condensed form,
+    so the square result never exists. Same values as analysis.compute_distance_matrix.
+
+    Args:
+        X (numpy.ndarray): m x n matrix without NaN.
+        metric (str): "pearson", "spearman", "cosine" or "braycurtis".
+        dtype: Floating point type of the computation and of the result.
+        block_bytes (int): Size of the similarity block computed at a time.
+
+    Returns:
+        tuple: (condensed vector, diagonal).
+    """
+    dtype = np.dtype(dtype)
+    n = X.shape[1]
+    diagonal = np.zeros(n, dtype=dtype)
+    if metric == "braycurtis":
+        # scipy computes bray-curtis (in float64) straight into condensed form
+        from scipy.spatial.distance import pdist
+        return pdist(np.asarray(X, dtype=np.float64).T, metric='braycurtis').astype(dtype, copy=False), diagonal
+
+    # standardize every column once; each block is then one GEMM
+    Z = standardize_columns(np.asarray(X), metric, dtype=dtype)
+    if metric != "cosine":
+        # profiles without variance have no defined correlation, not even with themselves
+        diagonal[np.isnan(Z).any(axis=0)] = np.nan
+
+    out = np.empty(n * (n - 1) // 2, dtype=dtype)
+    block = max(1, int(block_bytes // (dtype.itemsize * max(n, 1))))
+    start = 0
+    for first in range(0, n, block):
+        rows = slice(first, min(first + block, n))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tile = similarity_to_distance(Z[:, rows].T @ Z[:, rows.start:], metric)
+        # the cells right of the diagonal, row by row, are exactly the next stretch of the condensed vector
+        for r in range(tile.shape[0]):
+            out[start:start + tile.shape[1] - r - 1] = tile[r, r + 1:]
+            start += tile.shape[1] - r - 1
+    return out, diagonal
+
+
+def _condensed_position(i, j, n):
+    # position of the pair (i, j), i < j, in the condensed vector of an n x n matrix
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def _pair_of(positions, n):
+    # inverse of _condensed_position
+    row_starts = _condensed_position(np.arange(n), np.arange(n) + 1, n)
+    rows = np.searchsorted(row_starts, positions, side='right') - 1
+    cols = positions - row_starts[rows] + rows + 1
+    return rows, cols
@@ -0,0 +1,181 @@
+# Major-division level summaries of RSA matrices.
+# Regions are mapped to integer division codes once (pd.factorize); a sparse region x division indicator matrix
+# then turns every block statistic into sparse products: block sums and pair counts are I.T @ D @ I and
+# I.T @ M @ I for the RSA matrix D and its mask of defined cells. Block medians come from sorting all cells by
+# (block, value). No loop runs over divisions or regions, so atlases with thousands of regions are summarized in
+# milliseconds to a few seconds. The same indicator aggregates connection profiles for division-level RSA.
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import instrument
+from analysis import compute_distance_matrix
+
+
+DivisionSummary = namedtuple('DivisionSummary', ['mean', 'median', 'count', 'contrast'])
+
+
+def region_divisions(regions, division_labels, all_regions=None):
+    """
+    The division of each region, as a Series indexed by region; also what compute_mds(group_labels=...) takes.
+
+    Args:
+        regions (list-like): Region labels to look up, e.g. the index of an RSA matrix.
+        division_labels (pandas.Series or list-like): Division per region: a Series indexed by region label,
+            or a sequence aligned with all_regions (the order of the loaded connection matrix, as the GUI's
+            load_div_labels reads them), or aligned with regions themselves.
+        all_regions (list-like): Labels division_labels is aligned with, when it is not a Series.
+
+    Returns:
+        pandas.Series: Division of every region in regions; NaN for regions without one.
+    """
+    regions = pd.Index(regions)
+    if not isinstance(division_labels, pd.Series):
+        division_labels = np.asarray(division_labels)
+        if all_regions is not None:
+            if len(division_labels) != len(all_regions):
+                raise ValueError(f"Got {len(division_labels)} division labels for {len(all_regions)} regions")
+            division_labels = pd.Series(division_labels, index=pd.Index(all_regions))
+        elif len(division_labels) == len(regions):
+            return pd.Series(division_labels, index=regions)
+        else:
+            raise ValueError(f"Got {len(division_labels)} division labels for {len(regions)} regions; "
+                             f"pass the labels they are aligned with as all_regions")
+    return division_labels.reindex(regions)
+
+
+def indicator_matrix(divisions):
+    """
+    Sparse region x division membership matrix.
+
+    Args:
+        divisions (pandas.Series or list-like): Division per region; NaN leaves a region out.
+
+    Returns:
+        tuple: (CSR matrix of 0/1 with one column per division, pandas.Index of the divisions in column order).
+    """
+    codes, names = _division_codes(divisions)
+    return _indicator(codes, len(names)), names
+
+
+@instrument.traced("division_summary")
+def division_summary(rsa_matrix, division_labels, all_regions=None, median=True):
+    """
+    Summarizes an RSA matrix block by block over major divisions.
+
+    Each division x division cell holds the statistic of all defined distances between a region of one division
+    and a region of the other; a region's distance to itself is left out, so within-division blocks only
+    compare different regions.
+
+    Args:
+        rsa_matrix (pandas.DataFrame, CondensedMatrix or TiledDistanceMatrix): Square RSA matrix.
+        division_labels, all_regions: As for region_divisions.
+        median (bool): Also compute block medians (sorts every cell once).
+
+    Returns:
+        DivisionSummary: mean, median (None with median=False) and count (number of region pairs) as
+        division x division DataFrames, and contrast, a DataFrame per division of its mean within-division and
+        between-division distance, their difference (between - within; positive when the division's regions
+        connect more alike than to other divisions) and its number of regions.
+    """
+    codes, names = _division_codes(region_divisions(rsa_matrix.index, division_labels, all_regions))
+    indicator = _indicator(codes, len(names))
+    # the dense square form: the summary reads every cell once
+    values = np.asarray(rsa_matrix.to_frame() if hasattr(rsa_matrix, 'to_frame') else rsa_matrix, dtype=np.float64)
+    defined = ~np.isnan(values)
+    np.fill_diagonal(defined, False)
+
+    # block sums and pair counts as sparse products (sparse.T @ dense gives a dense array)
+    filled = np.where(defined, values, 0.0)
+    sums = np.asarray(indicator.T @ filled @ indicator)
+    counts = np.asarray(indicator.T @ defined.astype(np.float64) @ indicator)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+
+    medians = _block_medians(values, defined, codes, len(names)) if median else None
+
+    # within: the diagonal blocks; between: everything else on the division's rows
+    within_sums, within_counts = np.diag(sums), np.diag(counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        within = within_sums / within_counts
+        between = (sums.sum(axis=1) - within_sums) / (counts.sum(axis=1) - within_counts)
+    region_counts = np.asarray(indicator.sum(axis=0)).ravel().astype(np.int64)
+    contrast = pd.DataFrame({'within': within, 'between': between, 'contrast': between - within,
+                             'n_regions': region_counts}, index=names)
+
+    def frame(array):
+        return None if array is None else pd.DataFrame(array, index=names, columns=names)
+
+    return DivisionSummary(frame(means), frame(medians), frame(counts.astype(np.int64)), contrast)
+
+
+def division_rsa(df, division_labels, distance_metric="pearson", aggregate="mean", aggregate_sources=False, **kwargs):
+    """
+    Division-level RSA computed directly from aggregated connection profiles: the connection matrix's columns
+    are summed or averaged per division, and the division profiles compared with compute_distance_matrix.
+
+    Args:
+        df (pandas.DataFrame): Connection matrix (columns are the profiles, as in compute_distance_matrix).
+        division_labels: As for region_divisions, aligned with df's columns.
+        distance_metric (str): Passed to compute_distance_matrix.
+        aggregate (str): "mean" or "sum" of the member regions' profiles.
+        aggregate_sources (bool): Also aggregate the rows, so profiles run over divisions instead of regions.
+        **kwargs: Passed to compute_distance_matrix (nan_policy, dtype, ...).
+
+    Returns:
+        pandas.DataFrame: division x division RSA matrix.
+    """
+    if aggregate not in ("mean", "sum"):
+        raise ValueError(f"aggregate must be 'mean' or 'sum', got {aggregate!r}")
+    indicator, names = indicator_matrix(region_divisions(df.columns, division_labels))
+    if aggregate == "mean":
+        indicator = sp.csr_matrix(indicator.multiply(1 / np.maximum(indicator.sum(axis=0), 1)))
+
+    with instrument.span("division_rsa.aggregate", regions=df.shape[1], divisions=len(names)):
+        values = df.to_numpy(dtype=np.float64)
+        # NaN connections would spread through the sums; only whole missing profiles stay missing
+        profiles = np.asarray(np.nan_to_num(values) @ indicator)
+        index = df.index
+        if aggregate_sources:
+            source_indicator, _ = indicator_matrix(region_divisions(df.index, division_labels, df.columns))
+            if aggregate == "mean":
+                source_indicator = sp.csr_matrix(source_indicator.multiply(1 / np.maximum(source_indicator.sum(axis=0), 1)))
+            profiles = np.asarray(source_indicator.T @ profiles)
+            index = names
+    return compute_distance_matrix(pd.DataFrame(profiles, index=index, columns=names), metric=distance_metric, **kwargs)
+
+
+def _division_codes(divisions):
+    # integer code per region (-1 without a division) and the divisions in code order
+    codes, uniques = pd.factorize(np.asarray(divisions, dtype=object), sort=True)
+    return codes, pd.Index(uniques)
+
+
+def _indicator(codes, n_divisions):
+    member = codes >= 0
+    return sp.csr_matrix((np.ones(member.sum()), (np.flatnonzero(member), codes[member])), shape=(len(codes), n_divisions))
+
+
+def _block_medians(values, defined, codes, n_divisions):
+    # median of every division x division block from a single sort of all cells by (block, value)
+    member = codes >= 0
+    cells = defined & member[:, None] & member[None, :]
+    rows, cols = np.nonzero(cells)
+    blocks = codes[rows] * n_divisions + codes[cols]
+    cell_values = values[rows, cols]
+    # order cells by block, then by value within the block (the order of np.lexsort((cell_values, blocks))):
+    # sort by value, then stably by block, so the values keep their order inside every block
+    order = np.argsort(cell_values)
+    order = order[np.argsort(blocks[order], kind='stable')]
+    sorted_values = cell_values[order]
+
+    counts = np.bincount(blocks, minlength=n_divisions * n_divisions)
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+    lower = starts + np.maximum(counts - 1, 0) // 2
+    upper = starts + counts // 2
+    medians = np.full(n_divisions * n_divisions, np.nan)
+    medians[present] = (sorted_values[lower[present]] + sorted_values[np.minimum(upper, len(sorted_values) - 1)[present]]) / 2
+    return medians.reshape(n_divisions, n_divisions)
@@ -0,0 +1,222 @@
+# Group-level RSA over many subjects' connection matrices.
+# The subjects come as one 3-D subject x region x region stack (an ndarray, or a memory-mapped .npy file that is
+# read a batch of subjects at a time). For each batch, the ROI blocks of every subject are sliced at once, the
+# profiles standardized together, and all the subjects' RSA matrices come out of a single batched GEMM (matmul
+# over the subject axis). Group mean and variance RDMs are accumulated batch by batch with Welford's method
+# (Chan's pairwise update for a whole batch), counting the subjects per cell, so a region missing in some
+# subjects (filtered out, or a profile without variance) only leaves those subjects out of its cells.
+# Memory is bounded by the batch size and the result size, whatever the number of subjects.
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from analysis import FUSED_METRICS, compute_distance_matrix
+from kernels import rank_columns, similarity_to_distance
+from loaders import numbered_labels
+
+
+# bytes the blocks and RSA matrices of one batch of subjects may take
+GROUP_BATCH_BYTES = 256 * 1024 ** 2
+
+GroupRSA = namedtuple('GroupRSA', ['mean', 'variance', 'count'])
+
+
+class WelfordAccumulator:
+    """
+    Running per-cell count, mean and sum of squared deviations, updated a batch at a time. NaN cells are skipped,
+    so every cell keeps its own count.
+
+    Args:
+        shape (tuple): Shape of one observation.
+    """
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add(self, batch):
+        """
+        Adds a batch of observations stacked along the first axis (Chan et al.'s parallel update).
+        """
+        batch = np.asarray(batch, dtype=np.float64)
+        present = ~np.isnan(batch)
+        batch_count = present.sum(axis=0)
+        values = np.where(present, batch, 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            batch_mean = np.where(batch_count > 0, values.sum(axis=0) / batch_count, 0.0)
+            deviations = np.where(present, batch - batch_mean, 0.0)
+            batch_m2 = np.einsum('b...,b...->...', deviations, deviations)
+
+            total = self.count + batch_count
+            delta = batch_mean - self.mean
+            weight = np.where(total > 0, batch_count / np.maximum(total, 1), 0.0)
+            self.mean += delta * weight
+            self.m2 += batch_m2 + delta ** 2 * self.count * weight
+        self.count = total
+
+    def variance(self, ddof=1):
+        # sample variance per cell; NaN where fewer than ddof + 1 observations were seen
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan)
+
+    def result_mean(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+
+def load_subject_stack(path):
+    # a subject x region x region .npy stack, memory-mapped so only the subjects being processed are read
+    stack = np.load(path, mmap_mode='r', allow_pickle=False)
+    if stack.ndim != 3 or stack.shape[1] != stack.shape[2]:
+        raise ValueError(f"{path} must hold a subject x region x region stack, got shape {stack.shape}")
+    return stack
+
+
+def group_rsa(stack, ROI_list=(), filter_flag=False, min_num_connections=1, distance_metric='pearson', labels=None,
+              nan_policy="pairwise", dtype=np.float64, batch_bytes=GROUP_BATCH_BYTES):
+    """
+    Group mean and variance of build_corr_matrix over a stack of subjects.
+
+    Every subject's RSA matrices are what build_corr_matrix would return for that subject's matrix; a region
+    dropped for a subject (by the filter, or because its profile has no variance) is missing from that subject's
+    cells only. Regions missing in every subject are dropped from the result, like build_corr_matrix's dropna.
+
+    Args:
+        stack (numpy.ndarray or str): subject x region x region array (a memmap is read batch by batch), or the
+            path of such a .npy file.
+        ROI_list (list): Region labels of the ROI; empty for the full matrix (compute_distance_matrix).
+        filter_flag, min_num_connections, distance_metric, nan_policy: As for build_corr_matrix, applied per
+            subject.
+        labels (list-like): Names of the regions; "1".."n" by default, like load_connection_matrix.
+        dtype: Floating point type of the per-subject kernels; the accumulation is always float64.
+        batch_bytes (int): Memory allowed for one batch of subjects.
+
+    Returns:
+        tuple: (to, from) GroupRSA results of DataFrames (mean, variance, count), as ordered by build_corr_matrix;
+        the same result twice for the full matrix.
+    """
+    stack = load_subject_stack(stack) if isinstance(stack, (str, os.PathLike)) else stack
+    directions = _directions(stack, ROI_list, labels)
+    accumulators = [WelfordAccumulator((len(d['labels']), len(d['labels']))) for d in directions]
+    for _, batches in _batches(stack, directions, filter_flag, min_num_connections, distance_metric, nan_policy, dtype, batch_bytes):
+        for accumulator, distances in zip(accumulators, batches):
+            with instrument.span("group_rsa.welford", subjects=len(distances)):
+                accumulator.add(distances)
+
+    results = [_group_result(accumulator, direction['labels']) for accumulator, direction in zip(accumulators, directions)]
+    if len(results) == 1:
+        return (results[0], results[0])
+    from_result, to_result = results
+    return (to_result, from_result)
+
+
+def subject_rsa(stack, ROI_list=(), filter_flag=False, min_num_connections=1, distance_metric='pearson', labels=None,
+                nan_policy="pairwise", dtype=np.float64, batch_bytes=GROUP_BATCH_BYTES):
+    """
+    The per-subject RSA matrices behind group_rsa, computed in batches and yielded one subject at a time.
+
+    Yields:
+        tuple: (subject index, (to, from) DataFrames as build_corr_matrix returns them for that subject).
+    """
+    stack = load_subject_stack(stack) if isinstance(stack, (str, os.PathLike)) else stack
+    directions = _directions(stack, ROI_list, labels)
+    for start, batches in _batches(stack, directions, filter_flag, min_num_connections, distance_metric, nan_policy, dtype, batch_bytes):
+        for offset in range(len(batches[0])):
+            matrices = []
+            for distances, direction in zip(batches, directions):
+                frame = pd.DataFrame(distances[offset], index=direction['labels'], columns=direction['labels'])
+                matrices.append(frame.dropna(axis=0, how='all').dropna(axis=1, how='all'))
+            yield (start + offset, (matrices[0], matrices[0]) if len(matrices) == 1 else (matrices[1], matrices[0]))
+
+
+def _directions(stack, ROI_list, labels):
+    # the blocks to compare for each direction: profile rows x compared columns of every subject's matrix.
+    # from (outgoing): ROI rows x non-ROI targets; to (incoming): ROI columns x non-ROI sources (transposed block)
+    n = stack.shape[1]
+    labels = numbered_labels(n) if labels is None else pd.Index(labels)
+    if len(ROI_list) == 0:
+        everything = np.arange(n)
+        return [{'rows': everything, 'cols': everything, 'transpose': False, 'labels': labels}]
+
+    ROI_index = pd.Index(ROI_list)
+    missing = list(ROI_index[~ROI_index.isin(labels)])
+    if missing:
+        raise KeyError(f"{missing} not found in axis")
+    roi = labels.isin(ROI_list)
+    rois, others = np.flatnonzero(roi), np.flatnonzero(~roi)
+    return [{'rows': rois, 'cols': others, 'transpose': False, 'labels': labels[others]},
+            {'rows': others, 'cols': rois, 'transpose': True, 'labels': labels[others]}]
+
+
+def _batches(stack, directions, filter_flag, min_num_connections, distance_metric, nan_policy, dtype, batch_bytes):
+    # yields (first subject, [distances for each direction, each batch x t x t]) for consecutive batches of subjects
+    n_subjects = stack.shape[0]
+    # per subject: the block and its standardized copy, the RSA matrix and the Welford update's float64 temporaries
+    per_subject = sum(8 * (4 * len(d['cols']) ** 2 + 3 * len(d['rows']) * len(d['cols'])) for d in directions)
+    batch = max(1, int(batch_bytes // max(per_subject, 1)))
+    for start in range(0, n_subjects, batch):
+        subjects = slice(start, min(start + batch, n_subjects))
+        batches = []
+        for direction in directions:
+            with instrument.span("group_rsa.slice", subjects=subjects.stop - subjects.start):
+                # profiles are the columns of every subject's block: batch x profile length x compared regions
+                block = np.asarray(stack[subjects][:, direction['rows']][:, :, direction['cols']], dtype=np.float64)
+                if direction['transpose']:
+                    block = block.transpose(0, 2, 1)
+                keep = np.ones(block.shape[::2], dtype=bool)
+                if filter_flag:
+                    # nonzero counts over the ROI, as in build_corr_matrix (NaN counts as a connection)
+                    keep = (block != 0).sum(axis=1) >= min_num_connections
+            with instrument.span("group_rsa.kernel", metric=distance_metric, subjects=len(block)):
+                batches.append(_batch_distances(block, keep, distance_metric, nan_policy, dtype))
+        yield (start, batches)
+
+
+def _batch_distances(block, keep, metric, nan_policy, dtype):
+    # RSA matrices of a batch of subjects' blocks (batch x m x t); regions not kept are NaN in that subject's matrix
+    complete = ~np.isnan(block).any(axis=(1, 2))
+    if metric in FUSED_METRICS and block.shape[1] >= 2 and complete.all():
+        distances = _gemm_distances(block, metric, dtype)
+    else:
+        # missing values (pairwise handling) and bray-curtis go through the single-subject path
+        distances = np.empty((block.shape[0], block.shape[2], block.shape[2]), dtype=dtype)
+        for i, subject in enumerate(block):
+            distances[i] = compute_distance_matrix(pd.DataFrame(subject), metric=metric, nan_policy=nan_policy,
+                                                     dtype=dtype).to_numpy()
+    dropped = ~keep
+    distances[dropped] = np.nan
+    distances.transpose(0, 2, 1)[dropped] = np.nan
+    return distances
+
+
+def _gemm_distances(block, metric, dtype):
+    # standardize_columns for every subject at once, then one batched GEMM
+    if metric == "spearman":
+        b, m, t = block.shape
+        # rank along the profile axis: subjects' columns side by side make one m x (b * t) matrix
+        Z = rank_columns(block.transpose(1, 0, 2).reshape(m, b * t)).reshape(m, b, t).transpose(1, 0, 2).astype(dtype)
+    else:
+        Z = block.astype(dtype, copy=True)
+    if metric != "cosine":
+        Z -= Z.mean(axis=1, keepdims=True)
+    norms = np.sqrt(np.einsum('bij,bij->bj', Z, Z))
+    norms[norms == 0] = 1 if metric == "cosine" else np.nan
+    Z /= norms[:, None, :]
+
+    distances = similarity_to_distance(np.matmul(Z.transpose(0, 2, 1), Z), metric)
+    # a profile is at distance exactly 0 from itself, unless its correlation is undefined
+    diagonal = np.einsum('bii->bi', distances)
+    diagonal[...] = 0 if metric == "cosine" else np.where(np.isnan(diagonal), np.nan, 0)
+    return distances
+
+
+def _group_result(accumulator, labels):
+    mean = pd.DataFrame(accumulator.result_mean(), index=labels, columns=labels)
+    keep = mean.notna().any(axis=1).to_numpy()
+    mean = mean.loc[keep, keep]
+    variance = pd.DataFrame(accumulator.variance()[np.ix_(keep, keep)], index=mean.index, columns=mean.columns)
+    count = pd.DataFrame(accumulator.count[np.ix_(keep, keep)], index=mean.index, columns=mean.columns)
+    return GroupRSA(mean, variance, count)
@@ -2,16 +2,31 @@
 # The GUI will allow users to upload a CSV file, specify columns to aggregate into a region of interest (RSA), and compute RSA on connections to/from specified regions.
 # The results will be displayed in a text area, and a plot will be shown in a separate window.
 from qtpy.QtWidgets import (
-    QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog, QLineEdit, QTextEdit, QTableWidget,
-    QTableWidgetItem, QDialog, QComboBox
+    QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog, QLineEdit, QTextEdit, QTableView,
+    QDialog, QComboBox, QProgressBar, QCheckBox
 )
-import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas, NavigationToolbar2QT as NavigationToolbar
 
-import seaborn as sns
-from analysis import build_corr_matrix, build_corr_matrix_full, compute_mds  # Assuming this is your analysis function
+# Only Qt and the lightweight modules below are imported up front, so the window shows quickly. pandas, the
+# analysis modules, matplotlib and seaborn are imported where they are first needed: the analysis modules on the
+# worker threads that run them, the plotting libraries when the first plot window opens.
+import instrument
+from table_model import MatrixTableModel
+from workers import TaskRunner
+
+# RSA matrices with more regions than this are drawn by the level-of-detail renderer instead of seaborn
+SEABORN_MAX_REGIONS = 150
+
+# connection matrix formats understood by loaders.load_connection_matrix
+MATRIX_FILE_FILTER = ("Matrix Files (*.csv *.npy *.npz *.parquet *.h5 *.hdf5 *.xlsx *.xls);;CSV Files (*.csv);;"
+                      "NumPy Files (*.npy *.npz);;Parquet Files (*.parquet);;HDF5 Files (*.h5 *.hdf5);;Excel Files (*.xlsx *.xls)")
+
+# MDS choices offered in the GUI. Classical MDS is near-instant; SMACOF is the original reference embedding.
+MDS_METHODS = {
+    "classical (fast)": dict(method="classical"),
+    "SMACOF, classical start": dict(method="smacof", warm_start=True),
+    "SMACOF (reference)": dict(method="smacof"),
+    "landmark (very large matrices)": dict(method="landmark"),
+}
 
 class DataAnalysisApp(QWidget):
     def __init__(self):
@@ -25,7 +40,9 @@ class DataAnalysisApp(QWidget):
         hbox_upload_buttons = QHBoxLayout()
 
         self.uploaded_data = None
-        self.upload_button = QPushButton("*REQUIRED* Upload connection matrix CSV File")
+        # bumped by every load or relabel of uploaded_data, so results computed before it can be recognized
+        self.data_generation = 0
+        self.upload_button = QPushButton("*REQUIRED* Upload connection matrix file")
         self.upload_button.clicked.connect(self.load_data)
 
         self.uploaded_cols = None
@@ -50,6 +67,13 @@ class DataAnalysisApp(QWidget):
         self.column_input.setPlaceholderText("Enter column name(s) separated by commas to aggregate into RSA region")
         self.layout.addWidget(self.column_input)
 
+        # Once RSA has been computed, edits of the ROI list update it from running statistics (IncrementalRSA)
+        self.live_rsa_checkbox = QCheckBox("Update RSA while the ROI list is edited")
+        self.live_rsa_checkbox.setChecked(True)
+        self.layout.addWidget(self.live_rsa_checkbox)
+        self.rsa_engine = None
+        self.column_input.textChanged.connect(self.roi_list_edited)
+
         # Dropdown (QComboBox)
         self.distance_metric = "pearson"  # Default value
         self.metric_dropdown = QComboBox()
@@ -70,17 +94,77 @@ class DataAnalysisApp(QWidget):
         self.layout.addWidget(self.mds_button)
         self.mds_button.setVisible(False)  # Initially hidden
 
-        # Table Widget for Data Preview (Initially Hidden)
-        self.table_widget = QTableWidget()
-        self.table_widget.setMinimumHeight(200)
-        self.table_widget.setVisible(False)  # Hide initially
-        self.layout.addWidget(self.table_widget)
+        # Dropdown for the MDS embedding method; labels map to compute_mds keyword arguments
+        self.mds_method_dropdown = QComboBox()
+        self.mds_method_dropdown.addItems(list(MDS_METHODS))
+        self.layout.addWidget(self.mds_method_dropdown)
+        self.mds_method_dropdown.setVisible(False)  # Shown together with the MDS button
+
+        # Division x division summary of the RSA result (divisions.py), once major division labels are loaded
+        self.division_button = QPushButton("Summarize RSA by major division")
+        self.division_button.clicked.connect(self.run_division_summary)
+        self.layout.addWidget(self.division_button)
+        self.division_button.setVisible(False)  # Shown once RSA has been computed
+
+        # Regions with the most similar connectivity profile to one region, from a SimilarityIndex over the
+        # loaded matrix (built on first use, named with the labels from load_columns)
+        hbox_neighbors = QHBoxLayout()
+        self.neighbor_input = QLineEdit(self)
+        self.neighbor_input.setPlaceholderText("Region name")
+        self.neighbor_input.returnPressed.connect(self.find_neighbors)
+        self.neighbors_button = QPushButton("Find most similar regions")
+        self.neighbors_button.clicked.connect(self.find_neighbors)
+        hbox_neighbors.addWidget(self.neighbor_input)
+        hbox_neighbors.addWidget(self.neighbors_button)
+        self.layout.addLayout(hbox_neighbors)
+        self.similarity_index = None
+
+        # Loading, RSA and MDS run on background threads; progress bar and cancel button show while any is busy
+        self.tasks = TaskRunner(self)
+        self.tasks.busy_changed.connect(self.task_busy_changed)
+        hbox_progress = QHBoxLayout()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_tasks)
+        hbox_progress.addWidget(self.progress_bar)
+        hbox_progress.addWidget(self.cancel_button)
+        self.layout.addLayout(hbox_progress)
+        self.progress_bar.setVisible(False)
+        self.cancel_button.setVisible(False)
+
+        # Table View for Data Preview (Initially Hidden); the model formats only the cells in view,
+        # so the whole matrix can be scrolled
+        self.table_model = MatrixTableModel(parent=self)
+        self.table_view = QTableView()
+        self.table_view.setModel(self.table_model)
+        self.table_view.setMinimumHeight(200)
+        self.table_view.setVisible(False)  # Hide initially
+        self.layout.addWidget(self.table_view)
 
         # Text Area for Results
         self.result_text = QTextEdit()
         self.result_text.setReadOnly(True)
         self.layout.addWidget(self.result_text)
 
+        # Optional per-stage timing of the last run (instrument.py); also on when started with CONNECTOME_TRACE=1
+        hbox_timing = QHBoxLayout()
+        self.timing_checkbox = QCheckBox("Show timing breakdown of the last run")
+        self.timing_checkbox.setChecked(instrument.enabled())
+        self.timing_checkbox.toggled.connect(self.timing_toggled)
+        self.export_trace_button = QPushButton("Export trace...")
+        self.export_trace_button.clicked.connect(self.export_trace)
+        hbox_timing.addWidget(self.timing_checkbox)
+        hbox_timing.addWidget(self.export_trace_button)
+        self.layout.addLayout(hbox_timing)
+        self.timing_model = MatrixTableModel(float_format=".1f", parent=self)
+        self.timing_view = QTableView()
+        self.timing_view.setModel(self.timing_model)
+        self.timing_view.setMinimumHeight(120)
+        self.layout.addWidget(self.timing_view)
+        self.timing_view.setVisible(instrument.enabled())
+        self.export_trace_button.setVisible(instrument.enabled())
+
         self.setLayout(self.layout)
         self.file_path = ""
 
@@ -88,37 +172,36 @@ class DataAnalysisApp(QWidget):
     # IN DEVELOPMENT
     def load_data(self):
         """
-        Imports a CSV file into a pandas DataFrame and numbers the rows and columns.
-
-        Args:
-            matrix_csv_path (str): Path to the CSV file containing the matrix data.
+        Imports a connection matrix file into a pandas DataFrame with rows and columns numbered "1".."n".
 
-        Returns:
-            pandas.DataFrame: A pandas DataFrame containing the matrix data with numbered rows and columns.
+        Binary files (.npy, .npz, .parquet, .h5) are memory-mapped or read directly; a CSV is converted once
+        to a binary sidecar file in the cache folder, so opening it again skips the text parsing (see loaders.load_connection_matrix).
+        The file is read on a background thread and handed to data_loaded.
         """
-        file_path, _ = QFileDialog.getOpenFileName(self, "Open File", "", "CSV Files (*.csv);;Excel Files (*.xlsx *.xls)")
+        file_path, _ = QFileDialog.getOpenFileName(self, "Open File", "", MATRIX_FILE_FILTER)
         if file_path:
             self.file_path = file_path
             self.result_text.setText(f"Inside load_data, Loaded file: {file_path}")
+        else:
+            return
 
-        df = pd.read_csv(file_path, header=None)  # Read without header
-
-        # Number the rows and columns
-        df.index = range(1, len(df) + 1)  # Number the rows
-        df.columns = range(1, len(df.columns) + 1)  # Number the columns
-
-        # convert to string so we can index
-        df.index = df.index.astype(str)
-        df.columns = df.columns.astype(str)
+        # rows and columns come back numbered as strings so we can index
+        self.start_timing()
+        self.tasks.submit('load', load_matrix_task, file_path, report_progress=True,
+                          on_result=self.data_loaded, on_error=self.task_failed, on_progress=self.task_progress)
 
+    def data_loaded(self, df):
         self.result_text.setText(f"Loaded matrix data from: {df.index}")
         self.uploaded_data = df
+        self.data_generation += 1
+        self.rsa_engine = None
+        self.similarity_index = None
 
-        preview_df = df.head(10)
-        self.display_table(preview_df)
+        self.display_table(df)
+        self.update_timing()
         self.upload_columns_buttons.setEnabled(True) # can't upload columns until data is uploaded
         self.upload_div_labels_buttons.setEnabled(True) # can't upload major divisions until data is uploaded
-        self.table_widget.setVisible(True)
+        self.table_view.setVisible(True)
 
     def load_columns(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Open File", "", "CSV Files (*.csv);;Excel Files (*.xlsx *.xls);;Text Files (*.txt)")
@@ -127,6 +210,7 @@ class DataAnalysisApp(QWidget):
             self.result_text.setText(f"Loaded file: {file_path}")
 
         try:
+            import pandas as pd
             region_names = pd.read_csv(file_path, header=None).to_numpy().flatten()  # Read without header
             self.uploaded_cols = region_names
 
@@ -134,12 +218,14 @@ class DataAnalysisApp(QWidget):
 
             self.uploaded_data.index = region_names
             self.uploaded_data.columns = region_names
+            self.data_generation += 1
+            self.rsa_engine = None  # built for the old labels
+            self.similarity_index = None
         except Exception as e:
             self.result_text.setText(f"Error loading column file: {str(e)}")
         
         # refresh preview of data
-        preview_df = self.uploaded_data.head(10)
-        self.display_table(preview_df)
+        self.display_table(self.uploaded_data)
 
     def load_div_labels(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Open File", "", "CSV Files (*.csv);;Excel Files (*.xlsx *.xls);;Text Files (*.txt)")
@@ -148,6 +234,7 @@ class DataAnalysisApp(QWidget):
             self.result_text.setText(f"Loaded file: {file_path}")
 
         try:
+            import pandas as pd
             major_div_labels = pd.read_csv(file_path, header=None).to_numpy().flatten()  # Read without header
             self.uploaded_division_labels = major_div_labels
             self.result_text.setText(f"Loaded major division labels: {major_div_labels}")
@@ -160,10 +247,13 @@ class DataAnalysisApp(QWidget):
         print(f"Selected option: {selected_option}")  # Or do something else with the selection
         # You can use the selected_option to change the plot or other aspects of your application
         self.distance_metric = selected_option
+        self.rsa_engine = None  # running statistics are specific to the metric
+        self.similarity_index = None
 
 
     def preview_data(self, file_path):
         try:
+            import pandas as pd
             if file_path.endswith(".csv"):
                 df = pd.read_csv(file_path, index_col=0)  # Use first column as index
             elif file_path.endswith(".xlsx") or file_path.endswith(".xls"):
@@ -173,47 +263,97 @@ class DataAnalysisApp(QWidget):
                 return
             
             self.uploaded_data = df
+            self.data_generation += 1
 
-            preview_df = df.head(10)
-            self.display_table(preview_df)
-            self.table_widget.setVisible(True)
+            self.display_table(df)
+            self.table_view.setVisible(True)
 
         except Exception as e:
             self.result_text.setText(f"Error loading file: {str(e)}")
 
     def display_table(self, df):
-        self.table_widget.setRowCount(df.shape[0])
-        self.table_widget.setColumnCount(df.shape[1])
-        self.table_widget.setHorizontalHeaderLabels(df.columns.astype(str))
-        self.table_widget.setVerticalHeaderLabels(df.index.astype(str))
-
-        for row in range(df.shape[0]):
-            for col in range(df.shape[1]):
-                self.table_widget.setItem(row, col, QTableWidgetItem(str(df.iat[row, col])))
-
-        self.table_widget.resizeColumnsToContents()
+        # the model only keeps a reference to the matrix; nothing is converted until it is scrolled into view
+        self.table_model.set_matrix(df)
 
     def run_rsa(self):
         if not self.file_path:
             self.result_text.setText("Please upload a file first.")
             return
-        try:
-            if self.column_input.text() == "":
-                self.rsa_data = build_corr_matrix_full(self.uploaded_data, distance_metric=self.distance_metric)
-                self.show_plot(viz_type='RSA')
-            else:
-                # Split the input text by commas and remove any leading/trailing whitespace
-                columns = self.column_input.text().split(",")
-                columns = [col.strip() for col in columns]
-
-                # define RSA matrices for incoming and outgoing connections
-                self.rsa_data = build_corr_matrix(self.uploaded_data, columns, filter_flag=True, min_num_connections=1, distance_metric=self.distance_metric)
-                self.show_plot(viz_type='RSA')
-                
-                self.mds_button.setVisible(True) # Show the MDS button
+        # Split the input text by commas and remove any leading/trailing whitespace
+        columns = []
+        if self.column_input.text() != "":
+            columns = self.column_input.text().split(",")
+            columns = [col.strip() for col in columns]
+
+        # repeat clicks restart the computation instead of queueing more of them
+        self.start_timing()
+        self.tasks.submit('rsa', rsa_task, self.uploaded_data, columns, self.distance_metric, report_progress=True,
+                          on_result=self.rsa_finished, on_error=self.task_failed, on_progress=self.task_progress)
+
+    def rsa_finished(self, rsa_data):
+        self.rsa_data = rsa_data
+        self.show_plot(viz_type='RSA')
+        self.update_timing()
+        self.division_button.setVisible(True)
+        if self.column_input.text() != "":
+            self.mds_button.setVisible(True) # Show the MDS button
+            self.mds_method_dropdown.setVisible(True)
+
+    def roi_list_edited(self, text):
+        # live updates only refine an ROI RSA that is already on screen
+        if not self.live_rsa_checkbox.isChecked() or not isinstance(self.rsa_data, tuple) or text.strip() == "":
+            return
+        columns = [col.strip() for col in text.split(",") if col.strip() != ""]
+        # wait while a label is still being typed rather than flashing a KeyError for it
+        if not all(col in self.uploaded_data.columns for col in columns):
+            return
+        # shares the task name with run_rsa, so a click and typing never compute side by side. The engine is
+        # built on the worker (it converts the whole matrix) and handed back with the result for the next edit.
+        self.start_timing()
+        # the result is tagged with the data generation it was computed from
+        self.tasks.submit('rsa', live_rsa_task, self.rsa_engine, self.uploaded_data, columns, self.distance_metric,
+                          on_result=lambda result, generation=self.data_generation: self.rsa_updated(result, generation),
+                          on_error=self.task_failed)
+
+    def rsa_updated(self, result, generation):
+        engine, rsa_data = result
+        # the data was reloaded or relabelled (load_columns renames it in place) while the engine was working:
+        # the result carries the old labels, so it and the engine are dropped
+        if generation != self.data_generation:
+            return
+        # keep the engine unless the metric changed while it was working
+        if engine.distance_metric == self.distance_metric:
+            self.rsa_engine = engine
+        # redraw the open RSA windows in place rather than opening new ones on every edit
+        self.rsa_data = rsa_data
+        windows = [getattr(self, 'plot_window_to_plot', None), getattr(self, 'plot_window_from_plot', None)]
+        if all(window is not None and window.isVisible() and window.viz_type == 'RSA' for window in windows):
+            for window, matrix in zip(windows, rsa_data):
+                window.set_data(matrix)
+        else:
+            self.show_plot(viz_type='RSA')
+        self.update_timing()
 
-        except Exception as e:
-            self.result_text.setText(f"Error: {str(e)}")
+    def find_neighbors(self):
+        region = self.neighbor_input.text().strip()
+        if self.uploaded_data is None or region == "":
+            self.result_text.setText("Please upload a file and enter a region name first.")
+            return
+        self.start_timing()
+        self.tasks.submit('neighbors', neighbors_task, self.similarity_index, self.uploaded_data, region,
+                          self.distance_metric, on_result=self.neighbors_found, on_error=self.task_failed)
+
+    def neighbors_found(self, result):
+        from similarity_index import INDEX_METRICS
+        index, neighbors = result
+        # keep the index unless the data, labels or metric changed while it was being built
+        metric = self.distance_metric if self.distance_metric in INDEX_METRICS else "pearson"
+        if self.uploaded_data is not None and index.labels.equals(self.uploaded_data.columns) and index.metric == metric:
+            self.similarity_index = index
+        lines = [f"{label}: {distance:.4f}" for label, distance in neighbors.items()]
+        self.result_text.setText(f"Most similar regions to {neighbors.name} ({index.metric} distance):\n"
+                                 + "\n".join(lines))
+        self.update_timing()
 
     # only to be run after rsa matrices have been generated
     def run_mds(self):
@@ -221,13 +361,109 @@ class DataAnalysisApp(QWidget):
         to_matrix = self.rsa_data[0]
         from_matrix = self.rsa_data[1]
         self.result_text.setText("got the matrices extracted")
-        try:
-            mds_result_to = compute_mds(to_matrix)
-            mds_result_from = compute_mds(from_matrix)
-            self.show_plot(mds_result_to, mds_result_from, 'MDS')
+        mds_options = MDS_METHODS[self.mds_method_dropdown.currentText()]
+        # points are coloured by major division when labels for every region are loaded
+        division_labels = self.division_labels()
+        if division_labels is not None:
+            mds_options = dict(mds_options, group_labels=division_labels)
+
+        # both embeddings are computed at the same time, each window opens as soon as its embedding is ready
+        self.start_timing()
+        self.tasks.submit('mds_to', mds_task, to_matrix, mds_options, report_progress=True,
+                          on_result=lambda mds_result: self.mds_finished(mds_result, "To Matrix MDS"),
+                          on_error=self.task_failed, on_progress=self.task_progress)
+        self.tasks.submit('mds_from', mds_task, from_matrix, mds_options, report_progress=True,
+                          on_result=lambda mds_result: self.mds_finished(mds_result, "From Matrix MDS"),
+                          on_error=self.task_failed, on_progress=self.task_progress)
+
+    def division_labels(self):
+        # the uploaded major division labels as a Series over the matrix's region labels, if they fit the matrix
+        if self.uploaded_division_labels is None or self.uploaded_data is None or \
+                len(self.uploaded_division_labels) != len(self.uploaded_data.columns):
+            return None
+        import pandas as pd
+        return pd.Series(self.uploaded_division_labels, index=self.uploaded_data.columns)
+
+    def run_division_summary(self):
+        division_labels = self.division_labels()
+        if self.rsa_data is None or division_labels is None:
+            self.result_text.setText("Please compute RSA and upload one major division label per region first.")
+            return
+        if isinstance(self.rsa_data, tuple):
+            matrices = {"To Matrix by Division": self.rsa_data[0], "From Matrix by Division": self.rsa_data[1]}
+        else:
+            matrices = {"RSA by Division": self.rsa_data}
+        self.start_timing()
+        self.tasks.submit('divisions', division_task, matrices, division_labels,
+                          on_result=self.division_summary_finished, on_error=self.task_failed)
+
+    def division_summary_finished(self, summaries):
+        self.division_windows = []
+        lines = []
+        for window_title, summary in summaries.items():
+            plot_window = PlotWindow(self, display_data=summary.mean, viz_type='RSA', window_title=window_title)
+            plot_window.show()
+            self.division_windows.append(plot_window)
+            lines.append(f"{window_title}, within vs between division distances:\n{summary.contrast.to_string()}")
+        self.result_text.setText("\n\n".join(lines))
+        self.update_timing()
+
+    def mds_finished(self, mds_result, window_title):
+        plot_window = PlotWindow(self, display_data=mds_result, viz_type='MDS', window_title=window_title)
+        # kept apart from the RSA windows, which live ROI edits redraw in place
+        if window_title == "To Matrix MDS":
+            self.plot_window_to_mds = plot_window
+        else:
+            self.plot_window_from_mds = plot_window
+        plot_window.show()
+        self.update_timing()
+
+    def timing_toggled(self, checked):
+        instrument.enable(checked)
+        self.timing_view.setVisible(checked)
+        self.export_trace_button.setVisible(checked)
+
+    def start_timing(self):
+        # each load, RSA or MDS run starts a fresh breakdown
+        if instrument.enabled():
+            instrument.reset()
+
+    def update_timing(self):
+        # one row per stage: calls, total / mean / max milliseconds (and peak MB with CONNECTOME_TRACE=memory)
+        if not instrument.enabled():
+            return
+        import pandas as pd
+        stages = pd.DataFrame(instrument.summary(), columns=['name', 'calls', 'total_ms', 'mean_ms', 'max_ms', 'peak_mb'])
+        stages = stages.set_index('name').dropna(axis=1, how='all')
+        for name, value in instrument.counters().items():
+            stages.loc[name, 'calls'] = value
+        self.timing_model.set_matrix(stages)
+
+    def export_trace(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Trace", "trace.json",
+                                                   "Chrome Trace (*.json);;JSON Lines (*.jsonl)")
+        if file_path:
+            instrument.export(file_path)
+            self.result_text.setText(f"Trace written to {file_path}")
 
-        except Exception as e:
-            self.result_text.setText(f"Error: {str(e)}")
+    def task_progress(self, percent, message):
+        self.progress_bar.setValue(percent)
+        if message:
+            self.result_text.setText(message)
+
+    def task_failed(self, error):
+        self.result_text.setText(f"Error: {str(error)}")
+
+    def task_busy_changed(self, name, busy):
+        running = self.tasks.is_running()
+        self.progress_bar.setVisible(running)
+        self.cancel_button.setVisible(running)
+        if busy:
+            self.progress_bar.setValue(0)
+
+    def cancel_tasks(self):
+        self.tasks.cancel()
+        self.result_text.setText("Cancelled.")
 
     def show_plot(self, viz_type='RSA'):
         try:
@@ -249,26 +485,84 @@ class DataAnalysisApp(QWidget):
         except Exception as e:
             self.result_text.setText(f"Error: {str(e)}")
 
+def load_matrix_task(file_path, progress):
+    from loaders import load_connection_matrix
+    progress(0, f"Loading {file_path}...")
+    df = load_connection_matrix(file_path)
+    progress(100, f"Loaded file: {file_path}")
+    return df
+
+def live_rsa_task(engine, data, columns, distance_metric):
+    # updates the live ROI RSA, building the IncrementalRSA engine on first use
+    if engine is None:
+        from analysis import IncrementalRSA
+        engine = IncrementalRSA(data, distance_metric=distance_metric, filter_flag=True, min_num_connections=1)
+    return engine, engine.update(columns)
+
+def rsa_task(data, columns, distance_metric, progress):
+    # results are reused across clicks and sessions
+    from cache import cached_build_corr_matrix, cached_build_corr_matrix_full
+    # if they haven't entered any columns, just run RSA on the full matrix
+    progress(0, "Computing RSA...")
+    if len(columns) == 0:
+        # stored condensed: the symmetric result takes half the memory, and the plot and table read it lazily
+        rsa_data = cached_build_corr_matrix_full(data, distance_metric=distance_metric, condensed=True)
+    else:
+        # define RSA matrices for incoming and outgoing connections
+        rsa_data = cached_build_corr_matrix(data, columns, filter_flag=True, min_num_connections=1, distance_metric=distance_metric)
+    progress(100, "RSA done.")
+    return rsa_data
+
+def neighbors_task(index, data, region, distance_metric, k=10):
+    # builds the index on first use (bray-curtis has no vector form, so it falls back to pearson)
+    if index is None:
+        from similarity_index import INDEX_METRICS, SimilarityIndex
+        metric = distance_metric if distance_metric in INDEX_METRICS else "pearson"
+        index = SimilarityIndex(data, metric=metric, nan_policy="complete")
+    return index, index.neighbors(region, k)
+
+def division_task(matrices, division_labels):
+    from divisions import division_summary
+    return {name: division_summary(matrix, division_labels) for name, matrix in matrices.items()}
+
+def mds_task(rsa_matrix, mds_options, progress):
+    from cache import cached_compute_mds
+    progress(0, "Running MDS analysis...")
+    mds_result = cached_compute_mds(rsa_matrix, **mds_options)
+    progress(100, "MDS done.")
+    return mds_result
+
 class PlotWindow(QDialog):
     def __init__(self, parent=None, display_data=None, viz_type='RSA', window_title="Analysis Plot"):
         super().__init__(parent)
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas, NavigationToolbar2QT as NavigationToolbar
         self.setWindowTitle(window_title)
         self.setGeometry(200, 200, 800, 600)
 
         self.layout = QVBoxLayout(self)
 
-        self.figure = plt.Figure(figsize=(4, 4), dpi=100)
+        self.figure = Figure(figsize=(4, 4), dpi=100)
         self.canvas = FigureCanvas(self.figure)
 
         # Add the Matplotlib toolbar for navigation (zoom, pan, save)
         self.toolbar = NavigationToolbar(self.canvas, self)  # Pass self for parent
 
         self.data = display_data
+        self.viz_type = viz_type
 
         self.layout.addWidget(self.toolbar)
         self.layout.addWidget(self.canvas)
         self.canvas.draw()
 
+        # the full RSA matrix can be scrolled below the plot
+        if viz_type == 'RSA':
+            self.table_view = QTableView()
+            self.table_model = MatrixTableModel(display_data, parent=self)
+            self.table_view.setModel(self.table_model)
+            self.table_view.setMinimumHeight(150)
+            self.layout.addWidget(self.table_view)
+
         if viz_type == 'RSA':
             self.plot_rsa_data()
         elif viz_type == 'MDS':
@@ -276,25 +570,56 @@ class PlotWindow(QDialog):
         else:
             raise ValueError("Invalid visualization type")
 
+    def set_data(self, display_data):
+        # replaces the shown data and redraws, keeping the window where the user put it
+        self.data = display_data
+        self.figure.clear()
+        if self.viz_type == 'RSA':
+            self.table_model.set_matrix(display_data)
+            self.plot_rsa_data()
+        else:
+            self.plot_mds_data()
+            self.canvas.draw_idle()
+
+    @instrument.traced("plot.rsa")
     def plot_rsa_data(self):
+        # seaborn also registers the 'rocket' colormap the large-matrix renderer uses
+        import seaborn as sns
+        from condensed import CondensedMatrix
+        from tiled import TiledDistanceMatrix
 
         ax = self.figure.add_subplot(111)  # Create a subplot
-        sns.heatmap(self.data, fmt=".2f", cbar=True, square=True, xticklabels=True, yticklabels=True, ax=ax)
+        data = self.data
+        if len(data) > SEABORN_MAX_REGIONS:
+            # one image from a downsampled pyramid, re-rendered on zoom; a per-cell seaborn plot takes minutes here.
+            # Out-of-core results are read from their memory map one chunk at a time.
+            from heatmap import LODHeatmap
+            self.heatmap = LODHeatmap(ax, data)
+        else:
+            if isinstance(data, (TiledDistanceMatrix, CondensedMatrix)):
+                data = data.to_frame()
+            sns.heatmap(data, fmt=".2f", cbar=True, square=True, xticklabels=True, yticklabels=True, ax=ax)
         ax.set_title("Representational Dissimilarity in Connectivity Patterns")
 
         self.canvas.draw()
 
+    @instrument.traced("plot.mds")
     def plot_mds_data(self):
+        import seaborn as sns
         ax = self.figure.add_subplot(111)  # Create a subplot
-        sns.scatterplot(
-            x='Dim1', y='Dim2', 
-            data=self.data, 
-            ax=ax,
-            s=100,
-            marker='o',
-            color='red'
-        )
+        if 'Group' in self.data.columns:
+            # coloured by major division (compute_mds group_labels)
+            sns.scatterplot(x='Dim1', y='Dim2', data=self.data, ax=ax, s=100, marker='o', hue='Group')
+        else:
+            sns.scatterplot(
+                x='Dim1', y='Dim2',
+                data=self.data,
+                ax=ax,
+                s=100,
+                marker='o',
+                color='red'
+            )
 
         ax.set_title("Representational Dissimilarity in Connectivity Patterns")
-        for label, (x, y) in self.data.iterrows():
+        for label, (x, y) in self.data[['Dim1', 'Dim2']].iterrows():
             ax.text(x, y, label, fontsize=12, ha='right', va='center')
\ No newline at end of file
@@ -0,0 +1,172 @@
+# Fast heatmaps for large RSA matrices.
+# Instead of one patch per cell (seaborn), the matrix is drawn as a single image from a level-of-detail pyramid:
+# each level halves the resolution of the one below by averaging 2x2 blocks. Only about one screen's worth of
+# pixels is drawn at a time; zooming or panning with the navigation toolbar re-renders the visible window from
+# the finest level that still matches the screen resolution, and tick labels are thinned to what fits.
+import matplotlib
+import numpy as np
+from matplotlib.ticker import FixedFormatter, FixedLocator
+
+import instrument
+
+
+# levels are added until the coarsest one is at most this many cells on a side
+PYRAMID_BASE_SIZE = 512
+# rows of the full-resolution matrix read at a time when building the first level (bounds memory for memory maps)
+PYRAMID_CHUNK_ROWS = 1024
+# vertical space per tick label, as a multiple of the font size
+LABEL_SPACING = 1.4
+
+
+class HeatmapPyramid:
+    """
+    Level-of-detail pyramid of a 2-D matrix. Level 0 is the matrix itself (an ndarray or memory map, not copied);
+    level k averages 2^k x 2^k blocks, ignoring NaN cells.
+
+    Args:
+        values (numpy.ndarray): The matrix.
+        base_size (int): Stop adding levels once the coarsest one fits into base_size x base_size.
+    """
+
+    @instrument.traced("heatmap.pyramid")
+    def __init__(self, values, base_size=PYRAMID_BASE_SIZE):
+        self.levels = [values]
+        self.vmin, self.vmax = np.inf, -np.inf
+        while max(self.levels[-1].shape) > base_size:
+            self.levels.append(self._downsample(self.levels[-1], track_range=len(self.levels) == 1))
+        if len(self.levels) == 1:
+            self._update_range(np.asarray(values))
+
+    def window(self, rows, cols, max_cells):
+        """
+        The coarsest level that still has at least max_cells cells across the visible window, sliced to that window.
+
+        Args:
+            rows (tuple): (first, stop) visible rows of the full matrix.
+            cols (tuple): (first, stop) visible columns of the full matrix.
+            max_cells (tuple): (rows, cols) that can be resolved on screen, e.g. the axes size in pixels.
+
+        Returns:
+            tuple: (block, (first_row, stop_row, first_col, stop_col)), the block and the span of the full
+            matrix it covers.
+        """
+        span = max((rows[1] - rows[0]) / max(max_cells[0], 1), (cols[1] - cols[0]) / max(max_cells[1], 1))
+        level = int(np.clip(np.floor(np.log2(span)) if span > 1 else 0, 0, len(self.levels) - 1))
+        scale = 2 ** level
+        n_rows, n_cols = self.levels[0].shape
+        r0, c0 = rows[0] // scale, cols[0] // scale
+        r1, c1 = -(-rows[1] // scale), -(-cols[1] // scale)
+        block = np.asarray(self.levels[level][r0:r1, c0:c1], dtype=np.float64)
+        return block, (r0 * scale, min(r1 * scale, n_rows), c0 * scale, min(c1 * scale, n_cols))
+
+    def _update_range(self, block):
+        with np.errstate(invalid="ignore"):
+            if np.isfinite(block).any():
+                self.vmin = min(self.vmin, np.nanmin(block))
+                self.vmax = max(self.vmax, np.nanmax(block))
+
+    def _downsample(self, values, track_range=False):
+        # NaN-aware 2x2 block means; odd edges are padded with NaN so partial blocks average what they have
+        n_rows, n_cols = values.shape
+        out = np.empty((-(-n_rows // 2), -(-n_cols // 2)))
+        step = PYRAMID_CHUNK_ROWS - PYRAMID_CHUNK_ROWS % 2
+        for start in range(0, n_rows, step):
+            chunk = np.asarray(values[start:start + step], dtype=np.float64)
+            if track_range:
+                self._update_range(chunk)
+            padded = np.full((chunk.shape[0] + chunk.shape[0] % 2, n_cols + n_cols % 2), np.nan)
+            padded[:chunk.shape[0], :n_cols] = chunk
+            blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+            present = ~np.isnan(blocks)
+            counts = present.sum(axis=(1, 3))
+            sums = np.where(present, blocks, 0).sum(axis=(1, 3))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out[start // 2:start // 2 + blocks.shape[0]] = sums / counts
+        return out
+
+
+class LODHeatmap:
+    """
+    Heatmap of a labelled matrix on a matplotlib Axes, re-rendered from a HeatmapPyramid whenever the view limits change.
+
+    Args:
+        ax (matplotlib.axes.Axes): Axes to draw into.
+        matrix (pandas.DataFrame, TiledDistanceMatrix, CondensedMatrix or numpy.ndarray): Matrix to show; its index and columns
+            label the ticks.
+        cmap (str): Colormap; defaults to seaborn's heatmap colormap when seaborn is loaded.
+        fontsize (float): Tick label font size in points.
+        colorbar (bool): Add a colorbar.
+    """
+
+    def __init__(self, ax, matrix, cmap=None, fontsize=8, colorbar=True):
+        self.ax = ax
+        values = matrix.values if hasattr(matrix, 'values') else np.asarray(matrix)
+        n_rows, n_cols = values.shape
+        self.row_labels = np.asarray(getattr(matrix, 'index', np.arange(n_rows))).astype(str)
+        self.col_labels = np.asarray(getattr(matrix, 'columns', np.arange(n_cols))).astype(str)
+        self.fontsize = fontsize
+        self.pyramid = HeatmapPyramid(values)
+
+        if cmap is None:
+            cmap = 'rocket' if 'rocket' in matplotlib.colormaps else 'viridis'
+        vmin, vmax = (self.pyramid.vmin, self.pyramid.vmax) if self.pyramid.vmin <= self.pyramid.vmax else (0, 1)
+        block, _ = self.pyramid.window((0, n_rows), (0, n_cols), (1, 1))
+        self.image = ax.imshow(block, cmap=cmap, vmin=vmin, vmax=vmax, interpolation='nearest', aspect='equal',
+                               extent=(-0.5, n_cols - 0.5, n_rows - 0.5, -0.5))
+        if colorbar:
+            ax.figure.colorbar(self.image, ax=ax)
+        ax.set_xlim(-0.5, n_cols - 0.5)
+        ax.set_ylim(n_rows - 0.5, -0.5)
+        # the limits are now driven by the toolbar alone; redrawing must not autoscale them
+        ax.set_autoscale_on(False)
+
+        self._rendering = False
+        ax.callbacks.connect('xlim_changed', self._limits_changed)
+        ax.callbacks.connect('ylim_changed', self._limits_changed)
+        ax.figure.canvas.mpl_connect('resize_event', lambda event: self.render())
+        self.render()
+
+    @instrument.traced("heatmap.render")
+    def render(self):
+        # redraws the image and the tick labels for the current view limits and axes size
+        if self._rendering:
+            return
+        self._rendering = True
+        try:
+            n_rows, n_cols = self.pyramid.levels[0].shape
+            rows = self._visible(self.ax.get_ylim(), n_rows)
+            cols = self._visible(self.ax.get_xlim(), n_cols)
+            width, height = self._axes_pixels()
+            block, (r0, r1, c0, c1) = self.pyramid.window(rows, cols, (height, width))
+            self.image.set_data(block)
+            self.image.set_extent((c0 - 0.5, c1 - 0.5, r1 - 0.5, r0 - 0.5))
+            self._set_ticks(self.ax.yaxis, rows, height, self.row_labels)
+            self._set_ticks(self.ax.xaxis, cols, width, self.col_labels, rotation=90)
+            self.ax.figure.canvas.draw_idle()
+        finally:
+            self._rendering = False
+
+    def _limits_changed(self, ax):
+        self.render()
+
+    def _axes_pixels(self):
+        bbox = self.ax.get_window_extent()
+        return max(int(bbox.width), 1), max(int(bbox.height), 1)
+
+    @staticmethod
+    def _visible(limits, n):
+        # cell range [first, stop) covered by a pair of axis limits (cells are centred on integers)
+        low, high = sorted(limits)
+        return int(np.clip(np.floor(low + 0.5), 0, n)), int(np.clip(np.ceil(high + 0.5), 0, n))
+
+    def _set_ticks(self, axis, span, pixels, labels, rotation=0):
+        # adaptive thinning: keep every step-th label so that the labels never overlap
+        first, stop = span
+        label_pixels = self.fontsize * self.ax.figure.dpi / 72 * LABEL_SPACING
+        fits = max(int(pixels / label_pixels), 1)
+        step = max(1, -(-(stop - first) // fits))
+        ticks = np.arange(-(-first // step) * step, stop, step)
+        # fixed locator/formatter rather than set_ticks, which could widen the view limits again
+        axis.set_major_locator(FixedLocator(ticks))
+        axis.set_major_formatter(FixedFormatter(labels[ticks]))
+        axis.set_tick_params(labelsize=self.fontsize, labelrotation=rotation)
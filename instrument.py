@@ -0,0 +1,224 @@
+# Lightweight instrumentation: named spans (timed, optionally with memory) and counters around the analysis stages.
+# Off by default; while off, span() hands back one shared do-nothing context manager and count() returns at
+# once, so the instrumented code pays a function call and nothing else. Turn it on with
+#   CONNECTOME_TRACE=1         (CONNECTOME_TRACE=memory also records each span's peak traced memory)
+# or enable() from code. Recorded spans export to JSON lines (one event per line) or to the Chrome trace format,
+# which chrome://tracing and https://ui.perfetto.dev open as a timeline per thread.
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+
+
+# environment variable that turns instrumentation on when the module is imported
+TRACE_ENV = "CONNECTOME_TRACE"
+
+SpanRecord = namedtuple('SpanRecord', ['name', 'start', 'duration', 'thread', 'peak_bytes', 'args'])
+
+_state = {'enabled': False, 'memory': False}
+_lock = threading.Lock()
+_spans = []
+_counters = {}
+_local = threading.local()
+# perf_counter value all span start times are relative to
+_origin = time.perf_counter()
+
+
+class _NullSpan:
+    # what span() returns while instrumentation is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.child_peak = 0
+
+    def __enter__(self):
+        stack = _stack()
+        if _state['memory']:
+            # the peak since the last reset belongs to the enclosing span; reset it to measure this one alone
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        stack = _stack()
+        stack.pop()
+        peak_bytes = None
+        if _state['memory'] and tracemalloc.is_tracing() and hasattr(self, 'start_memory'):
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            peak_bytes = max(peak - self.start_memory, 0)
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+            tracemalloc.reset_peak()
+        record = SpanRecord(self.name, self.start - _origin, end - self.start, threading.get_ident(), peak_bytes, self.args)
+        with _lock:
+            _spans.append(record)
+        return False
+
+
+def enable(on=True, memory=False):
+    """
+    Turns instrumentation on or off.
+
+    Args:
+        on (bool): Record spans and counters.
+        memory (bool): Also record the peak memory of each span with tracemalloc. This slows allocations down
+            noticeably, and with several threads a span also sees the other threads' allocations.
+    """
+    _state['enabled'] = bool(on)
+    _state['memory'] = bool(on and memory)
+    if _state['memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not _state['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def enabled():
+    return _state['enabled']
+
+
+def span(name, **args):
+    """
+    Context manager timing a named stage; keyword arguments (sizes, metric, ...) are stored with it.
+
+        with instrument.span("distance_kernel", metric=metric, n=n):
+            ...
+    """
+    if not _state['enabled']:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name=None):
+    """
+    Decorator form of span; the span is named after the function unless a name is given.
+    """
+    def decorate(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return function(*args, **kwargs)
+            with _Span(span_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    # adds value to a named counter (cache hits, regions filtered out, ...)
+    if not _state['enabled']:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def reset():
+    # forgets everything recorded so far, e.g. at the start of a new run
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def spans():
+    with _lock:
+        return list(_spans)
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def summary():
+    """
+    Per-stage breakdown of the recorded spans, in order of first appearance.
+
+    Returns:
+        list of dict: name, calls, total_ms, mean_ms, max_ms and peak_mb (None without memory tracing).
+    """
+    stages = {}
+    for record in spans():
+        stage = stages.setdefault(record.name, {'name': record.name, 'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'peak_mb': None})
+        stage['calls'] += 1
+        stage['total_ms'] += record.duration * 1000
+        stage['max_ms'] = max(stage['max_ms'], record.duration * 1000)
+        if record.peak_bytes is not None:
+            stage['peak_mb'] = max(stage['peak_mb'] or 0.0, record.peak_bytes / 1024 ** 2)
+    for stage in stages.values():
+        stage['mean_ms'] = stage['total_ms'] / stage['calls']
+    return list(stages.values())
+
+
+def export_jsonl(path):
+    # one JSON object per span, then one per counter
+    with open(path, 'w') as f:
+        for record in spans():
+            f.write(json.dumps({'type': 'span', **record._asdict(), 'args': _jsonable(record.args)}) + "\n")
+        for name, value in counters().items():
+            f.write(json.dumps({'type': 'counter', 'name': name, 'value': value}) + "\n")
+
+
+def export_chrome_trace(path):
+    """
+    Writes the recorded spans and counters in the Chrome trace event format (complete "X" events in
+    microseconds, counters as "C" events at the end of the trace).
+    """
+    pid = os.getpid()
+    events = []
+    end = 0.0
+    for record in spans():
+        args = _jsonable(record.args)
+        if record.peak_bytes is not None:
+            args['peak_mb'] = record.peak_bytes / 1024 ** 2
+        events.append({'name': record.name, 'cat': record.name.split('.')[0], 'ph': 'X', 'pid': pid, 'tid': record.thread,
+                       'ts': record.start * 1e6, 'dur': record.duration * 1e6, 'args': args})
+        end = max(end, record.start + record.duration)
+    for name, value in counters().items():
+        events.append({'name': name, 'ph': 'C', 'pid': pid, 'tid': 0, 'ts': end * 1e6, 'args': {name: value}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def export(path):
+    # JSON lines for .jsonl files, Chrome trace format otherwise
+    if path.endswith('.jsonl'):
+        export_jsonl(path)
+    else:
+        export_chrome_trace(path)
+
+
+def _stack():
+    # spans currently open on this thread, innermost last
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _jsonable(args):
+    return {key: value if isinstance(value, (bool, int, float, str, type(None))) else str(value) for key, value in args.items()}
+
+
+if os.environ.get(TRACE_ENV, "").strip().lower() not in ("", "0", "false", "no", "off"):
+    enable(memory=os.environ[TRACE_ENV].strip().lower() == "memory")
@@ -0,0 +1,332 @@
+# Low-level distance kernels used by analysis.py.
+# Everything in here works on plain numpy / scipy arrays whose columns are the profiles being compared;
+# labelling the result (index/columns) is left to the caller.
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import blas
+
+
+# bytes the row-sharing pairs and correction rows of one block of columns may take in the sparse bray-curtis kernel
+BRAYCURTIS_BLOCK_BYTES = 64 * 1024 ** 2
+
+
+def sparse_distances(X, metric="pearson", dtype=np.float64):
+    """
+    Computes a column-by-column distance matrix for a scipy sparse matrix without densifying the input.
+
+    Only sufficient statistics of the nonzero entries are used (column sums, norms and the sparse
+    gram matrix X.T @ X), so the work and memory scale with the number of nonzeros rather than with
+    the full m x n size. The result matches the dense path in analysis.compute_distance_matrix.
+
+    Args:
+        X (scipy.sparse matrix): m x n matrix whose columns are the profiles to compare.
+        metric (str): "pearson", "cosine" or "braycurtis".
+        dtype: Floating point type used for the computation and the result.
+
+    Returns:
+        numpy.ndarray: n x n distance matrix.
+    """
+    # own copy in CSC form so the in-place cleanup below never touches the caller's matrix
+    X = sp.csc_matrix(X, dtype=dtype, copy=True)
+    X.eliminate_zeros()
+
+    if metric == "cosine":
+        return _sparse_cosine(X)
+    elif metric == "braycurtis":
+        return _sparse_braycurtis(X)
+    else:
+        return _sparse_pearson(X)
+
+
+def _sparse_gram(X):
+    # X.T @ X as a dense array; this is the only n x n allocation besides the result itself
+    gram = (X.T @ X).toarray()
+    return gram
+
+
+def _sparse_pearson(X):
+    m = X.shape[0]
+    col_sums = np.asarray(X.sum(axis=0)).ravel()
+    means = col_sums / m
+
+    # covariance from raw cross products: sum(x*y) - m * mean_x * mean_y, done in place on the gram matrix
+    cov = _sparse_gram(X)
+    cov -= (m * np.outer(means, means)).astype(cov.dtype, copy=False)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov /= (m - 1)
+        std = np.sqrt(np.diag(cov).clip(min=0))
+        cov /= std[:, None]
+        cov /= std[None, :]
+
+    # constant columns have no defined correlation (same as pandas, which returns NaN for them).
+    # Checked exactly from the stored values, since the raw-moment variance can be off by rounding error.
+    nnz = np.diff(X.indptr)
+    full = np.flatnonzero(nnz == m)
+    col_max = np.array([X.data[X.indptr[j]:X.indptr[j + 1]].max() for j in full])
+    col_min = np.array([X.data[X.indptr[j]:X.indptr[j + 1]].min() for j in full])
+    constant = (std == 0) | (nnz == 0)
+    constant[full[col_max == col_min]] = True
+    cov[constant, :] = np.nan
+    cov[:, constant] = np.nan
+    np.fill_diagonal(cov, np.where(constant, np.nan, 1.0))
+    np.clip(cov, -1, 1, out=cov)
+
+    # convert correlation to distance in place
+    np.subtract(1, cov, out=cov)
+    return cov
+
+
+def _sparse_cosine(X):
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=0)).ravel())
+    # zero columns keep a similarity of 0 to everything, as in sklearn's cosine_distances
+    norms[norms == 0] = 1
+
+    sim = _sparse_gram(X)
+    sim /= norms[:, None]
+    sim /= norms[None, :]
+
+    np.subtract(1, sim, out=sim)
+    np.clip(sim, 0, 2, out=sim)
+    np.fill_diagonal(sim, 0)
+    return sim
+
+
+def _sparse_braycurtis(X, block_bytes=BRAYCURTIS_BLOCK_BYTES):
+    # Bray-Curtis is sum|u - v| / sum|u + v|. Where only one of u, v is nonzero both terms equal |u| + |v|,
+    # so each pair starts from abs_sums[i] + abs_sums[j] and is corrected only on rows where both are nonzero.
+    # The corrections are gathered for a block of columns i at a time: every nonzero u of the block is paired
+    # with all nonzeros v on its row, and the pairs are summed per (i, j) with one bincount.
+    n = X.shape[1]
+    abs_sums = np.asarray(abs(X).sum(axis=0)).ravel()
+    X_rows = X.tocsr()
+    row_nnz = np.diff(X_rows.indptr)
+
+    # memory of a block: 5 arrays per row-sharing pair, plus two n-wide correction rows per column
+    pairs_before = np.concatenate([[0], np.cumsum(row_nnz[X.indices])])
+    pair_counts = pairs_before[X.indptr[1:]] - pairs_before[X.indptr[:-1]]
+    cost = np.cumsum(40 * pair_counts + 16 * n)
+
+    dist = np.empty((n, n), dtype=X.dtype)
+    start = 0
+    while start < n:
+        offset = cost[start - 1] if start else 0
+        stop = max(start + 1, int(np.searchsorted(cost, offset + block_bytes, side='right')))
+        size = stop - start
+        first, last = X.indptr[start], X.indptr[stop]
+        rows, u = X.indices[first:last], X.data[first:last]
+        block_cols = np.repeat(np.arange(size), np.diff(X.indptr[start:stop + 1]))
+
+        # expand every nonzero of the block into its row's nonzeros: (block column, column j, u, v)
+        counts = row_nnz[rows]
+        ends = np.cumsum(counts)
+        positions = np.repeat(X_rows.indptr[rows] - (ends - counts), counts) + np.arange(ends[-1] if len(ends) else 0)
+        pair_cells = np.repeat(block_cols, counts) * n + X_rows.indices[positions]
+        u_vals, v_vals = np.repeat(u, counts), X_rows.data[positions]
+        both = np.abs(u_vals) + np.abs(v_vals)
+
+        num_correction = np.bincount(pair_cells, weights=both - np.abs(u_vals - v_vals), minlength=size * n).reshape(size, n)
+        den_correction = np.bincount(pair_cells, weights=both - np.abs(u_vals + v_vals), minlength=size * n).reshape(size, n)
+
+        totals = abs_sums[start:stop, None] + abs_sums[None, :]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dist[start:stop] = (totals - num_correction) / (totals - den_correction)
+        start = stop
+
+    np.fill_diagonal(dist, 0)
+    return dist
+
+
+def standardize_columns(X, metric="pearson", copy=True, dtype=np.float64):
+    """
+    Scales the columns of a dense matrix so that Z.T @ Z holds their pairwise similarity.
+
+    For pearson the columns are centered and scaled to unit norm, for spearman the same is done to their
+    ranks and for cosine they are only scaled to unit norm. Columns without variance (pearson/spearman)
+    become NaN, which propagates into NaN distances exactly as pandas' corr reports them; all-zero columns
+    stay zero for cosine, matching sklearn's cosine_distances.
+
+    Args:
+        X (numpy.ndarray): m x n matrix whose columns are the profiles to compare.
+        metric (str): "pearson", "spearman" or "cosine".
+        copy (bool): If False and X already has the requested dtype, X is standardized in place.
+        dtype: Floating point type of the standardized matrix (and so of every product taken from it).
+
+    Returns:
+        numpy.ndarray: m x n standardized matrix.
+    """
+    if metric == "spearman":
+        Z = rank_columns(X).astype(dtype, copy=False)
+    else:
+        Z = np.array(X, dtype=dtype) if copy else np.asarray(X, dtype=dtype)
+
+    if metric != "cosine":
+        Z -= Z.mean(axis=0)
+    norms = np.sqrt(np.einsum('ij,ij->j', Z, Z))
+    if metric == "cosine":
+        norms[norms == 0] = 1
+    else:
+        norms[norms == 0] = np.nan
+    Z /= norms
+    return Z
+
+
+def rank_columns(X):
+    """
+    Ranks every column of a dense matrix, giving tied values their average rank (like pandas' rank()).
+
+    All columns are ranked at once: one argsort, then the start and end position of every run of ties
+    are propagated with cumulative max/min scans, so there is no Python loop over columns or ties.
+    The input must not contain NaN.
+
+    Args:
+        X (numpy.ndarray): m x n matrix.
+
+    Returns:
+        numpy.ndarray: m x n float64 matrix of 1-based ranks.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    m = X.shape[0]
+    order = np.argsort(X, axis=0, kind='stable')
+    sorted_values = np.take_along_axis(X, order, axis=0)
+
+    # runs of equal values in each sorted column
+    run_start = np.ones(X.shape, dtype=bool)
+    run_start[1:] = sorted_values[1:] != sorted_values[:-1]
+    run_end = np.ones(X.shape, dtype=bool)
+    run_end[:-1] = run_start[1:]
+
+    positions = np.arange(1, m + 1, dtype=np.float64)[:, None]
+    first = np.maximum.accumulate(np.where(run_start, positions, 0), axis=0)
+    last = np.minimum.accumulate(np.where(run_end, positions, m + 1)[::-1], axis=0)[::-1]
+
+    ranks = np.empty(X.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (first + last) / 2, axis=0)
+    return ranks
+
+
+def similarity_to_distance(S, metric="pearson"):
+    # converts a block of Z.T @ Z similarities into distances, in place
+    if metric == "cosine":
+        np.subtract(1, S, out=S)
+        np.clip(S, 0, 2, out=S)
+    else:
+        np.clip(S, -1, 1, out=S)
+        np.subtract(1, S, out=S)
+    return S
+
+
+def gram_distances(Z, metric="pearson"):
+    """
+    Computes the n x n distance matrix between the columns of a matrix from standardize_columns.
+
+    Args:
+        Z (numpy.ndarray): m x n standardized matrix (views of a larger buffer are fine).
+        metric (str): The metric Z was standardized for.
+
+    Returns:
+        numpy.ndarray: n x n distance matrix.
+    """
+    dist = similarity_to_distance(Z.T @ Z, metric)
+    # a profile is at distance exactly 0 from itself, unless its correlation is undefined
+    diagonal = np.diag(dist)
+    np.fill_diagonal(dist, 0 if metric == "cosine" else np.where(np.isnan(diagonal), np.nan, 0))
+    return dist
+
+
+def braycurtis_distances(X, dtype=np.float64, block_bytes=64 * 1024 ** 2):
+    """
+    Dense Bray-Curtis distances between the columns of X, computed in the requested floating point type.
+
+    scipy's implementation always works in float64; this one processes blocks of columns against all
+    others with broadcasting, keeping each m x b x n temporary within block_bytes.
+
+    Args:
+        X (numpy.ndarray): m x n matrix whose columns are the profiles to compare.
+        dtype: Floating point type used for the computation and the result.
+        block_bytes (int): Memory allowed for one block's temporaries.
+
+    Returns:
+        numpy.ndarray: n x n distance matrix.
+    """
+    X = np.asarray(X, dtype=dtype)
+    m, n = X.shape
+    block = max(1, int(block_bytes // max(1, m * n * X.itemsize)))
+
+    dist = np.empty((n, n), dtype=dtype)
+    for start in range(0, n, block):
+        a = X[:, start:start + block, None]
+        numerator = np.abs(a - X[:, None, :]).sum(axis=0)
+        denominator = np.abs(a + X[:, None, :]).sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dist[start:start + block] = numerator / denominator
+    np.fill_diagonal(dist, 0)
+    return dist
+
+
+class GramAccumulator:
+    """
+    Running sufficient statistics of a set of profile vectors: their count, sums, cross products and
+    nonzero counts per coordinate.
+
+    Adding or removing a vector costs O(n^2), after which pearson or cosine distances between any subset
+    of the n coordinates can be read off directly. This is what lets ROI sets that differ by a few regions
+    share almost all of their work. Statistics are raw moments, so the inputs must not contain NaN.
+    """
+
+    def __init__(self, n):
+        self.count = 0
+        self.sums = np.zeros(n)
+        self.gram = np.zeros((n, n))
+        self.nonzero = np.zeros(n, dtype=np.int64)
+        self.updates = 0
+
+    def add(self, vectors, sign=1):
+        # vectors is a p x n array holding one profile per row
+        vectors = np.asarray(vectors, dtype=np.float64)
+        self.count += sign * vectors.shape[0]
+        self.sums += sign * vectors.sum(axis=0)
+        # rank-p update straight into the gram buffer (its transpose is the Fortran-ordered view BLAS wants)
+        self.gram = blas.dgemm(alpha=sign, a=vectors, b=vectors, beta=1.0, c=self.gram.T, trans_a=True, overwrite_c=True).T
+        self.nonzero += sign * np.count_nonzero(vectors, axis=0)
+        self.updates += 1
+
+    def remove(self, vectors):
+        self.add(vectors, sign=-1)
+
+    def distances(self, keep, metric="pearson"):
+        """
+        Distance matrix between the selected coordinates over the accumulated vectors.
+
+        Args:
+            keep (numpy.ndarray): Boolean mask or integer positions of the coordinates to compare.
+            metric (str): "pearson" or "cosine".
+
+        Returns:
+            numpy.ndarray: Distance matrix matching gram_distances on the same data.
+        """
+        keep = np.flatnonzero(keep) if np.asarray(keep).dtype == bool else np.asarray(keep)
+        sim = self.gram[keep][:, keep]
+        raw_norms = np.diag(sim).copy()
+        # removed vectors can leave rounding residue behind, so all-zero coordinates are taken from the exact counts
+        zero = self.nonzero[keep] == 0
+
+        if metric == "cosine":
+            sim[zero, :] = 0
+            sim[:, zero] = 0
+            raw_norms[zero] = 1
+            norms = np.sqrt(raw_norms)
+        else:
+            sums = self.sums[keep]
+            # sim -= outer(sums, sums) / count, in place
+            sim = blas.dger(-1.0 / self.count, sums, sums, a=sim.T, overwrite_a=True).T
+            variances = np.diag(sim)
+            # relative cutoff so a constant column that doesn't cancel exactly still counts as constant
+            constant = zero | (variances <= 1e-12 * raw_norms)
+            norms = np.sqrt(np.where(constant, np.nan, variances))
+
+        sim /= norms[:, None]
+        sim /= norms[None, :]
+        dist = similarity_to_distance(sim, metric)
+        diagonal = np.diag(dist)
+        np.fill_diagonal(dist, 0 if metric == "cosine" else np.where(np.isnan(diagonal), np.nan, 0))
+        return dist
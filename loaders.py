@@ -0,0 +1,241 @@
+# Loading connection matrices from disk.
+# Binary formats (.npy, .npz, sparse .npz, Parquet, HDF5) are read without any text parsing, and .npy and
+# uncompressed HDF5 datasets are memory-mapped so opening even a 10k x 10k matrix is near-instant.
+# CSV files are converted once, in chunks, into a .npy sidecar in the cache folder (never next to the user's
+# data); later opens map the sidecar.
+# Rows and columns are numbered "1".."n" as strings, like the GUI always did for its CSV input.
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import instrument
+
+
+CSV_CHUNK_ROWS = 1000
+# folder for CSV sidecars (in a "csv" subfolder) and, see cache.py, cached results; $CONNECTOME_CACHE_DIR overrides it
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "connectome-toolbox")
+# integer dtypes tried, smallest first, when downcasting matrices that only hold whole numbers (e.g. synapse counts)
+INTEGER_DTYPES = (np.uint8, np.uint16, np.int16, np.uint32, np.int32)
+
+
+@instrument.traced("load")
+def load_connection_matrix(path, dtype=None, downcast=True, mmap=True, sparse=False, key=None, convert_csv=True):
+    """
+    Loads a connection matrix from .npy, .npz (dense or scipy sparse), .parquet, .h5/.hdf5, .csv or Excel.
+
+    Args:
+        path (str): File to load; the format is chosen from the extension.
+        dtype: Cast the matrix to this type. By default the stored type is kept, except that matrices
+            loaded into memory are downcast (see downcast).
+        downcast (bool): Store whole-number matrices in the smallest integer type that holds them and
+            float64 matrices as float32 when that is lossless. Memory-mapped files are never downcast.
+        mmap (bool): Memory-map .npy files, CSV sidecars and uncompressed HDF5 datasets instead of reading them.
+        sparse (bool): Return a scipy sparse .npz as a CSR matrix instead of densifying it.
+        key (str): Array name inside a .npz or dataset path inside an HDF5 file; defaults to the first one.
+        convert_csv (bool): Convert CSV files to a .npy sidecar in the cache folder (once) and load that, instead
+            of parsing the text.
+
+    Returns:
+        pandas.DataFrame with rows and columns numbered "1".."n", or scipy.sparse.csr_matrix when sparse=True
+        and the file holds a sparse matrix (name its rows/columns with numbered_labels).
+    """
+    extension = os.path.splitext(path)[1].lower()
+    mapped = False
+    if extension == '.npy':
+        values = np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+        mapped = mmap
+    elif extension == '.npz':
+        values = _load_npz(path, key)
+        if sp.issparse(values):
+            if sparse:
+                return values.astype(dtype) if dtype is not None else values
+            values = values.toarray()
+    elif extension == '.parquet':
+        values = pd.read_parquet(path).to_numpy()
+    elif extension in ('.h5', '.hdf5'):
+        values, mapped = _load_hdf5(path, key, mmap)
+    elif extension == '.csv':
+        if convert_csv:
+            sidecar = csv_sidecar_path(path, downcast=downcast)
+            if not _is_fresh(sidecar, path):
+                try:
+                    convert_csv_to_npy(path, sidecar, downcast=downcast)
+                except OSError:
+                    # unwritable cache folder: parse the text in memory instead
+                    sidecar = None
+            if sidecar is not None:
+                return load_connection_matrix(sidecar, dtype=dtype, downcast=downcast, mmap=mmap)
+        values = pd.read_csv(path, header=None).to_numpy()
+    elif extension in ('.xlsx', '.xls'):
+        values = pd.read_excel(path, header=None).to_numpy()
+    else:
+        raise ValueError(f"Unsupported connection matrix format: {extension or path}")
+
+    if values.ndim != 2:
+        raise ValueError(f"Connection matrix must be 2-dimensional, got shape {values.shape}")
+
+    if dtype is not None:
+        values = values.astype(dtype, copy=False)
+    elif downcast and not mapped:
+        values = downcast_matrix(values)
+
+    return pd.DataFrame(values, index=numbered_labels(values.shape[0]), columns=numbered_labels(values.shape[1]), copy=False)
+
+
+def as_connection_matrix(data, **kwargs):
+    # lets the analysis functions take a file path wherever they take a matrix
+    if isinstance(data, (str, os.PathLike)):
+        return load_connection_matrix(os.fspath(data), **kwargs)
+    return data
+
+
+def numbered_labels(n):
+    """
+    Region labels "1".."n", the naming the GUI uses before region names are uploaded.
+
+    Args:
+        n (int): Number of regions.
+
+    Returns:
+        pandas.Index: String labels.
+    """
+    return pd.RangeIndex(1, n + 1).astype(str)
+
+
+def downcast_matrix(values):
+    """
+    Returns the matrix in the smallest dtype that represents it exactly: an integer type for whole numbers,
+    float32 for float64 values that survive the round trip, and the original array otherwise.
+
+    Args:
+        values (numpy.ndarray): Matrix to downcast.
+
+    Returns:
+        numpy.ndarray: Downcast matrix (or values itself).
+    """
+    if values.size == 0 or values.dtype.kind not in 'iuf':
+        return values
+    target = _downcast_dtype(values)
+    return values if target == values.dtype else values.astype(target)
+
+
+@instrument.traced("load.csv_convert")
+def convert_csv_to_npy(csv_path, npy_path=None, chunk_rows=CSV_CHUNK_ROWS, downcast=True):
+    """
+    Converts a headerless CSV matrix to .npy without ever holding the parsed text in memory.
+
+    The CSV is parsed in chunks of rows into a raw float64 scratch file, then copied into the .npy file in
+    the downcast dtype (see downcast_matrix), which is only known once every chunk has been seen.
+
+    Args:
+        csv_path (str): Headerless CSV file.
+        npy_path (str): Output file; defaults to csv_sidecar_path(csv_path, downcast).
+        chunk_rows (int): Number of rows parsed at a time.
+        downcast (bool): Store the matrix in the smallest exact dtype.
+
+    Returns:
+        str: Path of the written .npy file.
+    """
+    if npy_path is None:
+        npy_path = csv_sidecar_path(csv_path, downcast=downcast)
+    directory = os.path.dirname(os.path.abspath(npy_path))
+    os.makedirs(directory, exist_ok=True)
+
+    n_rows, n_cols = 0, None
+    target = np.dtype(np.uint8) if downcast else np.dtype(np.float64)
+    with tempfile.TemporaryDirectory(dir=directory) as scratch_dir:
+        raw_path = os.path.join(scratch_dir, 'raw.f8')
+        with open(raw_path, 'wb') as raw:
+            for chunk in pd.read_csv(csv_path, header=None, chunksize=chunk_rows, dtype=np.float64):
+                values = chunk.to_numpy()
+                n_cols = values.shape[1]
+                n_rows += values.shape[0]
+                if downcast:
+                    target = np.promote_types(target, _downcast_dtype(values))
+                raw.write(np.ascontiguousarray(values).tobytes())
+        if n_cols is None:
+            raise ValueError(f"{csv_path} contains no data")
+
+        raw_values = np.memmap(raw_path, dtype=np.float64, mode='r', shape=(n_rows, n_cols))
+        # write to a temporary name first so a crash never leaves a truncated sidecar behind
+        tmp_path = os.path.join(scratch_dir, 'matrix.npy')
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=target, shape=(n_rows, n_cols))
+        for start in range(0, n_rows, chunk_rows):
+            out[start:start + chunk_rows] = raw_values[start:start + chunk_rows]
+        out.flush()
+        del out, raw_values
+        os.replace(tmp_path, npy_path)
+    return npy_path
+
+
+def csv_sidecar_path(csv_path, downcast=True, directory=None):
+    """
+    Where the binary copy of a CSV matrix is kept: the "csv" subfolder of $CONNECTOME_CACHE_DIR (or
+    DEFAULT_CACHE_DIR), under a name made from the CSV's absolute path and the conversion options, so sidecars
+    of different files or of downcast and full-precision conversions never overwrite each other.
+
+    Args:
+        csv_path (str): CSV file.
+        downcast (bool): Whether the sidecar holds the downcast matrix (see convert_csv_to_npy).
+        directory (str): Folder to use instead of the cache folder.
+
+    Returns:
+        str: Path of the sidecar .npy file.
+    """
+    if directory is None:
+        directory = os.path.join(os.environ.get("CONNECTOME_CACHE_DIR", DEFAULT_CACHE_DIR), "csv")
+    source = hashlib.blake2b(os.path.abspath(csv_path).encode(), digest_size=8).hexdigest()
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(directory, f"{name}-{source}-{'downcast' if downcast else 'float64'}.npy")
+
+
+def _is_fresh(sidecar, source):
+    # a sidecar is reused only while it is newer than the CSV it was made from
+    return os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(source)
+
+
+def _downcast_dtype(values):
+    # smallest dtype holding every value exactly; NaN or fractional values rule out the integer types
+    if values.dtype.kind in 'iu' or np.array_equal(values, np.round(values)):
+        low, high = values.min(), values.max()
+        for candidate in INTEGER_DTYPES:
+            info = np.iinfo(candidate)
+            if info.min <= low and high <= info.max:
+                return np.dtype(candidate)
+        return values.dtype if values.dtype.kind in 'iu' else np.dtype(np.float64)
+    if values.dtype == np.float64 and np.array_equal(values.astype(np.float32), values, equal_nan=True):
+        return np.dtype(np.float32)
+    return values.dtype
+
+
+def _load_npz(path, key):
+    with np.load(path, allow_pickle=False) as data:
+        # scipy.sparse.save_npz archives are recognised by their layout entries
+        if key is None and 'format' in data.files and 'shape' in data.files:
+            return sp.load_npz(path).tocsr()
+        return data[key if key is not None else data.files[0]]
+
+
+def _load_hdf5(path, key, mmap):
+    # HDF5 support is optional, and h5py is only imported when an HDF5 file is actually opened
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Loading HDF5 files requires the optional h5py package.") from None
+    with h5py.File(path, 'r') as f:
+        if key is None:
+            datasets = []
+            f.visititems(lambda name, obj: datasets.append(name) if isinstance(obj, h5py.Dataset) else None)
+            if not datasets:
+                raise ValueError(f"{path} contains no datasets")
+            key = datasets[0]
+        dataset = f[key]
+        # contiguous, uncompressed datasets are plain bytes in the file and can be mapped directly
+        offset = dataset.id.get_offset()
+        if mmap and offset is not None and dataset.chunks is None and dataset.compression is None:
+            return np.memmap(path, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape), True
+        return dataset[()], False
@@ -0,0 +1,140 @@
+# Fast embeddings of precomputed distance matrices, used by analysis.compute_mds.
+# Classical (Torgerson) MDS needs one truncated eigendecomposition instead of many SMACOF iterations,
+# and landmark MDS only reads a few hundred rows of the distance matrix, so it also works on
+# out-of-core (memory-mapped) RSA results. Condensed matrices (condensed.CondensedMatrix) are embedded
+# without ever building their square form.
+import numpy as np
+
+
+# above this size only the leading eigenpairs are computed (Lanczos) instead of a full eigh
+EIGSH_MIN_SIZE = 500
+# bytes of the band of rows unpacked at a time when multiplying by a condensed matrix
+CONDENSED_BAND_BYTES = 32 * 1024 ** 2
+
+
+def classical_mds(D, n_components=2):
+    """
+    Classical (Torgerson) MDS of a full distance matrix.
+
+    Args:
+        D (array-like or CondensedMatrix): n x n symmetric distance matrix.
+        n_components (int): Number of embedding dimensions.
+
+    Returns:
+        numpy.ndarray: n x n_components embedding.
+    """
+    if hasattr(D, 'condensed') and D.shape[0] > EIGSH_MIN_SIZE and n_components < D.shape[0] - 1:
+        return _condensed_classical_mds(D, n_components)
+
+    # double-centred squared distances, B = -1/2 J D^2 J, built in place
+    B = np.array(D, dtype=np.float64)
+    B **= 2
+    row_means = B.mean(axis=1)
+    B -= row_means[:, None]
+    B -= row_means[None, :]
+    B += row_means.mean()
+    B *= -0.5
+
+    eigenvalues, eigenvectors = _top_eigenpairs(B, n_components)
+    return _orient(eigenvectors * np.sqrt(eigenvalues))
+
+
+def _condensed_classical_mds(D, n_components):
+    # B = -1/2 J D^2 J as a linear operator for Lanczos: J v = v - mean(v), and D^2 = U + U.T + diag, where U
+    # (strictly upper triangle) is unpacked from the condensed vector a band of rows at a time
+    from scipy.sparse.linalg import LinearOperator
+
+    n = D.shape[0]
+    squared = np.square(D.condensed, dtype=np.float64)
+    squared_diagonal = np.square(D.diagonal, dtype=np.float64)
+    starts = np.concatenate(([0], np.cumsum(np.arange(n - 1, 0, -1))))
+    block = max(1, CONDENSED_BAND_BYTES // (8 * n))
+
+    def matvec(v):
+        w = np.ravel(v) - np.mean(v)
+        out = squared_diagonal * w
+        for first in range(0, n - 1, block):
+            stop = min(first + block, n - 1)
+            band = np.zeros((stop - first, n - first))
+            band[np.arange(n - first)[None, :] > np.arange(stop - first)[:, None]] = squared[starts[first]:starts[stop]]
+            out[first:stop] += band @ w[first:]
+            out[first:] += band.T @ w[first:stop]
+        return -0.5 * (out - out.mean())
+
+    B = LinearOperator((n, n), matvec=matvec, dtype=np.float64)
+    eigenvalues, eigenvectors = _top_eigenpairs(B, n_components)
+    return _orient(eigenvectors * np.sqrt(eigenvalues))
+
+
+def landmark_mds(D, n_components=2, n_landmarks=None, random_state=42):
+    """
+    Landmark MDS (de Silva & Tenenbaum): classical MDS on a subset of landmark points, with every other
+    point placed by distance-based triangulation against the landmarks.
+
+    Only the landmark rows of D are ever read, so D can be a memory-mapped array of any size.
+
+    Args:
+        D (array-like): n x n symmetric distance matrix supporting row indexing (ndarray, memmap or the
+            lazy .values of a CondensedMatrix).
+        n_components (int): Number of embedding dimensions.
+        n_landmarks (int): Number of landmarks; defaults to max(100, 20 * n_components), capped at n.
+        random_state (int): Seed for the first landmark.
+
+    Returns:
+        numpy.ndarray: n x n_components embedding.
+    """
+    n = D.shape[0]
+    if n_landmarks is None:
+        n_landmarks = max(100, 20 * n_components)
+    n_landmarks = min(n, max(n_landmarks, n_components + 1))
+
+    landmarks, landmark_rows = _maxmin_landmarks(D, n_landmarks, random_state)
+    squared_rows = landmark_rows ** 2
+
+    # classical MDS among the landmarks themselves
+    delta = squared_rows[:, landmarks]
+    delta_means = delta.mean(axis=1)
+    B = delta - delta_means[:, None] - delta_means[None, :] + delta_means.mean()
+    B *= -0.5
+    eigenvalues, eigenvectors = _top_eigenpairs(B, n_components)
+
+    # triangulate every point from its squared distances to the landmarks
+    # dimensions without positive spread collapse to zero rather than dividing by zero
+    scale = np.zeros_like(eigenvalues)
+    np.divide(1, np.sqrt(eigenvalues), out=scale, where=eigenvalues > 0)
+    pseudo_inverse = eigenvectors * scale
+    embedding = -0.5 * (squared_rows - delta_means[:, None]).T @ pseudo_inverse
+    return _orient(embedding)
+
+
+def _maxmin_landmarks(D, n_landmarks, random_state):
+    # greedy max-min selection spreads the landmarks over the data; returns their positions and rows of D
+    n = D.shape[0]
+    rng = np.random.default_rng(random_state)
+    landmarks = [int(rng.integers(n))]
+    rows = [np.asarray(D[landmarks[0]], dtype=np.float64)]
+    nearest = rows[0].copy()
+    for _ in range(n_landmarks - 1):
+        candidate = int(np.argmax(nearest))
+        landmarks.append(candidate)
+        rows.append(np.asarray(D[candidate], dtype=np.float64))
+        np.minimum(nearest, rows[-1], out=nearest)
+    return np.array(landmarks), np.vstack(rows)
+
+
+def _top_eigenpairs(B, k):
+    # leading k eigenpairs of a symmetric matrix, negative eigenvalues clipped to 0 (non-Euclidean distances)
+    if B.shape[0] > EIGSH_MIN_SIZE and k < B.shape[0] - 1:
+        from scipy.sparse.linalg import eigsh
+        eigenvalues, eigenvectors = eigsh(B, k=k, which='LA')
+    else:
+        eigenvalues, eigenvectors = np.linalg.eigh(B)
+    order = np.argsort(eigenvalues)[::-1][:k]
+    return np.clip(eigenvalues[order], 0, None), eigenvectors[:, order]
+
+
+def _orient(embedding):
+    # eigenvectors have arbitrary sign; make the largest coordinate of each axis positive for stable plots
+    signs = np.sign(embedding[np.argmax(np.abs(embedding), axis=0), np.arange(embedding.shape[1])])
+    signs[signs == 0] = 1
+    return embedding * signs
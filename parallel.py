@@ -0,0 +1,133 @@
+# Process-parallel RSA sweeps.
+# The connection matrix is copied once into shared memory; every worker process maps the same buffer
+# instead of receiving a pickled copy with each task, and runs build_corr_matrix on it.
+import itertools
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from threadpoolctl import threadpool_limits
+
+from analysis import build_corr_matrix
+from loaders import as_connection_matrix
+
+
+# state of a worker process, filled in once by _init_worker
+_worker = {}
+
+
+def run_rsa_sweep(df, ROI_lists, metrics=("pearson",), filter_flag=False, min_num_connections=1, labels=None,
+                  nan_policy="pairwise", max_workers=None, blas_threads=1, mp_context=None, return_exceptions=False):
+    """
+    Runs build_corr_matrix for every combination of ROI set and distance metric on a pool of processes.
+
+    An empty ROI list computes the full distance matrix (compute_distance_matrix), as in build_corr_matrix.
+    Results are yielded as soon as they are done, so their order follows completion, not submission.
+
+    Args:
+        df (pandas.DataFrame, scipy.sparse matrix or str): Square connection matrix, or the path of a matrix file.
+        ROI_lists (iterable of list): ROI sets, each a list of region labels.
+        metrics (iterable of str): Distance metrics to compute for every ROI set.
+        filter_flag, min_num_connections, labels, nan_policy: As for build_corr_matrix.
+        max_workers (int): Number of worker processes. Defaults to the CPU count divided by blas_threads.
+        blas_threads (int): BLAS/OpenMP threads each worker may use, to avoid oversubscribing the cores.
+        mp_context: Optional multiprocessing context (e.g. multiprocessing.get_context("spawn")).
+        return_exceptions (bool): Yield the exception of a failed task in place of its result and carry on with
+            the others, instead of raising it. A broken pool (a worker died) is always raised.
+
+    Yields:
+        tuple: (ROI_list, metric, (to, from)) for each finished task, or (ROI_list, metric, exception).
+    """
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) // blas_threads)
+
+    df = as_connection_matrix(df)
+    segments = []
+    try:
+        spec = _share_matrix(df, labels, segments)
+        tasks = itertools.product(ROI_lists, metrics)
+        options = (filter_flag, min_num_connections, nan_policy)
+
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=_init_worker,
+                                 initargs=(spec, blas_threads)) as pool:
+            # keep a bounded number of tasks in flight so finished results don't pile up unread
+            pending = {}
+            for ROI_list, metric in itertools.islice(tasks, 2 * max_workers):
+                pending[pool.submit(_run_task, list(ROI_list), metric, options)] = (ROI_list, metric)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ROI_list, metric = pending.pop(future)
+                    for next_ROI_list, next_metric in itertools.islice(tasks, 1):
+                        pending[pool.submit(_run_task, list(next_ROI_list), next_metric, options)] = (next_ROI_list, next_metric)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        if not return_exceptions:
+                            raise
+                        result = e
+                    yield (ROI_list, metric, result)
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+
+def _share_matrix(df, labels, segments):
+    # copies the matrix into shared memory segments and returns what a worker needs to map them again
+    if sp.issparse(df):
+        mat = sp.csr_matrix(df)
+        arrays = {'data': mat.data, 'indices': mat.indices, 'indptr': mat.indptr}
+        return {'sparse': True, 'shape': mat.shape, 'labels': labels,
+                'arrays': {key: _share_array(value, segments) for key, value in arrays.items()}}
+
+    return {'sparse': False, 'index': df.index, 'columns': df.columns,
+            'arrays': {'values': _share_array(df.to_numpy(), segments)}}
+
+
+def _share_array(array, segments):
+    array = np.ascontiguousarray(array)
+    segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+    segments.append(segment)
+    return (segment.name, array.shape, array.dtype.str)
+
+
+def _attach_array(name, shape, dtype):
+    # the parent owns (and unlinks) the segment; workers only map it
+    try:
+        segment = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always tracks, but workers share the parent's resource tracker so it is still released once
+        segment = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+    array.flags.writeable = False
+    return segment, array
+
+
+def _init_worker(spec, blas_threads):
+    # keep the segments referenced for the lifetime of the worker, or the mapped arrays become invalid
+    attached = {key: _attach_array(*value) for key, value in spec['arrays'].items()}
+    _worker['segments'] = [segment for segment, _ in attached.values()]
+    arrays = {key: array for key, (_, array) in attached.items()}
+
+    if spec['sparse']:
+        _worker['matrix'] = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=spec['shape'])
+        _worker['labels'] = spec['labels']
+    else:
+        _worker['matrix'] = pd.DataFrame(arrays['values'], index=spec['index'], columns=spec['columns'], copy=False)
+        _worker['labels'] = None
+
+    _worker['blas_limits'] = threadpool_limits(limits=blas_threads)
+
+
+def _run_task(ROI_list, metric, options):
+    filter_flag, min_num_connections, nan_policy = options
+    return build_corr_matrix(_worker['matrix'], ROI_list, filter_flag=filter_flag, min_num_connections=min_num_connections,
+                             distance_metric=metric, labels=_worker['labels'], fused=True, nan_policy=nan_policy)
@@ -0,0 +1,337 @@
+# Second-order RSA: comparing RSA matrices (RDMs) with each other and with model RDMs.
+# RDMs are symmetric with a zero diagonal, so everything here works on condensed vectors: the upper triangle,
+# row by row (scipy's squareform order), which holds every distance once. Many RDMs are compared in one batch:
+# pearson and spearman similarities of all pairs are a single matrix product of standardized vectors, and
+# Kendall's tau-b is computed for a whole batch of pairs with a vectorized merge-sort inversion count.
+# The Mantel test shuffles region labels in batches as well; resampling.py reuses its machinery.
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from condensed import CondensedMatrix
+from kernels import rank_columns
+
+
+# approximate bytes a chunk of resamples or of Kendall pairs may use
+CHUNK_BYTES = 64 * 1024 ** 2
+# resamples drawn from one random stream; fixed, so the draws never depend on chunk_size or n_jobs
+SEED_BLOCK = 256
+COMPARISON_METHODS = ("pearson", "spearman", "kendall")
+ALTERNATIVES = ("greater", "less", "two-sided")
+
+PermutationResult = namedtuple('PermutationResult', ['statistic', 'p_value', 'null_distribution'])
+
+# state of a worker process, filled in once by _init_worker
+_worker = {}
+
+
+def condense(rdm):
+    """
+    Condensed form of a square RSA matrix: its upper triangle without the diagonal, row by row.
+
+    Args:
+        rdm (pandas.DataFrame, numpy.ndarray or CondensedMatrix): n x n symmetric matrix.
+
+    Returns:
+        numpy.ndarray: Vector of the n * (n - 1) / 2 distances.
+    """
+    if isinstance(rdm, CondensedMatrix):
+        return rdm.condensed.astype(np.float64)
+    values = rdm.to_numpy(dtype=np.float64) if isinstance(rdm, pd.DataFrame) else np.asarray(rdm, dtype=np.float64)
+    rows, cols = np.triu_indices(values.shape[0], 1)
+    return values[rows, cols]
+
+
+def align_rdms(*rdms):
+    """
+    Restricts RSA matrices to the regions they all share, in the first matrix's order, dropping regions with
+    a missing distance in any of them (e.g. profiles without variance).
+
+    Args:
+        *rdms (pandas.DataFrame or CondensedMatrix): Square RSA matrices.
+
+    Returns:
+        tuple: (list of n x n numpy arrays, pandas.Index of the n shared labels).
+    """
+    labels = pd.Index(rdms[0].index)
+    for rdm in rdms[1:]:
+        labels = labels.intersection(pd.Index(rdm.index), sort=False)
+    matrices = [np.asarray(rdm.subset(labels), dtype=np.float64) if isinstance(rdm, CondensedMatrix)
+                else rdm.loc[labels, labels].to_numpy(dtype=np.float64) for rdm in rdms]
+    complete = ~np.logical_or.reduce([np.isnan(matrix).any(axis=1) for matrix in matrices])
+    if np.count_nonzero(complete) < 3:
+        raise ValueError("The RSA matrices share fewer than 3 regions with complete distances.")
+    return [matrix[np.ix_(complete, complete)] for matrix in matrices], labels[complete]
+
+
+def rdm_scores(vectors, method="pearson"):
+    """
+    Ranks (spearman) and standardizes condensed RDMs so that the correlation of two of them is the dot product.
+
+    Args:
+        vectors (numpy.ndarray): One condensed RDM (1-D) or one per row (2-D).
+        method (str): "pearson" or "spearman".
+
+    Returns:
+        numpy.ndarray: Centred, unit-length vectors of the same shape; rows without spread are NaN.
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    rows = np.atleast_2d(vectors)
+    if method == "spearman":
+        rows = rank_columns(rows.T).T
+    centred = rows - rows.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centred, axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = np.where(norms > 0, centred / norms, np.nan)
+    return scores.reshape(vectors.shape)
+
+
+def compare_rdms(rdms, others=None, method="spearman"):
+    """
+    Similarity of every pair of RDMs, computed as one batch.
+
+    Args:
+        rdms (list or dict): RSA matrices (square DataFrames, aligned with align_rdms) or condensed vectors
+            (e.g. model RDMs, in the same region order). A dict names the rows of the result.
+        others (list or dict): Second set of RDMs; when omitted, rdms are compared with each other.
+        method (str): "spearman", "pearson" or "kendall" (tau-b).
+
+    Returns:
+        pandas.DataFrame: len(rdms) x len(others) similarities.
+    """
+    if method not in COMPARISON_METHODS:
+        raise ValueError(f"method must be one of {COMPARISON_METHODS}, got {method!r}")
+    names, items = _named(rdms)
+    other_names, other_items = _named(others) if others is not None else (names, [])
+    vectors = _condensed_vectors(items + other_items)
+    A = vectors[:len(items)]
+    B = vectors[len(items):] if others is not None else A
+
+    if method == "kendall":
+        pairs_a, pairs_b = np.meshgrid(np.arange(len(A)), np.arange(len(B)), indexing='ij')
+        similarities = kendall_tau_b(A[pairs_a.ravel()], B[pairs_b.ravel()]).reshape(len(A), len(B))
+    else:
+        similarities = rdm_scores(A, method) @ rdm_scores(B, method).T
+    return pd.DataFrame(similarities, index=names, columns=other_names)
+
+
+def kendall_tau_b(X, Y):
+    """
+    Kendall's tau-b between the rows of X and the rows of Y (row i with row i), with ties handled as in
+    scipy.stats.kendalltau.
+
+    Uses Knight's algorithm: sort each pair by (x, y), then count the inversions left in y. The inversions of all
+    rows are counted together by a bottom-up merge sort whose levels are vectorized with searchsorted.
+
+    Args:
+        X, Y (numpy.ndarray): p x m matrices (or vectors), one condensed RDM per row.
+
+    Returns:
+        numpy.ndarray: p correlations (a float for vector input).
+    """
+    X, Y = np.asarray(X, dtype=np.float64), np.asarray(Y, dtype=np.float64)
+    if X.ndim == 1:
+        return float(kendall_tau_b(X[None], Y[None])[0])
+    p, m = X.shape
+    # chunks of pairs bound the memory of the merge levels
+    chunk = max(1, CHUNK_BYTES // (80 * max(m, 1)))
+    if p > chunk:
+        return np.concatenate([kendall_tau_b(X[start:start + chunk], Y[start:start + chunk]) for start in range(0, p, chunk)])
+
+    order = np.lexsort((Y, X), axis=1)
+    x_sorted = np.take_along_axis(X, order, axis=1)
+    y_sorted = np.take_along_axis(Y, order, axis=1)
+    total_pairs = m * (m - 1) / 2
+    x_ties = _tied_pairs(x_sorted != np.roll(x_sorted, 1, axis=1))
+    joint_ties = _tied_pairs((x_sorted != np.roll(x_sorted, 1, axis=1)) | (y_sorted != np.roll(y_sorted, 1, axis=1)))
+    y_values = np.sort(Y, axis=1)
+    y_ties = _tied_pairs(y_values != np.roll(y_values, 1, axis=1))
+    swaps = _count_inversions(_dense_ranks(y_sorted))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (total_pairs - x_ties - y_ties + joint_ties - 2 * swaps) / np.sqrt((total_pairs - x_ties) * (total_pairs - y_ties))
+
+
+def mantel_test(rdm_a, rdm_b, n_permutations=10000, method="pearson", alternative="greater", chunk_size=None,
+                n_jobs=1, random_state=None):
+    """
+    Mantel test: significance of the similarity of two RSA matrices under shuffling of rdm_a's region labels
+    (rows and columns together).
+
+    A permutation only reorders the upper triangle, so its mean, spread and ranks never change: rdm_a is
+    standardized once and every permuted statistic is a dot product with a permuted gather of it. Batches of
+    permutations are evaluated in chunks, optionally on several processes.
+
+    Args:
+        rdm_a, rdm_b (pandas.DataFrame): Square RSA matrices, aligned with align_rdms.
+        n_permutations (int): Number of label shuffles.
+        method (str): "pearson" or "spearman".
+        alternative (str): "greater", "less" or "two-sided".
+        chunk_size (int): Permutations evaluated at a time; sized to CHUNK_BYTES by default.
+        n_jobs (int): Number of processes.
+        random_state (int): Seed; results do not depend on chunk_size or n_jobs.
+
+    Returns:
+        PermutationResult: (statistic, p_value, null_distribution).
+    """
+    if method not in ("pearson", "spearman"):
+        raise ValueError(f"method must be 'pearson' or 'spearman', got {method!r}")
+    if alternative not in ALTERNATIVES:
+        raise ValueError(f"alternative must be one of {ALTERNATIVES}, got {alternative!r}")
+    (A, B), _ = align_rdms(rdm_a, rdm_b)
+    n = A.shape[0]
+    rows, cols = np.triu_indices(n, 1)
+
+    za = rdm_scores(A[rows, cols], method)
+    zb = rdm_scores(B[rows, cols], method)
+    ZA = np.zeros((n, n))
+    ZA[rows, cols] = za
+    ZA += ZA.T
+    statistic = float(za @ zb)
+
+    state = {'ZA': ZA.ravel(), 'zb': zb, 'rows': rows, 'cols': cols, 'n': n}
+    chunk_size = chunk_size or chunk_size_for(len(rows), bytes_per_value=24)
+    null = run_in_chunks(_permutation_chunk, _draw_permutations, state, n_permutations, chunk_size, n_jobs, random_state)
+
+    if alternative == "greater":
+        extreme = null >= statistic
+    elif alternative == "less":
+        extreme = null <= statistic
+    else:
+        extreme = np.abs(null) >= abs(statistic)
+    # the observed labelling counts as one of the permutations, so p is never 0
+    p_value = (np.count_nonzero(extreme) + 1) / (n_permutations + 1)
+    return PermutationResult(statistic, p_value, null)
+
+
+def chunk_size_for(n_pairs, bytes_per_value):
+    # number of resamples whose per-pair working arrays fit into CHUNK_BYTES
+    return max(1, CHUNK_BYTES // (bytes_per_value * n_pairs))
+
+
+def run_in_chunks(chunk_fn, draw_fn, state, n_samples, chunk_size, n_jobs=1, random_state=None):
+    """
+    Evaluates n_samples random resamples in chunks of chunk_size and concatenates the results.
+
+    The random inputs of the resamples (permutations, bootstrap counts) come from draw_fn(state, rng, size), in
+    blocks of SEED_BLOCK resamples, each block from its own seed of one SeedSequence. chunk_fn(state, draws)
+    evaluates a chunk's slice of them. As the blocks are fixed, the results only depend on random_state (and
+    the first k resamples are the same for any n_samples >= k), not on chunk_size or n_jobs. With n_jobs > 1
+    the chunks run on a process pool; state is sent to each process once.
+    """
+    starts = range(0, n_samples, chunk_size)
+    sizes = [min(chunk_size, n_samples - start) for start in starts]
+    if not sizes:
+        return np.empty(0)
+    seeds = np.random.SeedSequence(random_state).spawn(-(-n_samples // SEED_BLOCK))
+    if n_jobs == 1 or len(sizes) == 1:
+        cache = {}
+        return np.concatenate([chunk_fn(state, _chunk_draws(draw_fn, state, seeds, start, size, cache))
+                               for start, size in zip(starts, sizes)])
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state, chunk_fn, draw_fn, seeds)) as pool:
+        return np.concatenate(list(pool.map(_run_worker_chunk, starts, sizes)))
+
+
+def _chunk_draws(draw_fn, state, seeds, start, size, cache):
+    # the draws of resamples start .. start + size, cut from the seed blocks covering them. cache keeps the
+    # last block, so consecutive chunks smaller than a block draw it only once.
+    first, last = start // SEED_BLOCK, (start + size - 1) // SEED_BLOCK
+    blocks = []
+    for block in range(first, last + 1):
+        if cache.get('block') != block:
+            cache['block'], cache['draws'] = block, draw_fn(state, np.random.default_rng(seeds[block]), SEED_BLOCK)
+        blocks.append(cache['draws'])
+    offset = start - first * SEED_BLOCK
+    draws = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+    return draws[offset:offset + size]
+
+
+def _init_worker(state, chunk_fn, draw_fn, seeds):
+    _worker.update(state=state, chunk_fn=chunk_fn, draw_fn=draw_fn, seeds=seeds, cache={})
+
+
+def _run_worker_chunk(start, size):
+    draws = _chunk_draws(_worker['draw_fn'], _worker['state'], _worker['seeds'], start, size, _worker['cache'])
+    return _worker['chunk_fn'](_worker['state'], draws)
+
+
+def _draw_permutations(state, rng, size):
+    return rng.permuted(np.tile(np.arange(state['n']), (size, 1)), axis=1)
+
+
+def _permutation_chunk(state, permutations):
+    n = state['n']
+    # flat positions of every permuted upper-triangle pair, gathered in one go
+    flat = permutations[:, state['rows']] * n + permutations[:, state['cols']]
+    return state['ZA'][flat] @ state['zb']
+
+
+def _named(rdms):
+    if isinstance(rdms, dict):
+        return list(rdms.keys()), list(rdms.values())
+    return list(range(len(rdms))), list(rdms)
+
+
+def _condensed_vectors(items):
+    # square RSA matrices are aligned with each other and condensed; condensed vectors are taken as they are
+    frames = [i for i, item in enumerate(items) if isinstance(item, (pd.DataFrame, CondensedMatrix))]
+    vectors = [None] * len(items)
+    if frames:
+        aligned, _ = align_rdms(*[items[i] for i in frames])
+        for i, matrix in zip(frames, aligned):
+            vectors[i] = condense(matrix)
+    for i, item in enumerate(items):
+        if vectors[i] is None:
+            vectors[i] = np.asarray(item, dtype=np.float64).ravel()
+    lengths = {len(vector) for vector in vectors}
+    if len(lengths) > 1:
+        raise ValueError(f"RDMs of different sizes cannot be compared (condensed lengths {sorted(lengths)}).")
+    stacked = np.vstack(vectors)
+    if np.isnan(stacked).any():
+        raise ValueError("Condensed RDMs must not contain missing values.")
+    return stacked
+
+
+def _tied_pairs(new_group):
+    # number of tied pairs in each row, given a mask marking the first element of every run of equal sorted values
+    p, m = new_group.shape
+    new_group = new_group.copy()
+    new_group[:, 0] = True
+    starts = np.flatnonzero(new_group)
+    lengths = np.diff(np.append(starts, p * m))
+    return np.bincount(starts // m, weights=lengths * (lengths - 1) / 2, minlength=p)
+
+
+def _dense_ranks(values):
+    # 0-based dense ranks within each row
+    order = np.argsort(values, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    new_group = np.ones(values.shape, dtype=bool)
+    new_group[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    ranks = np.empty(values.shape, dtype=np.int64)
+    np.put_along_axis(ranks, order, np.cumsum(new_group, axis=1) - 1, axis=1)
+    return ranks
+
+
+def _count_inversions(ranks):
+    # pairs i < j with ranks[i] > ranks[j] in every row. Bottom-up merge sort: at each level, every element in the
+    # right half of a block is compared against the sorted left half of its block. Row and block are encoded in
+    # the sort keys, so one sort and two searchsorted calls cover all blocks of all rows.
+    p, m = ranks.shape
+    position = np.arange(m)
+    row_ids = np.arange(p)[:, None]
+    inversions = np.zeros(p)
+    width = 1
+    while width < m:
+        block = position // (2 * width)
+        left = position % (2 * width) < width
+        base = (row_ids * (block[-1] + 1) + block) * (m + 1)
+        keys = base + ranks
+        left_keys = np.sort(keys[:, left], axis=None)
+        block_end = np.searchsorted(left_keys, base[:, ~left] + m, side='right')
+        not_greater = np.searchsorted(left_keys, keys[:, ~left], side='right')
+        inversions += (block_end - not_greater).sum(axis=1)
+        width *= 2
+    return inversions
@@ -0,0 +1,124 @@
+# Significance testing for RSA matrices.
+# Label-shuffle (permutation) tests and bootstrap confidence intervals for the similarity of two RSA matrices,
+# e.g. the (to, from) pair returned by build_corr_matrix or any two results of compute_distance_matrix.
+# Resamples are drawn as whole batches and evaluated with a few array operations per batch:
+#  - a permutation only reorders the labels; this is the Mantel test of rdm_compare.
+#  - resampling regions with replacement is the same as weighting every region pair (i, j) by count_i * count_j,
+#    so each bootstrap statistic is a weighted correlation over the fixed upper triangle.
+# Batches are processed in chunks that bound memory, optionally on several processes (rdm_compare.run_in_chunks).
+from collections import namedtuple
+
+import numpy as np
+
+from rdm_compare import PermutationResult, align_rdms, chunk_size_for, mantel_test, rdm_scores, run_in_chunks
+
+
+SIMILARITY_METHODS = ("pearson", "spearman")
+
+BootstrapResult = namedtuple('BootstrapResult', ['statistic', 'ci_low', 'ci_high', 'distribution'])
+
+
+def permutation_test(rdm_a, rdm_b, n_permutations=10000, method="spearman", alternative="greater", chunk_size=None,
+                     n_jobs=1, random_state=None):
+    """
+    Label-shuffle test of the similarity between two RSA matrices.
+
+    The statistic is the pearson or spearman correlation of the two upper triangles. Its null distribution comes
+    from shuffling the region labels of rdm_a (rows and columns together), which keeps the structure within each
+    matrix intact. This is rdm_compare.mantel_test with a rank-based default.
+
+    Args:
+        rdm_a, rdm_b (pandas.DataFrame): Square RSA matrices. Only regions present in both (and without missing
+            distances in either) are compared.
+        n_permutations (int): Number of label shuffles.
+        method (str): "spearman" or "pearson".
+        alternative (str): "greater", "less" or "two-sided".
+        chunk_size (int): Permutations evaluated at a time; sized to rdm_compare.CHUNK_BYTES by default.
+        n_jobs (int): Number of processes.
+        random_state (int): Seed.
+
+    Returns:
+        PermutationResult: (statistic, p_value, null_distribution).
+    """
+    return mantel_test(rdm_a, rdm_b, n_permutations=n_permutations, method=method, alternative=alternative,
+                       chunk_size=chunk_size, n_jobs=n_jobs, random_state=random_state)
+
+
+def bootstrap_ci(rdm_a, rdm_b, n_bootstrap=1000, method="spearman", ci=0.95, chunk_size=None, n_jobs=1, random_state=None):
+    """
+    Bootstrap confidence interval for the similarity of two RSA matrices, resampling regions with replacement.
+
+    Pairs of a region with its own copy are left out, as the distance between them is not a measurement.
+
+    Args:
+        rdm_a, rdm_b (pandas.DataFrame): Square RSA matrices, aligned as in permutation_test.
+        n_bootstrap (int): Number of bootstrap samples.
+        method (str): "spearman" or "pearson".
+        ci (float): Coverage of the percentile interval.
+        chunk_size (int): Bootstrap samples evaluated at a time; sized to rdm_compare.CHUNK_BYTES by default.
+        n_jobs (int): Number of processes.
+        random_state (int): Seed.
+
+    Returns:
+        BootstrapResult: (statistic, ci_low, ci_high, distribution). Samples in which a matrix has no spread
+        give NaN and are ignored by the interval.
+    """
+    if method not in SIMILARITY_METHODS:
+        raise ValueError(f"method must be one of {SIMILARITY_METHODS}, got {method!r}")
+    (A, B), _ = align_rdms(rdm_a, rdm_b)
+    n = A.shape[0]
+    rows, cols = np.triu_indices(n, 1)
+    a, b = A[rows, cols], B[rows, cols]
+    statistic = float(rdm_scores(a, method) @ rdm_scores(b, method))
+
+    state = {'a': a, 'b': b, 'rows': rows, 'cols': cols, 'n': n, 'method': method}
+    # weights plus (for spearman) two rank matrices per sample
+    chunk_size = chunk_size or chunk_size_for(len(rows), bytes_per_value=48)
+    distribution = run_in_chunks(_bootstrap_chunk, _draw_counts, state, n_bootstrap, chunk_size, n_jobs, random_state)
+
+    tail = (1 - ci) / 2 * 100
+    ci_low, ci_high = np.nanpercentile(distribution, [tail, 100 - tail])
+    return BootstrapResult(statistic, float(ci_low), float(ci_high), distribution)
+
+
+def _draw_counts(state, rng, size):
+    # how often every region occurs in each bootstrap sample
+    n = state['n']
+    return rng.multinomial(n, np.full(n, 1 / n), size=size)
+
+
+def _bootstrap_chunk(state, counts):
+    counts = counts.astype(np.float64)
+    weights = counts[:, state['rows']] * counts[:, state['cols']]
+    a, b = state['a'], state['b']
+    if state['method'] == "spearman":
+        a, b = _weighted_ranks(a, weights), _weighted_ranks(b, weights)
+    return _weighted_correlation(a, b, weights)
+
+
+def _weighted_ranks(values, weights):
+    # average ranks in every weighted sample (a pair with weight w occurs w times), one row per sample.
+    # The sort order is shared by all samples; only the cumulative weights differ.
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    new_group = np.r_[True, sorted_values[1:] != sorted_values[:-1]]
+    starts = np.flatnonzero(new_group)
+    group = np.cumsum(new_group) - 1
+    group_weights = np.add.reduceat(weights[:, order], starts, axis=1)
+    group_ranks = np.cumsum(group_weights, axis=1) - group_weights + (group_weights + 1) / 2
+    ranks = np.empty_like(weights)
+    ranks[:, order] = group_ranks[:, group]
+    return ranks
+
+
+def _weighted_correlation(a, b, weights):
+    # pearson correlation of a and b under each row of weights; a and b are vectors or one row per sample
+    total = weights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        a_centred = a - (weights * a).sum(axis=1, keepdims=True) / total[:, None]
+        b_centred = b - (weights * b).sum(axis=1, keepdims=True) / total[:, None]
+        covariance = (weights * a_centred * b_centred).sum(axis=1)
+        a_variance = (weights * a_centred ** 2).sum(axis=1)
+        b_variance = (weights * b_centred ** 2).sum(axis=1)
+        correlation = covariance / np.sqrt(a_variance * b_variance)
+    return np.where((a_variance > 0) & (b_variance > 0), correlation, np.nan)
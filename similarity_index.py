@@ -0,0 +1,172 @@
+# Nearest-region search over connectivity profiles, without building the n x n distance matrix.
+# Every region's profile (a column of the connection matrix, as compared by compute_distance_matrix) is
+# standardized once into a unit vector, so that a dot product is its pearson / spearman / cosine similarity.
+# A query is then one matrix-vector product against all regions and a partial sort for the k best: milliseconds
+# per region, with memory linear in the size of the connection matrix. All-region searches run in blocks of
+# query regions. The approximate mode first compares random projections of the vectors (a few hundred numbers
+# per region, cheaper than long profiles) and computes exact distances only for the best candidates.
+import numpy as np
+import pandas as pd
+
+import instrument
+from kernels import similarity_to_distance, standardize_columns
+from loaders import as_connection_matrix, numbered_labels
+
+
+# metrics whose distances follow from dot products of standardized profiles
+INDEX_METRICS = ("pearson", "spearman", "cosine")
+# bytes the similarity block of one batch of query regions may take
+QUERY_BLOCK_BYTES = 64 * 1024 ** 2
+# candidates per requested neighbour that the approximate mode re-ranks exactly
+CANDIDATE_FACTOR = 20
+
+
+class SimilarityIndex:
+    """
+    Finds the regions with the most similar connectivity profiles to a region.
+
+    Distances are the ones compute_distance_matrix reports (1 - correlation, or cosine distance). Regions whose
+    correlation is undefined (no variance in their profile) have no neighbours and are nobody's neighbour, like
+    the NaN entries of the full matrix.
+
+    Args:
+        df (pandas.DataFrame or str): Connection matrix (or a file load_connection_matrix reads); the columns
+            are the profiles compared, so the labels are the ones load_columns sets in the GUI.
+        metric (str): "pearson", "spearman" or "cosine".
+        labels (list-like): Region names for an ndarray input; "1".."n" by default.
+        approximate (bool): Rank candidates by random projections and re-rank only the best exactly. Faster for
+            long profiles, but a true neighbour can occasionally be missed.
+        n_projections (int): Dimension of the random projections (approximate mode).
+        nan_policy (str): "complete" drops rows with a missing value first; "pairwise" (the default) refuses
+            missing values, since pairwise-complete correlations can't be indexed as fixed vectors.
+        dtype: Floating point type of the stored vectors; np.float32 halves the memory.
+        seed (int): Seed of the random projections.
+    """
+
+    def __init__(self, df, metric="pearson", labels=None, approximate=False, n_projections=256, nan_policy="pairwise",
+                 dtype=np.float64, seed=0):
+        if metric not in INDEX_METRICS:
+            raise ValueError(f"metric must be one of {INDEX_METRICS}, got {metric!r}")
+        df = as_connection_matrix(df)
+        if isinstance(df, pd.DataFrame):
+            if nan_policy == "complete":
+                df = df.dropna(axis=0, how='any')
+            values, self.labels = df.to_numpy(dtype=np.float64), pd.Index(df.columns)
+        else:
+            values = np.asarray(df, dtype=np.float64)
+            if nan_policy == "complete":
+                values = values[~np.isnan(values).any(axis=1)]
+            self.labels = numbered_labels(values.shape[1]) if labels is None else pd.Index(labels)
+        if np.isnan(values).any():
+            raise ValueError("The connection matrix has missing values; use nan_policy='complete' to drop those rows")
+        self.metric = metric
+
+        with instrument.span("similarity_index.build", n=values.shape[1], metric=metric):
+            # one unit vector per row, so a query reads one contiguous row
+            self.vectors = np.ascontiguousarray(standardize_columns(values, metric, dtype=dtype).T)
+            self.valid = ~np.isnan(self.vectors).any(axis=1)
+            self.vectors[~self.valid] = 0
+            self.projections = None
+            if approximate:
+                rng = np.random.default_rng(seed)
+                basis = rng.standard_normal((self.vectors.shape[1], n_projections)) / np.sqrt(n_projections)
+                self.projections = self.vectors @ basis.astype(dtype, copy=False)
+        # label -> position; a dict lookup keeps single-region queries free of pandas index overhead
+        self._positions = {label: position for position, label in enumerate(self.labels)}
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + (self.projections.nbytes if self.projections is not None else 0)
+
+    def neighbors(self, region, k=10):
+        """
+        The k regions nearest to one region.
+
+        Args:
+            region: Label of the query region.
+            k (int): Number of neighbours.
+
+        Returns:
+            pandas.Series: Distances indexed by neighbour label, nearest first (shorter if fewer regions qualify).
+        """
+        positions, distances = self.knn(k, [region])
+        found = positions[0] >= 0
+        return pd.Series(distances[0][found], index=self.labels[positions[0][found]], name=region)
+
+    def knn(self, k=10, regions=None, block_bytes=QUERY_BLOCK_BYTES):
+        """
+        The k nearest regions of many query regions at once, computed in blocks of queries.
+
+        Args:
+            k (int): Number of neighbours.
+            regions (list-like): Query region labels; every region by default.
+            block_bytes (int): Memory allowed for the similarities of one block of queries.
+
+        Returns:
+            tuple: (positions, distances), q x k arrays, nearest first. positions index self.labels; missing
+            neighbours (an invalid query region, or fewer than k valid regions) are -1 with distance NaN.
+        """
+        queries = np.arange(len(self)) if regions is None else self._lookup(regions)
+        k = min(k, max(len(self) - 1, 0))
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.nan)
+        if k == 0:
+            return positions, distances
+
+        # per query: its similarities to every region, plus the gathered candidate vectors in approximate mode
+        per_query = len(self)
+        if self.projections is not None:
+            per_query += self._n_candidates(k) * self.vectors.shape[1]
+        block = max(1, int(block_bytes // (self.vectors.itemsize * per_query)))
+        with instrument.span("similarity_index.query", queries=len(queries), k=k, approximate=self.projections is not None):
+            for start in range(0, len(queries), block):
+                rows = queries[start:start + block]
+                if self.projections is None:
+                    best, similarity = self._exact_block(rows, k)
+                else:
+                    best, similarity = self._approximate_block(rows, k)
+                distance = similarity_to_distance(similarity.astype(np.float64), self.metric)
+                # only invalid regions have -inf similarity left; they are never neighbours
+                missing = np.isneginf(similarity) | ~self.valid[rows][:, None]
+                best[missing] = -1
+                distance[missing] = np.nan
+                positions[start:start + len(rows)] = best
+                distances[start:start + len(rows)] = distance
+        return positions, distances
+
+    def _exact_block(self, rows, k):
+        # similarities of a block of queries to every region, then the k largest of each row
+        similarity = self.vectors[rows] @ self.vectors.T
+        return _top_k(similarity, rows, np.arange(len(self)), self.valid, k)
+
+    def _approximate_block(self, rows, k):
+        # candidates from the projected similarities, re-ranked with their exact similarities
+        n_candidates = self._n_candidates(k)
+        projected = self.projections[rows] @ self.projections.T
+        candidates, _ = _top_k(projected, rows, np.arange(len(self)), self.valid, n_candidates)
+        candidates = np.where(candidates < 0, rows[:, None], candidates)
+        similarity = np.einsum('qm,qcm->qc', self.vectors[rows], self.vectors[candidates])
+        return _top_k(similarity, rows, candidates, self.valid, k)
+
+    def _n_candidates(self, k):
+        return min(max(k * CANDIDATE_FACTOR, k + 1), len(self))
+
+    def _lookup(self, regions):
+        missing = [region for region in regions if region not in self._positions]
+        if missing:
+            raise KeyError(f"{missing} not found in axis")
+        return np.array([self._positions[region] for region in regions], dtype=np.int64)
+
+def _top_k(similarity, rows, columns, valid, k):
+    # the k most similar columns per row (as positions from columns), leaving out the query region itself and
+    # invalid regions; similarity is overwritten
+    columns = np.broadcast_to(columns, similarity.shape)
+    similarity[(columns == rows[:, None]) | ~valid[columns]] = -np.inf
+    part = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(similarity, part, axis=1)
+    order = np.argsort(-top, axis=1, kind='stable')
+    part = np.take_along_axis(part, order, axis=1)
+    return np.take_along_axis(columns, part, axis=1), np.take_along_axis(top, order, axis=1)
@@ -0,0 +1,64 @@
+# Table model for showing whole matrices in a QTableView.
+# The model reads straight from the matrix's numpy array (or memory map) and formats a cell only when the view
+# asks for it, so only the visible cells are ever converted to text, whatever the size of the matrix.
+import numpy as np
+from qtpy.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+
+class MatrixTableModel(QAbstractTableModel):
+    """
+    Read-only Qt table model over a labelled 2-D matrix.
+
+    Args:
+        matrix (pandas.DataFrame, TiledDistanceMatrix, CondensedMatrix or numpy.ndarray): Matrix to show; not copied.
+        float_format (str): Format spec used for floating point cells.
+        parent (QObject): Optional Qt parent.
+    """
+
+    def __init__(self, matrix=None, float_format=".4g", parent=None):
+        super().__init__(parent)
+        self.float_format = float_format
+        self._values = np.empty((0, 0))
+        self._index = self._columns = range(0)
+        if matrix is not None:
+            self.set_matrix(matrix)
+
+    def set_matrix(self, matrix):
+        # swaps in a new matrix (or the same one with new labels) and refreshes every attached view
+        self.beginResetModel()
+        if hasattr(matrix, 'to_numpy'):
+            # a view for single-dtype frames; mixed dtypes (e.g. text columns) become one object array
+            self._values = matrix.to_numpy()
+        else:
+            self._values = matrix.values if hasattr(matrix, 'values') else np.asarray(matrix)
+        n_rows, n_cols = self._values.shape
+        # pandas is not imported here, so that the main window can create an empty model without loading it
+        self._index = getattr(matrix, 'index', range(n_rows))
+        self._columns = getattr(matrix, 'columns', range(n_cols))
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._values.shape[0]
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._values.shape[1]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return self._format(self._values[index.row(), index.column()])
+        if role == Qt.TextAlignmentRole:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        labels = self._columns if orientation == Qt.Horizontal else self._index
+        return str(labels[section])
+
+    def _format(self, value):
+        if isinstance(value, (float, np.floating)):
+            return format(value, self.float_format)
+        return str(value)
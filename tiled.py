@@ -0,0 +1,211 @@
+# Out-of-core distance matrices.
+# The n x n result is computed in row/column tiles sized to a memory budget and written straight into a
+# memory-mapped .npy file, so neither the result nor the standardized input ever has to fit in RAM.
+import os
+import tempfile
+import weakref
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from kernels import similarity_to_distance, standardize_columns
+from loaders import numbered_labels
+
+
+DEFAULT_MEMORY_BUDGET = 512 * 1024 ** 2  # bytes
+
+
+class TiledDistanceMatrix:
+    """
+    Lazy handle on a distance matrix stored in a memory-mapped .npy file.
+
+    Behaves enough like the DataFrames returned by compute_distance_matrix (index, columns, shape,
+    numpy conversion) for compute_mds and the plotting code to consume it, but only pages in the parts
+    that are actually read.
+
+    Args:
+        path (str): The .npy file holding the matrix.
+        labels (list-like): Row and column labels.
+        owned (bool): The handle owns the file (a temporary result): it and its labels file are deleted by
+            close(), or once the handle is garbage collected.
+    """
+
+    def __init__(self, path, labels, owned=False):
+        self.path = path
+        self.index = pd.Index(labels)
+        self.columns = self.index
+        self._values = None
+        self._finalizer = weakref.finalize(self, _remove_files, path, _labels_path(path)) if owned else None
+
+    def close(self):
+        # releases the memory map and deletes the files if the handle owns them
+        self._values = None
+        if self._finalizer is not None:
+            self._finalizer()
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = np.load(self.path, mmap_mode='r')
+        return self._values
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values
+        if dtype is not None and dtype != values.dtype:
+            return values.astype(dtype)
+        return np.array(values) if copy else values
+
+    def to_frame(self):
+        # materializes the whole matrix in memory
+        return pd.DataFrame(np.array(self.values), index=self.index, columns=self.columns)
+
+    def preview(self, max_size=1000):
+        # strided subsample of at most max_size x max_size cells, cheap to read from disk
+        step = max(1, int(np.ceil(len(self) / max_size)))
+        sample = np.array(self.values[::step, ::step])
+        return pd.DataFrame(sample, index=self.index[::step], columns=self.columns[::step])
+
+
+def open_tiled_distance_matrix(path):
+    """
+    Reopens a distance matrix written by compute_distance_matrix_tiled.
+
+    Args:
+        path (str): Path to the .npy file holding the matrix.
+
+    Returns:
+        TiledDistanceMatrix: Lazy handle on the stored matrix.
+    """
+    labels = np.load(_labels_path(path), allow_pickle=False)
+    return TiledDistanceMatrix(path, labels)
+
+
+def compute_distance_matrix_tiled(df, metric="pearson", labels=None, memory_budget=DEFAULT_MEMORY_BUDGET, path=None, dtype=np.float64):
+    """
+    Computes the same column-by-column distance matrix as analysis.compute_distance_matrix, tile by tile.
+
+    Args:
+        df (pandas.DataFrame, numpy.ndarray or scipy.sparse matrix): m x n matrix whose columns are compared.
+        metric (str): "pearson", "spearman", "cosine" or "braycurtis".
+        labels (list-like): Column labels; taken from df.columns when df is a DataFrame.
+        memory_budget (int): Approximate number of bytes the working set of a single tile may use.
+        path (str): Where to write the .npy result (and its labels, as <name>_labels.npy). When omitted the
+            result goes to a temporary file owned by the returned handle, deleted by its close() or when the
+            handle is garbage collected; pass a path to keep the result.
+        dtype: Floating point type of the stored matrix and of the tile computations.
+
+    Returns:
+        TiledDistanceMatrix: Lazy handle on the memory-mapped result.
+    """
+    if isinstance(df, pd.DataFrame):
+        if labels is None:
+            labels = df.columns
+        X = df.to_numpy()
+    else:
+        X = df if sp.issparse(df) else np.asarray(df)
+    m, n = X.shape
+    if sp.issparse(X):
+        X = sp.csc_matrix(X)
+        if labels is None:
+            # named like compute_distance_matrix's in-memory sparse path
+            labels = numbered_labels(n)
+    if labels is None:
+        labels = pd.RangeIndex(n)
+
+    owned = path is None
+    if owned:
+        fd, path = tempfile.mkstemp(suffix='.npy', prefix='rsa_')
+        os.close(fd)
+    # created first, so a temporary file is also cleaned up if the computation fails
+    result = TiledDistanceMatrix(path, labels, owned=owned)
+
+    dtype = np.dtype(dtype)
+    block = _block_size(m, n, memory_budget, dtype.itemsize)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n, n))
+
+    if metric == "braycurtis":
+        from scipy.spatial.distance import cdist
+        _fill_tiles(out, lambda cols: _column_block(X, cols, dtype), block,
+                    lambda a, b: cdist(a.T, b.T, metric='braycurtis'))
+    else:
+        # standardize every column once into a scratch memmap; each tile is then a single GEMM.
+        # Columns without variance become NaN there and so come out NaN everywhere, like pandas' corr.
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            Z = np.lib.format.open_memmap(os.path.join(scratch_dir, 'z.npy'), mode='w+', dtype=dtype, shape=(m, n))
+            for start in range(0, n, block):
+                cols = slice(start, min(start + block, n))
+                Z[:, cols] = standardize_columns(_column_block(X, cols, dtype), metric, copy=False, dtype=dtype)
+
+            _fill_tiles(out, lambda cols: np.asarray(Z[:, cols]), block,
+                        lambda a, b: similarity_to_distance(a.T @ b, metric),
+                        nan_diagonal=metric != "cosine")
+            del Z
+
+    out.flush()
+    del out
+
+    # labels keep their dtype (numeric ones save without pickling); only object labels are stored as strings
+    label_values = np.asarray(labels)
+    if label_values.dtype == object:
+        label_values = label_values.astype(str)
+    np.save(_labels_path(path), label_values, allow_pickle=False)
+    return result
+
+
+def _labels_path(path):
+    root, _ = os.path.splitext(path)
+    return root + '_labels.npy'
+
+
+def _remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # already gone, or still mapped on a platform that refuses to delete it
+
+
+def _block_size(m, n, memory_budget, itemsize=8):
+    # a tile holds two m x b input blocks plus a b x b output: itemsize * (2*m*b + b*b) <= budget
+    b = int(-m + np.sqrt(m * m + memory_budget / itemsize))
+    return int(np.clip(b, 1, max(n, 1)))
+
+
+def _column_block(X, cols, dtype=np.float64):
+    block = X[:, cols]
+    block = block.toarray() if sp.issparse(block) else np.array(block, dtype=dtype)
+    if np.isnan(block).any():
+        raise ValueError("Tiled distance computation requires a matrix without missing values.")
+    return block.astype(dtype, copy=False)
+
+
+def _fill_tiles(out, read_block, block, tile_fn, nan_diagonal=False):
+    # only the upper triangle of tiles is computed; the lower one is its transpose
+    n = out.shape[0]
+    for i in range(0, n, block):
+        rows = slice(i, min(i + block, n))
+        a = read_block(rows)
+        for j in range(i, n, block):
+            cols = slice(j, min(j + block, n))
+            b = a if j == i else read_block(cols)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                tile = tile_fn(a, b)
+            if j == i:
+                # distance of a profile to itself is exactly 0, unless its correlation is undefined
+                diagonal = np.diag(tile)
+                np.fill_diagonal(tile, np.where(np.isnan(diagonal), np.nan, 0) if nan_diagonal else 0)
+            out[rows, cols] = tile
+            if j != i:
+                out[cols, rows] = tile.T
@@ -0,0 +1,198 @@
+# Background execution for the GUI.
+# Loading, RSA and MDS run as QRunnables on a QThreadPool so the window stays responsive. Results, errors and
+# progress come back to the UI thread through the signals of a WorkerSignals object. numpy and BLAS release
+# the GIL during the heavy lifting, so independent tasks (e.g. to- and from-matrix MDS) really run in parallel.
+import threading
+
+from qtpy.QtCore import QObject, QRunnable, QThreadPool, QTimer, Signal
+
+
+# repeat requests for the same task within this many milliseconds collapse into the last one
+DEFAULT_DEBOUNCE_MS = 200
+
+
+class Cancelled(Exception):
+    # raised inside a task at its next progress report once the task has been cancelled
+    pass
+
+
+class WorkerSignals(QObject):
+    """
+    Signals of a Worker. QRunnable is not a QObject, so it cannot carry signals itself.
+
+    progress carries (percent, message); result the task's return value; error the exception the task
+    raised (with its __traceback__). finished is emitted last in every case, including cancellation.
+    """
+    progress = Signal(int, str)
+    result = Signal(object)
+    error = Signal(object)
+    cancelled = Signal()
+    finished = Signal()
+
+
+class Worker(QRunnable):
+    """
+    Runs fn(*args, **kwargs) on a pool thread.
+
+    With report_progress=True the task also gets a progress=callable(percent, message) keyword argument.
+    Calling it emits the progress signal and is where cancellation takes effect: a cancelled task raises
+    Cancelled there, and whatever it would have returned is discarded.
+
+    Args:
+        fn (callable): The task.
+        report_progress (bool): Pass a progress callback to fn.
+    """
+
+    def __init__(self, fn, *args, report_progress=False, **kwargs):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self._cancel_event = threading.Event()
+        if report_progress:
+            self.kwargs['progress'] = self.report_progress
+        # the runner keeps its own reference; Qt must not delete the object behind it
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def report_progress(self, percent, message=""):
+        if self.is_cancelled():
+            raise Cancelled()
+        self.signals.progress.emit(int(percent), message)
+
+    def run(self):
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+            if self.is_cancelled():
+                raise Cancelled()
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            if not self.is_cancelled():
+                self.signals.error.emit(e)
+            else:
+                self.signals.cancelled.emit()
+        else:
+            self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()
+
+
+class TaskRunner(QObject):
+    """
+    Named background tasks on a QThreadPool, at most one live task per name.
+
+    Submitting a task under a name that is already running cancels the older task (its result is never
+    delivered), and submissions arriving within debounce_ms of each other are collapsed into the last one,
+    so repeated clicks start a single computation.
+
+    Cancelling only stops a task that has started at its next progress report (see Worker); until then it
+    keeps computing, and its result is discarded. The replacement waits for it to finish, so at most one
+    computation per name runs at a time and rapid edits never stack full computations on the pool.
+
+    Args:
+        parent (QObject): Usually the window that owns the runner.
+        debounce_ms (int): Debounce interval for submissions with the same name; 0 starts tasks immediately.
+        max_threads (int): Size of the thread pool; defaults to Qt's ideal thread count.
+    """
+
+    # emitted with the task name whenever the set of running tasks changes
+    busy_changed = Signal(str, bool)
+
+    def __init__(self, parent=None, debounce_ms=DEFAULT_DEBOUNCE_MS, max_threads=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        if max_threads is not None:
+            self.pool.setMaxThreadCount(max_threads)
+        self.debounce_ms = debounce_ms
+        self._workers = {}
+        self._timers = {}
+        # every started worker stays referenced here until it finishes, cancelled or not
+        self._running = set()
+        # per name: the worker executing on the pool, and the replacement waiting for it to finish
+        self._started = {}
+        self._queued = {}
+
+    def submit(self, name, fn, *args, on_result=None, on_error=None, on_progress=None, report_progress=False, **kwargs):
+        """
+        Queues fn(*args, **kwargs) as the task `name`; callbacks are invoked on the UI thread.
+
+        Returns:
+            Worker: The queued worker (it starts once the debounce interval has passed).
+        """
+        self.cancel(name)
+        worker = Worker(fn, *args, report_progress=report_progress, **kwargs)
+        if on_result is not None:
+            worker.signals.result.connect(on_result)
+        if on_error is not None:
+            worker.signals.error.connect(on_error)
+        if on_progress is not None:
+            worker.signals.progress.connect(on_progress)
+        worker.signals.finished.connect(lambda: self._finished(name, worker))
+        self._workers[name] = worker
+        self.busy_changed.emit(name, True)
+
+        if self.debounce_ms <= 0:
+            self._start(name, worker)
+            return worker
+        timer = QTimer(self)
+        timer.setSingleShot(True)
+        timer.timeout.connect(lambda: self._start(name, worker))
+        self._timers[name] = timer
+        timer.start(self.debounce_ms)
+        return worker
+
+    def cancel(self, name=None):
+        # cancels one task, or every task when name is None
+        names = list(self._workers) if name is None else [name]
+        for task_name in names:
+            timer = self._timers.pop(task_name, None)
+            if timer is not None:
+                # still waiting out the debounce interval: never started
+                timer.stop()
+                timer.deleteLater()
+            self._queued.pop(task_name, None)
+            worker = self._workers.pop(task_name, None)
+            if worker is not None:
+                worker.cancel()
+                self.busy_changed.emit(task_name, False)
+
+    def is_running(self, name=None):
+        return bool(self._workers) if name is None else name in self._workers
+
+    def wait(self, msecs=-1):
+        # blocks until every started task is done (for shutdown and scripts)
+        return self.pool.waitForDone(msecs)
+
+    def _start(self, name, worker):
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.deleteLater()
+        if self._workers.get(name) is worker and not worker.is_cancelled():
+            if name in self._started:
+                # a cancelled predecessor is still computing; start once it is done
+                self._queued[name] = worker
+                return
+            self._started[name] = worker
+            self._running.add(worker)
+            self.pool.start(worker)
+
+    def _finished(self, name, worker):
+        self._running.discard(worker)
+        # drop the task's inputs right away; the worker object itself may outlive this call
+        worker.fn, worker.args, worker.kwargs = None, (), {}
+        # a cancelled task may finish after its replacement was submitted; only forget the current one
+        if self._workers.get(name) is worker:
+            del self._workers[name]
+            self.busy_changed.emit(name, False)
+        if self._started.get(name) is worker:
+            del self._started[name]
+            queued = self._queued.pop(name, None)
+            if queued is not None:
+                self._start(name, queued)